@@ -13,35 +13,61 @@ from utils.config import opt
 from data.dataloader import DataLoader as DLoader
 import model.resnet_2d as models_2d
 import model.resnet_3d as models_3d
+from model.concurrent import StreamPool
 #import model.resnet3d_conv1_10 as model_dev
 from utils.extension import *
+from utils.timer import StageTimer, TraceWindow
+from data.telemetry import LoaderTelemetry
+from utils.tuner import tune
+from utils.compiled import TrainStep
+from utils.distributed import init_distributed, cleanup, is_main_process, wrap_model, \
+    unwrap_model, broadcast_buffers, all_reduce_meter, merge_video_preds, NullWriter
 
 
 def main(**kwargs):
 
     # opt config
     opt._parse(kwargs)
+    device = init_distributed(opt)
+
+    # pick batch_size and num_workers for this model and machine
+    if opt.autotune:
+        tune(opt, device, create_model)
 
     # Data Loader
     data_loader = DLoader(opt)
     train_loader, test_loader, test_video = data_loader.run()
 
     # Train my model
-    model = Resnet2D(opt, train_loader, test_loader, test_video)
+    model = Resnet2D(opt, train_loader, test_loader, test_video, device=device)
     model.run()
+    cleanup()
+
 
 
+def create_model(opt, pretrained=True):
+    # the probes of the tuner only need the architecture, not the stream weights
+    return Fusion_net(
+        RGB_weight='/home/ubuntu/cvlab/pytorch/icme2018/record/rgb_L1/model_best.pth.tar' if pretrained else None,
+        OPF_weight='/home/ubuntu/cvlab/pytorch/icme2018/record/opf_L15_Bbox/model_best.pth.tar' if pretrained else None,
+        opt=opt,
+        pretrained=pretrained
+    )
 
 
 class Resnet2D():
 
-    def __init__(self, opt, train_loader, test_loader, test_video):
+    def __init__(self, opt, train_loader, test_loader, test_video, device=None):
         self.opt = opt
+        self.device = device if device is not None else torch.device(opt.device)
         self.train_loader = train_loader
         self.test_loader = test_loader
         self.test_video = test_video
         self.best_prec1 = 0
 
+        # compiled forward and loss with --compile, built in run()
+        self.train_step = None
+
         # Check for rgb input
         if opt.input_type == 'rgb' and opt.nb_per_stack != 1:
             raise ValueError('rgb data only support nb_per_stack = 1')
@@ -54,29 +80,53 @@ class Resnet2D():
         # Bounding Box
         if opt.use_Bbox:
             log_dir = log_dir+'_Bbox'
-        self.tensorboard = SummaryWriter(log_dir=log_dir)
+        self.log_dir = log_dir
+        # only rank 0 writes tensorboard, timing and checkpoints
+        if is_main_process():
+            self.tensorboard = SummaryWriter(log_dir=log_dir)
+        else:
+            self.tensorboard = NullWriter()
+
+        # Hot path timing, the datasets report clip loading from their workers
+        self.timer = StageTimer(enabled=opt.timing and is_main_process(), sync=True)
+        if opt.timing and is_main_process():
+            for loader in [train_loader, test_loader]:
+                loader.dataset.db.timer = StageTimer(
+                    enabled=True,
+                    csv_path=os.path.join(log_dir, 'clip_timing.csv'),
+                    flush_every=200
+                )
+
+        # DataLoader worker telemetry, collected after every epoch
+        self.telemetry = None
+        if opt.telemetry:
+            self.telemetry = LoaderTelemetry()
+            for loader in [train_loader, test_loader]:
+                loader.dataset.db.telemetry = self.telemetry
 
     def build_model(self):
-        self.model = Fusion_net(
-            RGB_weight='/home/ubuntu/cvlab/pytorch/icme2018/record/rgb_L1/model_best.pth.tar',
-            OPF_weight='/home/ubuntu/cvlab/pytorch/icme2018/record/opf_L15_Bbox/model_best.pth.tar',
-            opt=self.opt
-        )
-        # To Cuda
-        self.model = self.model.cuda()
+        self.model = create_model(self.opt)
+        # To device
+        self.model = self.model.to(self.device)
 
         # Loss function and optimizer
-        self.criterion = nn.CrossEntropyLoss().cuda()
+        self.criterion = nn.CrossEntropyLoss().to(self.device)
         self.optimizer = torch.optim.SGD(
             self.model.parameters(), self.opt.lr, momentum=0.9)
         self.scheduler = ReduceLROnPlateau(
-            self.optimizer, 'min', patience=1, verbose=True)
+            self.optimizer, 'min', patience=1)
         print ('==> Build %s model and setup loss function and optimizer' %
                self.opt.model)
 
     def run(self):
         self.build_model()
+        self.checkpoint_writer = CheckpointWriter(
+            keep_last=self.opt.keep_last, background=self.opt.async_save)
         #self.resume_and_evaluate()
+        self.model = wrap_model(self.model, self.device)
+        if self.opt.compile:
+            self.train_step = TrainStep(self.model, self.criterion, self.opt.compile_mode,
+                                        verbose=is_main_process())
 
         cudnn.benchmark = True
         for self.epoch in range(self.opt.start_epoch, self.opt.nb_epochs):
@@ -87,6 +137,13 @@ class Resnet2D():
             prec1, val_loss = self.validate_1epoch()
             self.scheduler.step(val_loss)
 
+            # Save the current model and the best model, on rank 0 only
+            is_best = prec1 > self.best_prec1
+            if is_best:
+                self.best_prec1 = prec1
+            if not is_main_process():
+                continue
+
             # save training model and video level prediction
             save_folder = self.opt.record_path+'/' + \
                 '_SM_Fusion_L_'+str(opt.nb_per_stack)
@@ -98,29 +155,30 @@ class Resnet2D():
             if not os.path.isdir(save_folder):
                 os.mkdir(save_folder)
 
-            # Save the current model and the best model
-            is_best = prec1 > self.best_prec1
             if is_best:
-                self.best_prec1 = prec1
                 with open(save_folder+'/video_preds.pickle', 'wb') as f:
                     pickle.dump(self.dic_video_level_preds, f)
                 f.close()
 
             # Save model and hyperparameter
-            save_checkpoint({
+            self.checkpoint_writer.save({
                 'epoch': self.epoch,
-                'state_dict': self.model.state_dict(),
+                'state_dict': unwrap_model(self.model).state_dict(),
                 'best_prec1': self.best_prec1,
                 'optimizer': self.optimizer.state_dict(),
                 'config': self.opt._state_dict()
             }, is_best, folder=save_folder)
 
+        # wait for the last checkpoint to reach the disk
+        self.checkpoint_writer.close()
+
     def train_1epoch(self):
         batch_time = AverageMeter()
         data_time = AverageMeter()
-        losses = AverageMeter()
-        top1 = AverageMeter()
-        top5 = AverageMeter()
+        metrics = MetricMeter(topk=(1, 5))
+
+        # shuffle order of this epoch, see data.dataloader.ResumableRandomSampler
+        self.train_loader.sampler.set_epoch(self.epoch)
 
         # switch to train mode
         self.model.train()
@@ -129,115 +187,151 @@ class Resnet2D():
         # tqdm display
         des = 'Epoch:[%d/%d][training stage]' % (
             self.epoch, self.opt.nb_epochs)
-        progress = tqdm(self.train_loader, ascii=True, desc=des)
+        progress = tqdm(self.train_loader, ascii=True, desc=des, disable=not is_main_process())
+
+        # profiler trace for a few steps of the first epoch
+        trace = TraceWindow(
+            self.opt.trace_steps if self.epoch == self.opt.start_epoch and is_main_process() else 0,
+            self.opt.trace_start,
+            os.path.join(self.log_dir, 'trace_epoch%d.json' % self.epoch)
+        )
 
         # mini-batch training
         for i, (_key, data, label) in enumerate(progress):
             # measure data loading time
             data_time.update(time.time() - end)
+            self.timer.record('loader', data_time.val)
+            trace.step(i)
 
             # To cuda()
-            label = label.cuda(async=True)
-            target_var = Variable(label).cuda()
-
-            # Tensor to Variable
-            R = Variable(data[0]).cuda()
-            O = Variable(data[1]).cuda()
-            input_var = (R,O)
-
-            output = self.model(input_var)
-            loss = self.criterion(output, target_var)
-
-            # measure accuracy and record loss
-            prec1, prec5 = accuracy(output.data, label, topk=(1, 5))
-            losses.update(loss.data[0], label.size(0))
-            top1.update(prec1[0], label.size(0))
-            top5.update(prec5[0], label.size(0))
+            with self.timer.stage('h2d'):
+                label = label.to(self.device, non_blocking=True)
+                target_var = Variable(label).to(self.device)
+
+                # Tensor to Variable
+                R = Variable(data[0]).to(self.device)
+                O = Variable(data[1]).to(self.device)
+                input_var = (R,O)
+
+            if self.train_step is not None:
+                # one compiled graph, the loss is part of the forward stage
+                with self.timer.stage('forward'):
+                    output, loss = self.train_step(input_var, target_var)
+            else:
+                with self.timer.stage('forward'):
+                    output = self.model(input_var)
+                with self.timer.stage('loss'):
+                    loss = self.criterion(output, target_var)
+
+            # record loss and accuracy on device, no host sync here
+            metrics.update(loss, output, label)
 
             # compute gradient and do SGD step
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            with self.timer.stage('backward'):
+                self.optimizer.zero_grad()
+                loss.backward()
+            with self.timer.stage('optimizer'):
+                self.optimizer.step()
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
-            # tqdm visuallization
-            info = {
-                'Prec@1': display_format(top1.avg),
-                'Loss': display_format(losses.avg),
-                'Data Time': display_format(data_time.avg)
-            }
-            progress.set_postfix(info)
-
-        # tensorboard utils
+            # tqdm visuallization, synced every print_freq steps
+            if (i + 1) % self.opt.print_freq == 0:
+                loss_avg, (top1, top5) = metrics.summary()
+                info = {
+                    'Prec@1': display_format(top1),
+                    'Loss': display_format(loss_avg),
+                    'Data Time': display_format(data_time.avg)
+                }
+                progress.set_postfix(info, refresh=False)
+
+        # tensorboard utils, averaged over every rank
+        all_reduce_meter(metrics, self.device)
+        loss_avg, (top1, top5) = metrics.summary()
         tb_info = {
             'Batch Time': batch_time.avg,
             'Data Time': data_time.avg,
-            'Loss': losses.avg,
-            'Prec@1': top1.avg,
-            'Prec@5': top5.avg,
+            'Loss': loss_avg,
+            'Prec@1': top1,
+            'Prec@5': top5,
             'lr': self.optimizer.param_groups[0]['lr']
         }
         for k, v in tb_info.items():
             self.tensorboard.add_scalar('train/'+k, v, self.epoch)
 
+        # per-stage timing
+        trace.close()
+        if self.opt.timing:
+            self.timer.write_tensorboard(self.tensorboard, 'timing/', self.epoch)
+            self.timer.write_csv(os.path.join(self.log_dir, 'stage_timing.csv'), epoch=self.epoch)
+            self.timer.reset()
+        self.report_telemetry('train')
+
     def validate_1epoch(self):
         batch_time = AverageMeter()
-        losses = AverageMeter()
-        top1 = AverageMeter()
-        top5 = AverageMeter()
+        metrics = MetricMeter(topk=(1, 5))
+        # every rank scores its own shard of clips, without DDP collectives
+        model = unwrap_model(self.model)
+        broadcast_buffers(model)
         # switch to evaluate mode
-        self.model.eval()
+        model.eval()
         self.dic_video_level_preds = {}
+        clip_keys = []
+        clip_preds = []
         end = time.time()
 
         # tqdm display
         des = 'Epoch:[%d/%d][testing stage ]' % (
             self.epoch, self.opt.nb_epochs)
-        progress = tqdm(self.test_loader, ascii=True, desc=des)
+        progress = tqdm(self.test_loader, ascii=True, desc=des, disable=not is_main_process())
         # mini-batch training
         for i, (keys, data, label) in enumerate(progress):
             # TO cuda()
-            label = label.cuda(async=True)
-            label_var = Variable(label).cuda()
+            label = label.to(self.device, non_blocking=True)
+            label_var = Variable(label).to(self.device)
 
             # Tensor to Variable
-            R = Variable(data[0]).cuda()
-            O = Variable(data[1]).cuda()
+            R = Variable(data[0]).to(self.device)
+            O = Variable(data[1]).to(self.device)
             input_var = (R,O)
 
             # compute output
-            output = self.model(input_var)
-            loss = self.criterion(output, label_var)
-            prec1, prec5 = accuracy(output.data, label, topk=(1, 5))
+            with torch.no_grad():
+                output = model(input_var)
+                loss = self.criterion(output, label_var)
 
             # measure loss
-            losses.update(loss.data[0], label.size(0))
-            top1.update(prec1[0], label.size(0))
-            top5.update(prec5[0], label.size(0))
+            metrics.update(loss, output, label)
 
             # tqdm
-            info = {
-                'Prec@1': display_format(top1.avg),
-                'Loss': display_format(losses.avg),
-                'Batch Time': display_format(batch_time.avg),
-            }
-            progress.set_postfix(info)
+            if (i + 1) % self.opt.print_freq == 0:
+                loss_avg, (top1, top5) = metrics.summary()
+                info = {
+                    'Prec@1': display_format(top1),
+                    'Loss': display_format(loss_avg),
+                    'Batch Time': display_format(batch_time.avg),
+                }
+                progress.set_postfix(info, refresh=False)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
-            # Calculate video level prediction
-            preds = output.data.cpu().numpy()
-            nb_data = preds.shape[0]
-            for j in range(nb_data):
-                videoName = keys[j].split('/', 1)[0]
-                if videoName not in self.dic_video_level_preds.keys():
-                    self.dic_video_level_preds[videoName] = preds[j, :]
-                else:
-                    self.dic_video_level_preds[videoName] += preds[j, :]
+            # keep clip level prediction on device until the epoch ends
+            clip_keys.extend(keys)
+            clip_preds.append(output.detach())
+
+        # Calculate video level prediction
+        if clip_preds:
+            preds = torch.cat(clip_preds).cpu().numpy()
+        for j, key in enumerate(clip_keys):
+            videoName = key.split('/', 1)[0]
+            if videoName not in self.dic_video_level_preds.keys():
+                self.dic_video_level_preds[videoName] = preds[j, :].copy()
+            else:
+                self.dic_video_level_preds[videoName] += preds[j, :]
+        self.dic_video_level_preds = merge_video_preds(self.dic_video_level_preds)
 
         video_top1, video_top5, video_loss = self.frame2_video_level_accuracy()
         #print type(video_loss)
@@ -252,9 +346,22 @@ class Resnet2D():
 
         for k, v in info.items():
             self.tensorboard.add_scalar('test/'+k, v, self.epoch)
+        self.report_telemetry('test')
 
         return video_top1, video_loss
 
+    def report_telemetry(self, split):
+        if self.telemetry is None:
+            return
+        self.telemetry.collect()
+        if is_main_process():
+            report = self.telemetry.report()
+            print(report)
+            with open(os.path.join(self.log_dir, 'loader_telemetry.txt'), 'a') as f:
+                f.write('Epoch %d [%s]\n%s\n\n' % (self.epoch, split, report))
+            self.telemetry.write_tensorboard(self.tensorboard, split+'_loader/', self.epoch)
+        self.telemetry.reset()
+
     def frame2_video_level_accuracy(self):
         correct = 0
         video_level_preds = np.zeros(
@@ -277,8 +384,8 @@ class Resnet2D():
         video_level_labels = torch.from_numpy(video_level_labels).long()
         video_level_preds = torch.from_numpy(video_level_preds).float()
 
-        loss = self.criterion(Variable(video_level_preds).cuda(),
-                              Variable(video_level_labels).cuda())
+        loss = self.criterion(Variable(video_level_preds).to(self.device),
+                              Variable(video_level_labels).to(self.device))
 
         top1, top5 = accuracy(
             video_level_preds, video_level_labels, topk=(1, 5))
@@ -290,23 +397,27 @@ class Resnet2D():
         return top1, top5, loss.data.cpu().numpy()
 
 class Fusion_net(nn.Module):
-    def __init__(self, RGB_weight, OPF_weight, opt):
+    def __init__(self, RGB_weight, OPF_weight, opt, pretrained=True):
+        # RGB_weight / OPF_weight = None keeps the (ImageNet or random) init,
+        # e.g. for benchmarking without trained stream checkpoints
         super(Fusion_net, self).__init__()
         self.RGBnet = self.load_weight(
             models_2d.resnet50(
-                pretrained=True,
+                pretrained=pretrained,
                 channel=3,
                 nb_classes=opt.nb_classes,
-                extract_feature = True
+                extract_feature = True,
+                checkpoint_stages = opt.checkpoint_stages
                 ), 
             RGB_weight
             )
         self.OPFnet = self.load_weight(
             models_2d.resnet50(
-                pretrained=True,
-                channel=30,
+                pretrained=pretrained,
+                channel=2*opt.nb_per_stack,
                 nb_classes=opt.nb_classes,
-                extract_feature = True
+                extract_feature = True,
+                checkpoint_stages = opt.checkpoint_stages
                 ), 
             OPF_weight
             )
@@ -319,13 +430,16 @@ class Fusion_net(nn.Module):
         self.fusion_Linear = nn.Sequential(
                 nn.Dropout(0.5),
                 nn.Linear(256,1024),
-                nn.BatchNorm2d(1024),
+                nn.BatchNorm1d(1024),
                 nn.ReLU(inplace=True),
                 nn.Dropout(0.5),
                 nn.Linear(1024,15)
         )
+        self.streams = None  # see run_streams_concurrently
 
     def load_weight(self, model, weight_path):
+        if weight_path is None:
+            return model
         checkpoint = torch.load(weight_path)
         print("==> loaded checkpoint '{}' (epoch {}) (best_prec1 {})"
                   .format(weight_path, checkpoint['epoch'], checkpoint['best_prec1']))
@@ -334,9 +448,21 @@ class Fusion_net(nn.Module):
 
         return model
 
+    def run_streams_concurrently(self, mode='threads', cores=None):
+        # the two backbones are independent until torch.cat, run them on
+        # separate cores ('threads' or 'processes', see model/concurrent.py),
+        # mode=None goes back to one after the other
+        if self.streams is not None:
+            self.streams.close()
+        self.streams = StreamPool([self.RGBnet, self.OPFnet], mode, cores) if mode else None
+        return self
+
     def forward(self, x):
-        rx = self.RGBnet(x[0])
-        ox = self.OPFnet(x[1])
+        if self.streams is not None:
+            rx, ox = self.streams.run(x)
+        else:
+            rx = self.RGBnet(x[0])
+            ox = self.OPFnet(x[1])
 
         #print rx.size(),ox.size()
 
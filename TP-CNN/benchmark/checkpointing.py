@@ -0,0 +1,107 @@
+# Memory / time tradeoff of activation checkpointing per residual stage
+# Usage (from TP-CNN/):
+#   python -m benchmark.checkpointing --family=3d_pose --arch=resnet18 --L=15 --batch_size=8
+#   python -m benchmark.checkpointing --family=2d_opf --L=15 --configs='("","layer4","layer3,layer4","all")'
+#
+# 'act MB' is what autograd keeps alive for backward after one training
+# forward (parameters excluded). It is exact and device independent, and it
+# is what checkpointing saves. Each configuration also trains in a forked
+# child (see benchmark.model) for the step time and the RSS growth, which on
+# CPU also covers weights, gradients, optimizer state and allocator caching.
+# Select the configuration for training with --checkpoint_stages in utils/config.py.
+import json
+import torch
+import torch.nn as nn
+from benchmark.model import build, run_isolated
+from model.checkpointing import parse_stages
+
+
+DEFAULT_CONFIGS = ('', 'layer1', 'layer2', 'layer3', 'layer4', 'layer3,layer4', 'all')
+
+
+def activation_bytes(family, arch, L, stages, batch_size):
+    """Bytes of the tensors saved for backward by one training forward"""
+    model, make_input = build(family, arch, L, checkpoint_stages=stages)
+    model.train()
+    inputs = make_input(batch_size)
+    params = set(p.data_ptr() for p in model.parameters())
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in params:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        model(inputs)
+    return sum(storages.values())
+
+
+def check_gradients(family, arch, L, stages, batch_size=2):
+    """Max abs difference of gradients and BatchNorm statistics against no checkpointing"""
+    grads, buffers = [], []
+    for s in [(), stages]:
+        torch.manual_seed(0)
+        model, make_input = build(family, arch, L, checkpoint_stages=s)
+        model.train()
+        torch.manual_seed(1)
+        inputs = make_input(batch_size)
+        target = torch.randint(0, 15, (batch_size,))
+        nn.CrossEntropyLoss()(model(inputs), target).backward()
+        grads.append([p.grad for p in model.parameters() if p.grad is not None])
+        buffers.append([b.float() for b in model.buffers()])
+    diff = 0.
+    for a, b in zip(grads[0] + buffers[0], grads[1] + buffers[1]):
+        diff = max(diff, (a - b).abs().max().item())
+    return diff
+
+
+def main(family='3d_pose', arch='resnet18', L=15, batch_size=8, configs=DEFAULT_CONFIGS,
+         nb_iters=3, warmup=1, threads=0, output='checkpointing.json'):
+    if threads:
+        torch.set_num_threads(threads)
+    if isinstance(configs, str):
+        configs = [configs]
+    print('==> %s %s L=%d B=%d, torch %s, %d threads' % (
+        family, arch, L, batch_size, torch.__version__, torch.get_num_threads()))
+    print('%-20s %9s %7s %10s %10s %7s %14s' % (
+        'checkpoint_stages', 'act MB', 'act', 'RSS MB', 'train ms', 'time', 'max grad diff'))
+
+    results = []
+    base = None
+    for cfg in configs:
+        stages = parse_stages(cfg)
+        res = run_isolated(family=family, arch=arch, L=L, batch_size=batch_size,
+                           nb_iters=nb_iters, warmup=warmup, checkpoint_stages=stages)
+        if 'error' in res:
+            print('%-20s  %s' % (cfg or 'none', res['error']))
+            continue
+        res['activation_MB'] = activation_bytes(family, arch, L, stages, batch_size) / 2.**20
+        res['grad_diff'] = check_gradients(family, arch, L, stages) if stages else 0.
+        if base is None:
+            base = res
+        res.update({
+            'checkpoint_stages': ','.join(stages),
+            'family': family,
+            'arch': arch,
+            'nb_per_stack': L,
+            'batch_size': batch_size,
+            'activation_ratio': res['activation_MB'] / base['activation_MB'],
+            'time_ratio': res['train_step_ms'] / base['train_step_ms']
+        })
+        results.append(res)
+        print('%-20s %9.1f %6.0f%% %10.1f %10.1f %6.0f%% %14.2e' % (
+            cfg or 'none', res['activation_MB'], 100 * res['activation_ratio'],
+            res['peak_train_MB'], res['train_step_ms'], 100 * res['time_ratio'],
+            res['grad_diff']))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
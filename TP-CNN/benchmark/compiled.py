@@ -0,0 +1,118 @@
+# Eager vs torch.compile training steps (utils/compiled.py) on CPU
+# Usage (from TP-CNN/):
+#   python -m benchmark.compiled --families='(2d_pose,3d_pose,fusion)' --arch=resnet18 --L=15 --batch_size=8
+#
+# Random weights and one fixed random batch. Each mode starts from the same
+# weights and runs the trainers' step: forward and loss (TrainStep when
+# compiled), backward and SGD. 'warmup' is the first step, which for the
+# compiled mode traces and compiles the forward and the backward; 'step ms'
+# is the mean of the next --nb_iters steps. 'loss diff' is the largest
+# difference between the losses of the two modes over the timed steps
+# (Fusion_net has dropout, its losses differ by the random masks). Every
+# family runs in a forked child, like benchmark.model.
+import copy
+import json
+import time
+import multiprocessing
+import torch
+import torch.nn as nn
+from benchmark.model import build
+from utils.compiled import TrainStep
+
+
+def _as_tuple(v):
+    if isinstance(v, str):
+        return tuple(s.strip() for s in v.strip('()[]').split(',') if s.strip())
+    return tuple(v) if isinstance(v, (tuple, list)) else (v,)
+
+
+def train(model, step, inputs, target, nb_iters):
+    optimizer = torch.optim.SGD(model.parameters(), 1e-3, momentum=0.9)
+    times, losses = [], []
+    for _ in range(nb_iters + 1):
+        start = time.time()
+        output, loss = step(inputs, target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        times.append(time.time() - start)
+        losses.append(float(loss.detach()))
+    return times[0], sum(times[1:]) / nb_iters, losses[1:]
+
+
+def measure(family, arch, L, batch_size, nb_iters, mode='default', seed=0):
+    torch.manual_seed(seed)
+    model, make_input = build(family, arch, L)
+    model.train()
+    inputs = make_input(batch_size)
+    target = torch.randint(0, 15, (batch_size,))
+    criterion = nn.CrossEntropyLoss()
+
+    eager_model = copy.deepcopy(model)
+
+    def eager(x, y):
+        output = eager_model(x)
+        return output, criterion(output, y)
+    eager_warmup, eager_sec, eager_losses = train(eager_model, eager, inputs, target, nb_iters)
+
+    step = TrainStep(model, criterion, mode, verbose=False)
+    warmup, sec, losses = train(model, step, inputs, target, nb_iters)
+    return {
+        'eager_warmup_sec': eager_warmup,
+        'eager_step_ms': 1000. * eager_sec,
+        'compiled_warmup_sec': warmup,
+        'compile_sec': step.compile_sec,
+        'compiled_step_ms': 1000. * sec,
+        'speedup': eager_sec / sec,
+        'fallback': step.fallback,
+        'loss_diff': max(abs(a - b) for a, b in zip(eager_losses, losses)),
+    }
+
+
+def _child(q, kwargs):
+    try:
+        q.put(measure(**kwargs))
+    except Exception as e:
+        q.put({'error': '%s: %s' % (type(e).__name__, e)})
+
+
+def main(families=('2d_pose', '3d_pose', 'fusion'), arch='resnet18', L=15, batch_size=8, nb_iters=5,
+         mode='default', threads=0, output='compiled.json'):
+    if threads:
+        torch.set_num_threads(threads)
+    print('==> %s L=%d B=%d, torch %s, %d threads, compile mode %s' % (
+        arch, L, batch_size, torch.__version__, torch.get_num_threads(), mode))
+    print('%-12s %-9s %12s %12s %12s %14s %8s %10s' % (
+        'family', 'arch', 'eager ms', 'warmup sec', 'compile sec', 'compiled ms', 'speedup', 'loss diff'))
+
+    results = []
+    ctx = multiprocessing.get_context('fork')
+    for family in _as_tuple(families):
+        q = ctx.Queue()
+        p = ctx.Process(target=_child, args=(q, dict(family=family, arch=arch, L=L, batch_size=batch_size,
+                                                     nb_iters=nb_iters, mode=mode)))
+        p.start()
+        r = q.get()
+        p.join()
+        r.update({'family': family, 'arch': 'resnet50' if family == 'fusion' else arch,
+                  'nb_per_stack': L, 'batch_size': batch_size, 'mode': mode})
+        results.append(r)
+        if 'error' in r:
+            print('%-12s %-9s  %s' % (family, r['arch'], r['error']))
+            continue
+        print('%-12s %-9s %12.1f %12.1f %12s %14.1f %7.2fx %10.2g' % (
+            family, r['arch'], r['eager_step_ms'], r['compiled_warmup_sec'],
+            '%.1f' % r['compile_sec'] if r['compile_sec'] is not None else '-',
+            r['compiled_step_ms'], r['speedup'], r['loss_diff']))
+        if r['fallback']:
+            print('    eager fallback: %s' % r['fallback'])
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,75 @@
+# Fusion_net inference latency with its two backbones one after the other or concurrently
+# Usage (from TP-CNN/):
+#   python -m benchmark.fusion_streams --batch_sizes='(1,4,16)' --L=15
+#   python -m benchmark.fusion_streams --modes='(sequential,threads)' --cores='(0,1,2,3,4,5,6,7)'
+#
+# Random weights and inputs. 'sequential' is the plain forward on all
+# --cores, 'threads' and 'processes' run the RGB and OPF resnet50 streams
+# concurrently on half of the cores each (Fusion_net.run_streams_concurrently,
+# model/concurrent.py). Every mode is checked against the logits of the
+# first mode, and its speedup is relative to it.
+# On a single core there is nothing to partition and the concurrent modes
+# only add their hand-off cost.
+import os
+import json
+import time
+import numpy as np
+import torch
+from benchmark.model import build
+
+
+def _as_tuple(v):
+    if isinstance(v, str):
+        return tuple(s.strip() for s in v.strip('()[]').split(',') if s.strip())
+    return tuple(v) if isinstance(v, (tuple, list)) else (v,)
+
+
+def latency(model, inputs, nb_iters, warmup):
+    ms = []
+    with torch.no_grad():
+        for i in range(warmup + nb_iters):
+            start = time.time()
+            out = model(inputs)
+            if i >= warmup:
+                ms.append(1000. * (time.time() - start))
+    ms = np.array(ms)
+    return out, {'p50': float(np.percentile(ms, 50)), 'p90': float(np.percentile(ms, 90)),
+                 'mean': float(ms.mean()), 'min': float(ms.min())}
+
+
+def main(batch_sizes=(1, 4), L=15, modes=('sequential', 'threads', 'processes'), cores=None,
+         nb_iters=10, warmup=2, output='fusion_streams.json'):
+    cores = sorted(os.sched_getaffinity(0)) if cores is None else [int(c) for c in _as_tuple(cores)]
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.manual_seed(0)
+    model, make_input = build('fusion', 'resnet50', L)
+    model.eval()
+    print('==> Fusion_net L=%d, %d cores, torch %s' % (L, len(cores), torch.__version__))
+    print('%-11s %4s %10s %10s %10s %9s %10s' % ('mode', 'B', 'p50 ms', 'p90 ms', 'mean ms', 'speedup', 'max diff'))
+
+    results = []
+    for B in [int(b) for b in _as_tuple(batch_sizes)]:
+        inputs = make_input(B)
+        reference, base = None, None
+        for mode in _as_tuple(modes):
+            model.run_streams_concurrently(None if mode == 'sequential' else mode, cores)
+            out, r = latency(model, inputs, nb_iters, warmup)
+            if reference is None:
+                reference, base = out, r['p50']
+            r.update({'mode': mode, 'batch_size': B, 'nb_cores': len(cores),
+                      'speedup': base / r['p50'], 'max_diff': float((out - reference).abs().max())})
+            results.append(r)
+            print('%-11s %4d %10.1f %10.1f %10.1f %8.2fx %10.2g' % (
+                mode, B, r['p50'], r['p90'], r['mean'], r['speedup'], r['max_diff']))
+    model.run_streams_concurrently(None)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,138 @@
+# Input pipeline benchmark on a synthetic Penn Action tree
+# Usage (from TP-CNN/):
+#   python -m benchmark.loader --output=loader_bench.json
+#   python -m benchmark.loader --data_root=/tmp/PennAction_synth/ --num_workers='(0,4,8)'
+import os
+import json
+import time
+import random
+import itertools
+import tempfile
+import torch
+from torch.utils.data import DataLoader as _DataLoader, RandomSampler
+from utils.config import Config
+from data.dataloader import DataLoader as DLoader, Train_Dataset
+from data.telemetry import LoaderTelemetry
+from data.synthetic import generate
+
+
+INPUT_TYPES = ('pose', 'opf', 'rgb', '3d_pose')
+
+
+def _tensor_bytes(item):
+    if isinstance(item, (tuple, list)):
+        return sum(_tensor_bytes(x) for x in item)
+    return item.numel() * item.element_size()
+
+
+def make_config(data_root, dic_path, input_type, nb_per_stack, use_Bbox, Fusion,
+                num_workers, batch_size):
+    cfg = Config()
+    cfg.data_root = data_root
+    cfg.dic_path = dic_path
+    cfg.input_type = input_type
+    cfg.nb_per_stack = nb_per_stack
+    cfg.use_Bbox = use_Bbox
+    cfg.Fusion = Fusion
+    cfg.num_workers = num_workers
+    cfg.batch_size = batch_size
+    return cfg
+
+
+def bench_one(cfg, nb_batches, seed=0):
+    """Returns clips/s and bytes/clip of the training loader for one config."""
+    # the train split draws clips with random.randint, seeded so that every
+    # run reads the same files (workers are seeded from the loader generator)
+    random.seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+    data_loader = DLoader(cfg)
+    data_loader.train_video_labeling()
+    training_set = Train_Dataset(opt=cfg, dic_train=data_loader.dic_video_train)
+    telemetry = LoaderTelemetry()
+    training_set.db.telemetry = telemetry
+
+    # sample clips with replacement so the run length does not depend on
+    # the number of videos; the first batch pays for worker startup
+    sampler = RandomSampler(training_set, replacement=True,
+                            num_samples=cfg.batch_size * (nb_batches + 1), generator=generator)
+    loader = _DataLoader(training_set, batch_size=cfg.batch_size, sampler=sampler,
+                         num_workers=cfg.num_workers, generator=generator)
+
+    start = time.time()
+    batches = iter(loader)
+    batch = next(batches)
+    startup = time.time() - start
+
+    start = time.time()
+    nb_clips = 0
+    for batch in batches:
+        nb_clips += batch[-1].size(0)
+    elapsed = time.time() - start
+
+    telemetry.collect()
+    stats = telemetry.worker_stats()
+    nb_samples = sum(s['samples'] for s in stats.values())
+    bytes_read = sum(s['MB_read'] for s in stats.values()) * 2.**20
+    item = batch[1] if cfg.Fusion else batch[0]
+
+    return {
+        'clips_per_sec': nb_clips / elapsed,
+        'startup_sec': startup,
+        'bytes_read_per_clip': bytes_read / max(nb_samples, 1),
+        'tensor_bytes_per_clip': _tensor_bytes(item) // batch[-1].size(0)
+    }
+
+
+def sweep(input_type=INPUT_TYPES, nb_per_stack=(1, 5, 15), use_Bbox=(False, True),
+          Fusion=(False, True), num_workers=(0, 2)):
+    """Yields every valid (input_type, nb_per_stack, use_Bbox, Fusion, num_workers)."""
+    for fusion, L, bbox, workers in itertools.product(Fusion, nb_per_stack, use_Bbox, num_workers):
+        if fusion:
+            # Fusiondataset always reads rgb + opf, input_type is ignored
+            yield ('fusion', L, bbox, True, workers)
+            continue
+        for kind in input_type:
+            if kind == 'rgb' and L != 1:
+                continue
+            yield (kind, L, bbox, False, workers)
+
+
+def main(data_root=None, output='loader_bench.json', batch_size=8, nb_batches=10,
+         input_type=INPUT_TYPES, nb_per_stack=(1, 5, 15), use_Bbox=(False, True),
+         Fusion=(False, True), num_workers=(0, 2)):
+    if data_root is None:
+        data_root = os.path.join(tempfile.mkdtemp(prefix='PennAction_synth_'), '')
+        print('==> Generating synthetic Penn Action in %s' % data_root)
+        generate(data_root, nb_frames=max(nb_per_stack) + 10)
+    dic_path = os.path.join(data_root, 'train_test_split')
+
+    results = []
+    print('%-8s %3s %5s %6s %7s %10s %12s %12s' % (
+        'input', 'L', 'Bbox', 'Fusion', 'workers', 'clips/s', 'read KB/clip', 'tensor KB/clip'))
+    for kind, L, bbox, fusion, workers in sweep(
+            input_type, nb_per_stack, use_Bbox, Fusion, num_workers):
+        cfg = make_config(data_root, dic_path, kind if not fusion else 'rgb',
+                          L, bbox, fusion, workers, batch_size)
+        res = bench_one(cfg, nb_batches)
+        res.update({
+            'input_type': kind,
+            'nb_per_stack': L,
+            'use_Bbox': bbox,
+            'Fusion': fusion,
+            'num_workers': workers,
+            'batch_size': batch_size
+        })
+        results.append(res)
+        print('%-8s %3d %5s %6s %7d %10.2f %12.1f %12.1f' % (
+            kind, L, bbox, fusion, workers, res['clips_per_sec'],
+            res['bytes_read_per_clip'] / 1024., res['tensor_bytes_per_clip'] / 1024.))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,85 @@
+# Compare per-step metric syncing against deferred on-device accumulation
+# Usage (from TP-CNN/): python -m benchmark.metrics --steps=50 --batch_size=8
+import time
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+import model.resnet_2d as models_2d
+from utils.extension import *
+
+
+def per_step_sync(model, criterion, optimizer, batches):
+    # the original loop: accuracy() and loss.item() every step
+    losses = AverageMeter()
+    top1 = AverageMeter()
+    top5 = AverageMeter()
+    progress = tqdm(batches, ascii=True, desc='per-step sync', leave=False)
+    for data, label in progress:
+        output = model(data)
+        loss = criterion(output, label)
+        prec1, prec5 = accuracy(output.data, label, topk=(1, 5))
+        losses.update(loss.item(), data.size(0))
+        top1.update(prec1.item(), data.size(0))
+        top5.update(prec5.item(), data.size(0))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        progress.set_postfix({
+            'Prec@1': display_format(top1.avg),
+            'Loss': display_format(losses.avg)
+        })
+
+
+def deferred(model, criterion, optimizer, batches, print_freq=20):
+    metrics = MetricMeter(topk=(1, 5))
+    progress = tqdm(batches, ascii=True, desc='deferred', leave=False)
+    for i, (data, label) in enumerate(progress):
+        output = model(data)
+        loss = criterion(output, label)
+        metrics.update(loss, output, label)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if (i + 1) % print_freq == 0:
+            loss_avg, (prec1, prec5) = metrics.summary()
+            progress.set_postfix({
+                'Prec@1': display_format(prec1),
+                'Loss': display_format(loss_avg)
+            }, refresh=False)
+    metrics.summary()
+
+
+def main(model='resnet18', channel=15, batch_size=8, steps=50, print_freq=20):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    net = models_2d.__dict__[model](pretrained=False, channel=channel).to(device)
+    criterion = nn.CrossEntropyLoss().to(device)
+    optimizer = torch.optim.SGD(net.parameters(), 1e-3, momentum=0.9)
+    batches = [(torch.randn(batch_size, channel, 224, 224, device=device),
+                torch.randint(0, 15, (batch_size,), device=device))
+               for _ in range(steps)]
+
+    results = {}
+    for name, fn in [('per-step sync', per_step_sync), ('deferred', deferred)]:
+        # one warm-up step so allocator / cudnn setup is not billed
+        fn(net, criterion, optimizer, batches[:1])
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        if fn is deferred:
+            fn(net, criterion, optimizer, batches, print_freq)
+        else:
+            fn(net, criterion, optimizer, batches)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        results[name] = steps * batch_size / (time.time() - start)
+
+    print('==> %s on %s, batch_size %d, %d steps' % (model, device, batch_size, steps))
+    for name, clips_per_sec in results.items():
+        print('%-14s %8.2f clips/s' % (name, clips_per_sec))
+    print('speedup        %8.3fx' % (results['deferred'] / results['per-step sync']))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,183 @@
+# CPU latency / throughput / memory benchmark for every model factory
+# Usage (from TP-CNN/):
+#   python -m benchmark.model --output=model_bench.json
+#   python -m benchmark.model --archs='(resnet18,resnet34,resnet50,resnet101)' --depths='(5,10,15)'
+#
+# Every configuration runs in a forked child so its peak RSS can be
+# measured in isolation (ru_maxrss of a fresh fork starts at the current RSS).
+import json
+import time
+import queue
+import resource
+import itertools
+import multiprocessing
+import torch
+import torch.nn as nn
+import model.resnet_2d as models_2d
+import model.resnet_3d as models_3d
+import model.resnet_3d_conv1_10 as model_dev
+from utils.config import Config
+
+
+# family : (module, input channels as a function of the stack length L)
+FAMILIES = {
+    '2d_pose': (models_2d, lambda L: L),
+    '2d_opf': (models_2d, lambda L: 2 * L),
+    '2d_rgb': (models_2d, lambda L: 3),
+    '3d_pose': (models_3d, lambda L: 1),
+    '3d_conv1_10': (model_dev, lambda L: 1),
+    'fusion': (None, lambda L: 3 + 2 * L),
+}
+
+
+def build(family, arch, L, nb_classes=15, checkpoint_stages=()):
+    """Returns (model, inputs builder) with random weights."""
+    module, channel = FAMILIES[family]
+    if family == 'fusion':
+        from Fusion import Fusion_net
+        cfg = Config()
+        cfg.nb_per_stack = L
+        cfg.nb_classes = nb_classes
+        cfg.checkpoint_stages = checkpoint_stages
+        model = Fusion_net(None, None, cfg, pretrained=False)
+        make_input = lambda B: (torch.randn(B, 3, 224, 224), torch.randn(B, 2 * L, 224, 224))
+    elif family.startswith('3d'):
+        model = module.__dict__[arch](pretrained=False, num_classes=nb_classes,
+                                      checkpoint_stages=checkpoint_stages)
+        make_input = lambda B: torch.randn(B, 1, L, 112, 112)
+    else:
+        c = channel(L)
+        model = module.__dict__[arch](pretrained=False, channel=c, nb_classes=nb_classes,
+                                      checkpoint_stages=checkpoint_stages)
+        make_input = lambda B: torch.randn(B, c, 224, 224)
+    return model, make_input
+
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _timeit(fn, nb_iters, warmup):
+    for _ in range(warmup):
+        fn()
+    start = time.time()
+    for _ in range(nb_iters):
+        fn()
+    return (time.time() - start) / nb_iters
+
+
+def measure(family, arch, L, batch_size, nb_iters=3, warmup=1, nb_classes=15,
+            checkpoint_stages=()):
+    rss0 = _maxrss()
+    model, make_input = build(family, arch, L, nb_classes, checkpoint_stages)
+    inputs = make_input(batch_size)
+    target = torch.randint(0, nb_classes, (batch_size,))
+    params = sum(p.numel() for p in model.parameters())
+
+    model.eval()
+
+    def forward():
+        with torch.no_grad():
+            model(inputs)
+    forward_sec = _timeit(forward, nb_iters, warmup)
+    forward_rss = _maxrss() - rss0
+
+    model.train()
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), 1e-3, momentum=0.9)
+
+    def train_step():
+        output = model(inputs)
+        loss = criterion(output, target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    train_sec = _timeit(train_step, nb_iters, warmup)
+    train_rss = _maxrss() - rss0
+
+    return {
+        'params': params,
+        'forward_ms': 1000. * forward_sec,
+        'train_step_ms': 1000. * train_sec,
+        'forward_clips_per_sec': batch_size / forward_sec,
+        'train_clips_per_sec': batch_size / train_sec,
+        'peak_forward_MB': forward_rss / 2.**20,
+        'peak_train_MB': train_rss / 2.**20
+    }
+
+
+def _child(q, kwargs):
+    try:
+        q.put(measure(**kwargs))
+    except Exception as e:
+        q.put({'error': '%s: %s' % (type(e).__name__, e)})
+
+
+def run_isolated(**kwargs):
+    ctx = multiprocessing.get_context('fork')
+    q = ctx.Queue()
+    p = ctx.Process(target=_child, args=(q, kwargs))
+    p.start()
+    result = None
+    while result is None and p.is_alive():
+        try:
+            result = q.get(timeout=5)
+        except queue.Empty:
+            pass
+    if result is None:
+        # the child has exited, a result it put may still be in the pipe
+        try:
+            result = q.get(timeout=1)
+        except queue.Empty:
+            # killed before q.put, e.g. by the OOM killer or a crash in a native kernel
+            result = {'error': 'child exited with code %s without a result' % p.exitcode}
+    p.join()
+    return result
+
+
+def sweep(families, archs, depths, batch_sizes):
+    for family, arch, L, B in itertools.product(families, archs, depths, batch_sizes):
+        if family == '2d_rgb' and L != depths[0]:
+            continue  # rgb does not depend on the stack length
+        if family == 'fusion' and arch != archs[0]:
+            continue  # Fusion_net is always two resnet50 streams
+        yield family, arch, L, B
+
+
+def main(output='model_bench.json', families=tuple(sorted(FAMILIES)),
+         archs=('resnet18', 'resnet50'), depths=(5, 15), batch_sizes=(2, 8),
+         nb_iters=3, warmup=1, threads=0):
+    if threads:
+        torch.set_num_threads(threads)
+    print('==> torch %s, %d threads' % (torch.__version__, torch.get_num_threads()))
+    print('%-12s %-10s %3s %3s %9s %10s %10s %9s %9s' % (
+        'family', 'arch', 'L', 'B', 'params M', 'fwd ms', 'train ms', 'fwd MB', 'train MB'))
+
+    results = []
+    for family, arch, L, B in sweep(families, archs, depths, batch_sizes):
+        res = run_isolated(family=family, arch=arch, L=L, batch_size=B,
+                           nb_iters=nb_iters, warmup=warmup)
+        res.update({
+            'family': family,
+            'arch': 'resnet50' if family == 'fusion' else arch,
+            'nb_per_stack': L,
+            'batch_size': B,
+            'threads': torch.get_num_threads()
+        })
+        results.append(res)
+        if 'error' in res:
+            print('%-12s %-10s %3d %3d  %s' % (family, res['arch'], L, B, res['error']))
+            continue
+        print('%-12s %-10s %3d %3d %9.2f %10.1f %10.1f %9.1f %9.1f' % (
+            family, res['arch'], L, B, res['params'] / 1e6, res['forward_ms'],
+            res['train_step_ms'], res['peak_forward_MB'], res['peak_train_MB']))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,169 @@
+# Performance regression gate: fixed loader / model micro-benchmarks vs a stored baseline
+# Usage (from TP-CNN/):
+#   python -m benchmark.regression                      # compare, exit 1 on regression
+#   python -m benchmark.regression --update             # (re)write the baseline
+#   python -m benchmark.regression --baseline=benchmark/baselines/gpu-node.json
+#
+# Baselines are machine specific, record one per host type with --update.
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import torch
+from data.synthetic import generate
+from benchmark.loader import make_config, bench_one
+from benchmark.model import run_isolated
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'cpu.json')
+
+# name : (input_type, nb_per_stack, use_Bbox, Fusion)
+LOADER_CASES = {
+    'loader/pose_L5': ('pose', 5, False, False),
+    'loader/pose_L5_Bbox': ('pose', 5, True, False),
+    'loader/opf_L5': ('opf', 5, False, False),
+    'loader/rgb_L1': ('rgb', 1, False, False),
+    'loader/3d_pose_L5': ('3d_pose', 5, False, False),
+    'loader/fusion_L5': ('rgb', 5, False, True),
+}
+
+# name : (family, arch, nb_per_stack, batch_size)
+MODEL_CASES = {
+    'model/2d_pose_resnet18_L5_B2': ('2d_pose', 'resnet18', 5, 2),
+    'model/2d_opf_resnet18_L5_B2': ('2d_opf', 'resnet18', 5, 2),
+    'model/3d_pose_resnet18_L5_B2': ('3d_pose', 'resnet18', 5, 2),
+}
+
+# metric : (higher is better, allowed relative change)
+TOLERANCE = {
+    'clips_per_sec': (True, 0.30),
+    'bytes_read_per_clip': (False, 0.05),
+    'tensor_bytes_per_clip': (False, 0.0),
+    'forward_ms': (False, 0.30),
+    'train_step_ms': (False, 0.30),
+    'peak_train_MB': (False, 0.20),
+    'params': (False, 0.0),
+}
+
+
+def run_cases(repeats=3, nb_batches=10, batch_size=8):
+    """Returns {case: {metric: value}}, best of `repeats` for timings."""
+    data_root = os.path.join(tempfile.mkdtemp(prefix='PennAction_synth_'), '')
+    generate(data_root, nb_frames=20, seed=0)
+    dic_path = os.path.join(data_root, 'train_test_split')
+
+    results = {}
+    try:
+        for name, (kind, L, bbox, fusion) in sorted(LOADER_CASES.items()):
+            cfg = make_config(data_root, dic_path, kind, L, bbox, fusion, 0, batch_size)
+            runs = [bench_one(cfg, nb_batches) for _ in range(repeats)]
+            results[name] = {
+                'clips_per_sec': max(r['clips_per_sec'] for r in runs),
+                'bytes_read_per_clip': runs[0]['bytes_read_per_clip'],
+                'tensor_bytes_per_clip': runs[0]['tensor_bytes_per_clip']
+            }
+            print('==> %-30s %s' % (name, _fmt(results[name])))
+    finally:
+        shutil.rmtree(data_root)
+
+    for name, (family, arch, L, B) in sorted(MODEL_CASES.items()):
+        runs = [run_isolated(family=family, arch=arch, L=L, batch_size=B, nb_iters=5, warmup=2)
+                for _ in range(repeats)]
+        for r in runs:
+            if 'error' in r:
+                raise RuntimeError('%s failed: %s' % (name, r['error']))
+        results[name] = {
+            'forward_ms': min(r['forward_ms'] for r in runs),
+            'train_step_ms': min(r['train_step_ms'] for r in runs),
+            'peak_train_MB': min(r['peak_train_MB'] for r in runs),
+            'params': runs[0]['params']
+        }
+        print('==> %-30s %s' % (name, _fmt(results[name])))
+    return results
+
+
+def _fmt(metrics):
+    return ', '.join('%s=%.4g' % (k, v) for k, v in sorted(metrics.items()))
+
+
+def environment():
+    return {
+        'torch': torch.__version__,
+        'threads': torch.get_num_threads(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'python': platform.python_version()
+    }
+
+
+def compare(baseline, current, tolerance_scale=1.0):
+    """Returns (rows, nb_regressions); each row is one metric of one case."""
+    rows = []
+    nb_regressions = 0
+    for case in sorted(baseline):
+        for metric, base in sorted(baseline[case].items()):
+            higher_is_better, allowed = TOLERANCE[metric]
+            allowed *= tolerance_scale
+            if case not in current or metric not in current[case]:
+                rows.append((case, metric, base, None, None, allowed, 'MISSING'))
+                nb_regressions += 1
+                continue
+            value = current[case][metric]
+            change = (value - base) / base if base else 0.
+            worse = -change if higher_is_better else change
+            if worse > allowed + 1e-9:
+                status = 'REGRESSED'
+                nb_regressions += 1
+            elif worse < -allowed:
+                status = 'improved'
+            else:
+                status = 'ok'
+            rows.append((case, metric, base, value, change, allowed, status))
+    return rows, nb_regressions
+
+
+def format_rows(rows):
+    lines = ['%-30s %-22s %12s %12s %9s %8s  %s' % (
+        'case', 'metric', 'baseline', 'current', 'change', 'allowed', 'status')]
+    for case, metric, base, value, change, allowed, status in rows:
+        lines.append('%-30s %-22s %12.4g %12s %9s %7.0f%%  %s' % (
+            case, metric, base,
+            '-' if value is None else '%.4g' % value,
+            '-' if change is None else '%+.1f%%' % (100 * change),
+            100 * allowed, status))
+    return '\n'.join(lines)
+
+
+def main(baseline=DEFAULT_BASELINE, update=False, repeats=5, tolerance_scale=1.0, threads=1):
+    # a fixed thread count keeps latency comparable between runs
+    torch.set_num_threads(threads)
+    current = run_cases(repeats=repeats)
+
+    if update:
+        if not os.path.isdir(os.path.dirname(baseline)):
+            os.makedirs(os.path.dirname(baseline))
+        with open(baseline, 'w') as f:
+            json.dump({'environment': environment(), 'results': current}, f, indent=2, sort_keys=True)
+        print('==> Baseline written to %s' % baseline)
+        return
+
+    with open(baseline) as f:
+        stored = json.load(f)
+    if stored['environment'] != environment():
+        print('WARNING: baseline was recorded on %s, this run is %s' % (
+            stored['environment'], environment()))
+
+    rows, nb_regressions = compare(stored['results'], current, tolerance_scale)
+    print(format_rows(rows))
+    if nb_regressions:
+        print('==> %d metric(s) regressed against %s' % (nb_regressions, baseline))
+        sys.exit(1)
+    print('==> No regression against %s' % baseline)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
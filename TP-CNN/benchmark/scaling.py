@@ -0,0 +1,114 @@
+# Data parallel scaling on one machine: 1..N gloo processes training the same model
+# Usage (from TP-CNN/):
+#   python -m benchmark.scaling --max_procs=4 --family=2d_pose --arch=resnet18
+#   python -m benchmark.scaling --procs='(1,2,4,8)' --output=scaling.json
+#
+# Every process keeps opt.batch_size clips per step (as the DDP trainer does),
+# so ideal scaling is N times the single process clips/s. The cores of the
+# machine are split evenly between the processes. Inputs are random tensors,
+# the input pipeline is measured separately by benchmark.loader.
+import os
+import json
+import time
+import socket
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from benchmark.model import build
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _worker(rank, world_size, port, threads, cfg, queue):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(rank)
+
+    model, make_input = build(cfg['family'], cfg['arch'], cfg['L'])
+    model = DistributedDataParallel(model)
+    inputs = make_input(cfg['batch_size'])
+    target = torch.randint(0, 15, (cfg['batch_size'],))
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), 1e-3, momentum=0.9)
+
+    def step():
+        loss = criterion(model(inputs), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(cfg['warmup']):
+        step()
+    dist.barrier()
+    start = time.time()
+    for _ in range(cfg['nb_steps']):
+        step()
+    dist.barrier()
+    elapsed = time.time() - start
+
+    if rank == 0:
+        queue.put(elapsed)
+    dist.destroy_process_group()
+
+
+def measure(world_size, cfg, threads):
+    ctx = mp.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    mp.start_processes(_worker, args=(world_size, _free_port(), threads, cfg, queue),
+                       nprocs=world_size, start_method='spawn')
+    elapsed = queue.get()
+    step_sec = elapsed / cfg['nb_steps']
+    return {
+        'procs': world_size,
+        'threads_per_proc': threads,
+        'step_ms': 1000. * step_sec,
+        'clips_per_sec': world_size * cfg['batch_size'] / step_sec
+    }
+
+
+def main(max_procs=None, procs=None, family='2d_pose', arch='resnet18', L=5,
+         batch_size=4, nb_steps=10, warmup=2, output='scaling.json'):
+    cores = os.cpu_count() or 1
+    if procs is None:
+        max_procs = max_procs or cores
+        procs = [n for n in [1, 2, 4, 8, 16, 32, 64] if n < max_procs] + [max_procs]
+    cfg = {'family': family, 'arch': arch, 'L': L, 'batch_size': batch_size,
+           'nb_steps': nb_steps, 'warmup': warmup}
+    print('==> %s %s L=%d, %d clips per process and step, %d cores' % (
+        family, arch, L, batch_size, cores))
+    if max(procs) > cores:
+        print('WARNING: more processes than cores, processes will share cores')
+
+    print('%5s %8s %10s %10s %8s %10s' % (
+        'procs', 'threads', 'step ms', 'clips/s', 'speedup', 'efficiency'))
+    results = []
+    for n in procs:
+        res = measure(n, cfg, max(1, cores // n))
+        base = results[0]['clips_per_sec'] if results else res['clips_per_sec']
+        res['speedup'] = res['clips_per_sec'] / base
+        res['efficiency'] = res['speedup'] / (n / float(procs[0]))
+        res.update(cfg)
+        results.append(res)
+        print('%5d %8d %10.1f %10.2f %7.2fx %9.0f%%' % (
+            n, res['threads_per_proc'], res['step_ms'], res['clips_per_sec'],
+            res['speedup'], 100 * res['efficiency']))
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,112 @@
+# Load generator for serve.py
+# Usage (from TP-CNN/), with a server running:
+#   python -m benchmark.serving --port=8500 --concurrency='(1,4,16)' --nb_requests=50
+#   python -m benchmark.serving --port=8500 --rate=20 --duration=30
+#
+# Closed loop (default): for every --concurrency level, that many clients
+# each send --nb_requests requests of --clips clips back to back. Open loop
+# (--rate > 0): requests arrive as a Poisson process of --rate requests/s
+# for --duration seconds, each from its own connection. Inputs are random
+# with the shapes of GET /info. The table has the client side latency and
+# throughput and, from GET /stats, the server's mean batch size, queue
+# depth and queue wait.
+import json
+import time
+import threading
+import numpy as np
+from serve import Client
+
+
+def _as_tuple(v):
+    if isinstance(v, str):
+        return tuple(s.strip() for s in v.strip('()[]').split(',') if s.strip())
+    return tuple(v) if isinstance(v, (tuple, list)) else (v,)
+
+
+def random_inputs(info, clips, rng):
+    return dict((name, rng.rand(clips, *shape).astype(np.float32))
+                for name, shape in info['shapes'].items())
+
+
+def _client(host, port, inputs, starts, latency, errors):
+    client = Client(host, port)
+    try:
+        for start in starts:
+            delay = start - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            t = time.time()
+            client.predict(**inputs)
+            latency.append(time.time() - t)
+    except Exception as e:
+        errors.append('%s: %s' % (type(e).__name__, e))
+    finally:
+        client.close()
+
+
+def run(host, port, inputs, schedules):
+    """Sends the requests of every schedule (start times) from its own client thread"""
+    latency, errors = [], []
+    threads = [threading.Thread(target=_client, args=(host, port, inputs, starts, latency, errors))
+               for starts in schedules]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latency, errors, time.time() - start
+
+
+def main(host='127.0.0.1', port=8500, concurrency=(1, 4, 16), nb_requests=20, clips=1, rate=0.,
+         duration=10., warmup=2, seed=0, output='serving.json'):
+    client = Client(host, port)
+    info = client.info()
+    rng = np.random.RandomState(seed)
+    inputs = random_inputs(info, clips, rng)
+    for _ in range(warmup):
+        client.predict(**inputs)
+    print('==> %s %s L=%d at %s:%d, batches of up to %d clips within %.1f ms, %d clips per request' % (
+        info['model'], info['input'], info['nb_per_stack'], host, port, info['max_batch'],
+        info['max_wait_ms'], clips))
+
+    if rate > 0:
+        # Poisson arrivals, one connection each
+        gaps = rng.exponential(1. / rate, int(rate * duration * 2) + 1)
+        arrivals = np.cumsum(gaps)
+        t0 = time.time() + 0.1
+        loads = [('rate %.1f/s' % rate, [[t0 + a] for a in arrivals[arrivals < duration]])]
+    else:
+        loads = [('clients %d' % int(c), [[0] * nb_requests for _ in range(int(c))])
+                 for c in _as_tuple(concurrency)]
+
+    print('%-14s %8s %9s %9s %9s %9s %10s %9s %9s' % (
+        'load', 'requests', 'p50 ms', 'p90 ms', 'p99 ms', 'req/s', 'mean batch', 'queue', 'wait ms'))
+    results = []
+    for name, schedules in loads:
+        client.reset_stats()
+        latency, errors, wall = run(host, port, inputs, schedules)
+        server = client.stats()
+        ms = 1000. * np.array(latency) if latency else np.zeros(1)
+        r = {'load': name, 'clips_per_request': clips, 'requests': len(latency), 'errors': errors,
+             'wall_sec': wall, 'requests_per_sec': len(latency) / wall,
+             'clips_per_sec': clips * len(latency) / wall,
+             'client_ms': dict(('p%d' % p, float(np.percentile(ms, p))) for p in (50, 90, 99)),
+             'server': server}
+        results.append(r)
+        print('%-14s %8d %9.1f %9.1f %9.1f %9.2f %10.2f %9.2f %9.1f' % (
+            name, len(latency), r['client_ms']['p50'], r['client_ms']['p90'], r['client_ms']['p99'],
+            r['requests_per_sec'], server['mean_batch'], server['queue_depth']['mean'],
+            server['queue_ms'].get('p50', 0.)))
+        if errors:
+            print('    %d errors, first: %s' % (len(errors), errors[0]))
+    client.close()
+
+    with open(output, 'w') as f:
+        json.dump({'info': info, 'results': results}, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,168 @@
+# Import time and memory of the data and model modules, with an import budget check
+# Usage (from TP-CNN/):
+#   python -m benchmark.startup                              # measure, exit 1 over budget
+#   python -m benchmark.startup --modules='(data.dataloader,runtime)' --repeats=5 --workers=False
+#   python -m benchmark.startup --budget_scale=2             # slower host
+#
+# Every module is imported in a fresh interpreter after `import torch`, so
+# 'import sec' is its own cost on top of torch (median of --repeats) and
+# 'new' the modules it loaded. A module fails the check when it takes more
+# than BUDGETS[module] * --budget_scale seconds or loads one of FORBIDDEN:
+# training, plotting or model zoo packages the data modules do not need,
+# and that every spawned DataLoader worker would import again.
+#
+# With --workers, a DataLoader with one worker reads a batch of a synthetic
+# Penn Action tree (pose and fusion clips, fork and spawn workers, from a
+# fresh interpreter that imported data.dataloader only), and the worker's
+# VmRSS and RssAnon (its private memory) are read from /proc.
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ('data.PennAction_dataset', 'data.Fusion_dataset', 'data.dataloader', 'model.resnet_2d',
+           'model.resnet_3d', 'runtime')
+
+# seconds on top of `import torch`, on a CPU node
+BUDGETS = {
+    'data.PennAction_dataset': 0.2,
+    'data.Fusion_dataset': 0.2,
+    'data.dataloader': 0.25,
+    'model.resnet_2d': 0.1,
+    'model.resnet_3d': 0.1,
+    'runtime': 0.1,
+}
+
+# top level packages a module must not load
+FORBIDDEN = {
+    'data.PennAction_dataset': ('tensorboardX', 'matplotlib', 'torchvision.models', 'scipy'),
+    'data.Fusion_dataset': ('tensorboardX', 'matplotlib', 'torchvision.models', 'scipy'),
+    'data.dataloader': ('tensorboardX', 'matplotlib', 'torchvision.models', 'scipy'),
+    'model.resnet_2d': ('tensorboardX', 'matplotlib', 'torchvision'),
+    'model.resnet_3d': ('tensorboardX', 'matplotlib', 'torchvision'),
+    'runtime': ('tensorboardX', 'matplotlib', 'torchvision', 'utils', 'data', 'model'),
+}
+
+_IMPORT = '''
+import sys, time, json, resource
+import torch
+before = set(sys.modules)
+start = time.time()
+__import__(%r)
+sec = time.time() - start
+print(json.dumps({'import_sec': sec, 'maxrss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+                  'new_modules': sorted(set(sys.modules) - before)}))
+'''
+
+_WORKER = '''
+import json
+from benchmark.startup import worker_memory
+print(json.dumps(worker_memory(%r, %r, %r)))
+'''
+
+
+def _as_tuple(v):
+    if isinstance(v, str):
+        return tuple(s.strip() for s in v.strip('()[]').split(',') if s.strip())
+    return tuple(v) if isinstance(v, (tuple, list)) else (v,)
+
+
+def _run(code):
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    if out.returncode:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1])
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_import(module, repeats):
+    runs = [_run(_IMPORT % module) for _ in range(repeats)]
+    loaded = runs[0]['new_modules']
+    forbidden = [m for m in FORBIDDEN.get(module, ())
+                 if any(n == m or n.startswith(m + '.') for n in loaded)]
+    return {
+        'module': module,
+        'import_sec': float(np.median([r['import_sec'] for r in runs])),
+        'maxrss_MB': float(np.median([r['maxrss_MB'] for r in runs])),
+        'nb_new_modules': len(loaded),
+        'forbidden_loaded': forbidden,
+    }
+
+
+def _proc_status(pid):
+    status = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'RssAnon'):
+                status[key] = int(value.split()[0]) / 1024.
+    return status
+
+
+def worker_memory(data_root, case, context):
+    """VmRSS / RssAnon MB of a DataLoader worker after its first batch"""
+    from torch.utils.data import DataLoader as _DataLoader
+    from data.dataloader import DataLoader as DLoader, Train_Dataset
+    from benchmark.loader import make_config
+    kind, fusion = ('rgb', True) if case == 'fusion' else (case, False)
+    cfg = make_config(data_root, os.path.join(data_root, 'train_test_split'), kind, 5, False, fusion, 1, 2)
+    data_loader = DLoader(cfg)
+    data_loader.train_video_labeling()
+    loader = _DataLoader(Train_Dataset(opt=cfg, dic_train=data_loader.dic_video_train), batch_size=2,
+                         num_workers=1, multiprocessing_context=context)
+    batches = iter(loader)
+    next(batches)
+    memory = _proc_status(batches._workers[0].pid)
+    del batches
+    return memory
+
+
+def main(modules=MODULES, repeats=3, budget_scale=1.0, workers=True, output='startup.json'):
+    print('%-26s %10s %8s %10s %8s  %s' % ('module', 'import sec', 'budget', 'maxrss MB', 'modules', 'status'))
+    results, failures = [], 0
+    for module in _as_tuple(modules):
+        r = measure_import(module, repeats)
+        budget = BUDGETS.get(module)
+        r['budget_sec'] = budget * budget_scale if budget is not None else None
+        problems = []
+        if r['budget_sec'] is not None and r['import_sec'] > r['budget_sec']:
+            problems.append('over budget')
+        if r['forbidden_loaded']:
+            problems.append('loads ' + ', '.join(r['forbidden_loaded']))
+        r['ok'] = not problems
+        failures += bool(problems)
+        results.append(r)
+        print('%-26s %10.3f %8s %10.1f %8d  %s' % (
+            module, r['import_sec'], '-' if budget is None else '%.2f' % r['budget_sec'], r['maxrss_MB'],
+            r['nb_new_modules'], '; '.join(problems) or 'ok'))
+
+    memory = []
+    if workers:
+        from data.synthetic import generate
+        data_root = os.path.join(tempfile.mkdtemp(prefix='PennAction_synth_'), '')
+        generate(data_root, nb_frames=15, seed=0)
+        print('%-26s %10s %10s' % ('worker', 'VmRSS MB', 'RssAnon MB'))
+        for case in ('pose', 'fusion'):
+            for context in ('fork', 'spawn'):
+                m = _run(_WORKER % (data_root, case, context))
+                m.update({'case': case, 'context': context})
+                memory.append(m)
+                print('%-26s %10.1f %10.1f' % ('%s %s' % (case, context), m['VmRSS'], m['RssAnon']))
+
+    with open(output, 'w') as f:
+        json.dump({'budget_scale': budget_scale, 'imports': results, 'workers': memory}, f, indent=2)
+    if failures:
+        print('==> %d module(s) over their import budget, saved to %s' % (failures, output))
+        sys.exit(1)
+    print('==> All imports within budget, saved to %s' % output)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,97 @@
+# Per-frame latency of online recognition, see model/streaming.py
+# Usage (from TP-CNN/):
+#   python -m benchmark.streaming --families='(2d_pose,3d_pose)' --arch=resnet18 --L=15 --stride=5
+#   python -m benchmark.streaming --families=2d_pose --L=15 --stride=1 --modes='(full,incremental)'
+#
+# Random weights and random 480x640 heatmaps, so no data is needed. Every
+# push is timed from the raw frame to the smoothed prediction: 'buffered'
+# pushes only resize and store the frame, 'scored' pushes also run the model
+# on the last L frames, 'frame' is all of them. 'incremental' builds the
+# stems of 2D pose and opf windows from per-frame patches (IncrementalStem), which
+# unfolds each frame once and computes a window's stem as one matrix product,
+# and runs 3D windows with TemporalReuse3D, which copies the conv1, maxpool and
+# block activations shared with the previous window ('reused' is the fraction
+# of temporal positions over all levels that are copied).
+import json
+import numpy as np
+import torch
+from benchmark.model import build
+from model.streaming import StreamRecognizer
+
+
+INPUT_TYPES = {'2d_pose': 'pose', '2d_opf': 'opf', '2d_rgb': 'rgb', '3d_pose': '3d_pose',
+               '3d_conv1_10': '3d_pose'}
+
+
+def _as_tuple(v):
+    # fire leaves lists it cannot parse, e.g. '(2d_pose,3d_pose)', as one string
+    if isinstance(v, str):
+        return tuple(s.strip() for s in v.strip('()[]').split(','))
+    return tuple(v)
+
+
+def random_frame(input_type, rng, height=480, width=640):
+    if input_type == 'opf':
+        return tuple(rng.randint(0, 256, (height, width)).astype(np.uint8) for _ in range(2))
+    if input_type == 'rgb':
+        return rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    return rng.randint(0, 256, (height, width)).astype(np.uint8)
+
+
+def run(family, arch, L, stride, nb_frames, warmup, threads=0, device='cpu', seed=0,
+        incremental=False):
+    if threads:
+        torch.set_num_threads(threads)
+    model, _ = build(family, arch, L)
+    input_type = INPUT_TYPES[family]
+    recognizer = StreamRecognizer(model.to(device), input_type, L, stride=stride, device=device,
+                                  incremental=incremental)
+    rng = np.random.RandomState(seed)
+    frames = [random_frame(input_type, rng) for _ in range(min(nb_frames, 2 * L))]
+    for i in range(warmup + recognizer.nb_per_stack):
+        recognizer.push(frames[i % len(frames)])
+    recognizer.reset()
+    for i in range(nb_frames):
+        recognizer.push(frames[i % len(frames)])
+    report = recognizer.latency_percentiles()
+    if recognizer.reuse is not None:
+        report['reused'] = float(recognizer.reuse.nb_reused) / recognizer.reuse.nb_positions
+    return report
+
+
+def main(families=('2d_pose', '3d_pose'), arch='resnet18', L=15, stride=None, nb_frames=150,
+         warmup=2, threads=0, device='cpu', modes=('full',), output='streaming.json'):
+    families, modes = _as_tuple(families), _as_tuple(modes)
+    print('==> %s L=%d stride=%s, %d frames, torch %s, %d threads' % (
+        arch, L, stride or L, nb_frames, torch.__version__, threads or torch.get_num_threads()))
+    print('%-12s %-12s %-9s %6s %9s %9s %9s %9s %9s' % (
+        'family', 'mode', 'pushes', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'mean ms'))
+
+    results = []
+    for family in families:
+        for mode in modes:
+            if mode == 'incremental' and INPUT_TYPES[family] == 'rgb':
+                continue  # single frames, nothing to share between windows
+            report = run(family, arch, L, stride, nb_frames, warmup, threads, device,
+                         incremental=mode == 'incremental')
+            for name in ('buffered', 'scored', 'frame'):
+                if name not in report:
+                    continue
+                r = report[name]
+                print('%-12s %-12s %-9s %6d %9.2f %9.2f %9.2f %9.2f %9.2f' % (
+                    family, mode, name, r['count'], r['p50'], r['p90'], r['p99'], r['max'], r['mean']))
+            if 'reused' in report:
+                print('%-12s %-12s reused %.1f%% of the temporal positions' % (
+                    family, mode, 100. * report['reused']))
+            results.append({'family': family, 'mode': mode, 'arch': arch, 'nb_per_stack': L,
+                            'stride': stride or L, 'latency_ms': report})
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,88 @@
+# Video level Prec@1 and evaluation time of a fixed clip budget per test video
+# Usage (from TP-CNN/):
+#   python -m benchmark.test_budget --checkpoint=record/pose_L15/model_best.pth.tar --budgets='(1,2,4,8,16)' \
+#       --data_root=/path/to/Penn_Action/ --dic_path=/path/to/train_test_split --device=cpu
+#
+# Budget 0 is the trainers' sampling, one clip every nb_per_stack frames, so
+# the cost grows with the video length. A budget K takes K clips per video
+# (see DataLoader.test_starts), at the centers of K equal segments
+# ('uniform') or at a seeded random frame of each ('stratified'). Every
+# budget is one full evaluation pass: reading, decoding and the forward of
+# its clips. The cheapest budget within --tolerance Prec@1 points of the
+# dense sampling is the one to pass as --test_clips to main.py, Fusion.py,
+# evaluate.py or infer.py.
+import json
+import time
+import torch
+from torch.utils.data import DataLoader as _DataLoader
+from utils.config import opt
+from evaluate import (load_checkpoint, input_key, MultiInputClips, collate, video_level_accuracy,
+                      _as_list, _to)
+
+
+def run(cfg, model, key, device):
+    dataset = MultiInputClips(cfg, [key])
+    loader = _DataLoader(dataset, batch_size=cfg.batch_size, shuffle=False,
+                         num_workers=cfg.num_workers, collate_fn=collate)
+    dic_video_level_preds = {}
+    start = time.time()
+    for videos, starts, labels, inputs in loader:
+        rows, x = inputs[key]
+        with torch.no_grad():
+            logits = model(_to(x, device)).float().cpu().numpy()
+        for j, r in enumerate(rows.tolist()):
+            if videos[r] in dic_video_level_preds:
+                dic_video_level_preds[videos[r]] += logits[j]
+            else:
+                dic_video_level_preds[videos[r]] = logits[j].copy()
+    sec = time.time() - start
+    top1, top5, loss = video_level_accuracy(dic_video_level_preds, dataset.test_video, cfg.nb_classes)
+    return {'video_prec1': top1, 'video_prec5': top5, 'video_loss': loss, 'nb_clips': len(dataset),
+            'clips_per_video': float(len(dataset)) / max(len(dic_video_level_preds), 1), 'sec': sec}
+
+
+def main(checkpoint, budgets=(1, 2, 4, 8), samplings=('uniform', 'stratified'), tolerance=0.5,
+         output='test_budget.json', **kwargs):
+    opt._parse(kwargs)
+    device = torch.device(opt.device)
+    cfg, model, meta = load_checkpoint(checkpoint)
+    model = model.to(device)
+    key = input_key(cfg)
+    print('==> %s %s L=%d%s (epoch %s)' % (cfg.model, key[0], key[1], ' Bbox' if key[2] else '',
+                                           meta.get('epoch')))
+
+    configs = [(0, 'dense')] + [(int(K), sampling) for K in _as_list(budgets)
+                                for sampling in _as_list(samplings) if int(K) > 0]
+    print('%6s %-11s %8s %8s %9s %12s %9s' % (
+        'K', 'sampling', 'Prec@1', 'Prec@5', 'loss', 'clips/video', 'sec'))
+    results = []
+    for K, sampling in configs:
+        cfg.test_clips = K
+        cfg.test_sampling = sampling if K else 'uniform'
+        r = run(cfg, model, key, device)
+        r.update({'test_clips': K, 'test_sampling': sampling})
+        results.append(r)
+        print('%6d %-11s %8.2f %8.2f %9.4f %12.2f %9.2f' % (
+            K, sampling, r['video_prec1'], r['video_prec5'], r['video_loss'], r['clips_per_video'], r['sec']))
+
+    dense = results[0]
+    within = [r for r in results[1:] if r['video_prec1'] >= dense['video_prec1'] - tolerance]
+    best = min(within, key=lambda r: (r['sec'], r['test_clips'])) if within else None
+    if best is not None:
+        print('==> cheapest within %.2f points of dense: --test_clips=%d --test_sampling=%s, '
+              'Prec@1 %.2f in %.2f sec (dense %.2f in %.2f sec)' % (
+                  tolerance, best['test_clips'], best['test_sampling'], best['video_prec1'],
+                  best['sec'], dense['video_prec1'], dense['sec']))
+    else:
+        print('==> no budget within %.2f points of dense' % tolerance)
+
+    with open(output, 'w') as f:
+        json.dump({'checkpoint': checkpoint, 'tolerance': tolerance, 'results': results,
+                   'cheapest': best}, f, indent=2)
+    print('==> Saved %d results to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -1,33 +1,29 @@
 import numpy as np
-import pickle
 from PIL import Image
 import time
-import shutil
 from random import randint
-import random
-import argparse
-import scipy.io
-
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-import torchvision.models as models
-import torch.nn as nn
+
+from torch.utils.data import Dataset
 import torch
-import torch.backends.cudnn as cudnn
-from torch.autograd import Variable
-from torch.optim.lr_scheduler import ReduceLROnPlateau
-from matplotlib import pyplot as plt
+from utils.timer import StageTimer
 
 
 class Fusiondataset(Dataset):  
-    def __init__(self, dic, use_Bbox, split, nb_per_stack=3):
+    def __init__(self, dic, use_Bbox, split, nb_per_stack=3,
+                 data_root='/home/ubuntu/data/PennAction/Penn_Action/'):
         #Generate a 16 Frame clip
         self.keys=list(dic.keys())
         self.values=list(dic.values())
         self.use_Bbox=use_Bbox
         self.split=split
         self.nb_per_stack = nb_per_stack
-
+        self.data_root = data_root
+        # clip loading timer, replaced by the trainer when opt.timing is set
+        self.timer = StageTimer()
+        # worker telemetry, a data.telemetry.LoaderTelemetry when opt.telemetry is set
+        self.telemetry = None
+        # shared decoded cache, a data.cache.DecodedCache when opt.cache_dir is set
+        self.cache = None
 
     def __len__(self):
         return len(self.keys)
@@ -38,6 +34,7 @@ class Fusiondataset(Dataset):
             clips_idx = randint(1,int(nb_clips))
         elif self.split == 'val':
             video,clips_idx = self.keys[idx].split('[@]')
+            clips_idx = int(clips_idx)
         else:
             raise ValueError('There are only train and val mode')
 
@@ -45,19 +42,24 @@ class Fusiondataset(Dataset):
         label = int(label)-1
 
         # Get the rgb and opf data for model input
-        rgb = self.read_image(video, clips_idx)
-        opf = self.stack_opf(video, clips_idx)
+        start = time.time()
+        with self.timer.stage('load_rgb'):
+            rgb = self.read_image(video, clips_idx)
+        with self.timer.stage('load_opf'):
+            opf = self.stack_opf(video, clips_idx)
+        if self.telemetry is not None:
+            self.telemetry.sample(video, clips_idx, time.time()-start)
         
         data = (rgb,opf)
         sample = (video, data, label)
         return sample
 
     def stack_opf(self, key, index):
-        data_dir = '/home/ubuntu/data/PennAction/Penn_Action/flownet2.0/dense_opf/'
+        data_dir = self.data_root + 'flownet2.0/dense_opf/'
         out=np.zeros((2*self.nb_per_stack,224,224))
         for ii in range(self.nb_per_stack):
-            flowx=Image.open(data_dir + key+'/x'+str(index+ii).zfill(6)+'.jpg')
-            flowy=Image.open(data_dir + key+'/y'+str(index+ii).zfill(6)+'.jpg')
+            flowx=self.open_image(data_dir + key+'/x'+str(index+ii).zfill(6)+'.jpg', 'opf')
+            flowy=self.open_image(data_dir + key+'/y'+str(index+ii).zfill(6)+'.jpg', 'opf')
 
             if self.use_Bbox:
                 flowx = self.crop_gt_Bbox(flowx, key, index)
@@ -69,12 +71,15 @@ class Fusiondataset(Dataset):
         return torch.from_numpy(out).float().div(255)
 
     def read_image(self, key, index):
-        data_dir = '/home/ubuntu/data/PennAction/Penn_Action/frames/'
+        data_dir = self.data_root + 'frames/'
         n = key+'/'+ str(index).zfill(6)+'.jpg'
-        img = Image.open(data_dir+n)
+        img = self.open_image(data_dir+n, 'rgb')
+        # torchvision is imported here, by the rgb clips only: it also loads
+        # its model zoo, which pose and opf workers never need
+        import torchvision.transforms as transforms
 
         Rcrop=transforms.Compose([
-                transforms.Scale(256),
+                transforms.Resize(256),
                 transforms.RandomCrop(224),
                 ])
 
@@ -92,10 +97,40 @@ class Fusiondataset(Dataset):
         return transform(img)
 
     def crop_gt_Bbox(self, img, key, index):
-        anno_path = '/home/ubuntu/data/PennAction/Penn_Action/labels/'
-        annotation = scipy.io.loadmat(anno_path+key+'.mat')
-        x0,y0,x1,y1 = annotation['bbox'][index-1]
+        anno_path = self.data_root + 'labels/'
+        x0,y0,x1,y1 = self.load_bbox(anno_path+key+'.mat')[index-1]
         crop_img = img.crop([x0,y0,x1,y1])
 
         return crop_img
-    
\ No newline at end of file
+    
+
+    def load_mat(self, path, modality):
+        import scipy.io
+        if self.telemetry is None:
+            return scipy.io.loadmat(path)
+        start = time.time()
+        mat = scipy.io.loadmat(path)
+        self.telemetry.file(path, modality, time.time()-start)
+        return mat
+
+    def load_bbox(self, path):
+        decode = lambda: self.load_mat(path, 'label')['bbox']
+        if self.cache is None:
+            return decode()
+        return self.cache.get(path, decode)
+
+    def open_image(self, path, modality):
+        if self.cache is None:
+            return self.decode_image(path, modality)
+        arr = self.cache.get(path, lambda: np.asarray(self.decode_image(path, modality)))
+        return Image.fromarray(arr)
+
+    def decode_image(self, path, modality):
+        if self.telemetry is None:
+            return Image.open(path)
+        # decode now instead of lazily in resize(), so it is billed to this file
+        start = time.time()
+        img = Image.open(path)
+        img.load()
+        self.telemetry.file(path, modality, time.time()-start)
+        return img
@@ -1,21 +1,27 @@
-from utils.config import opt
+from utils.timer import StageTimer
 from random import randint
+import time
 from PIL import Image
 import torch
-import scipy.io
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 import numpy as np
-import torchvision.transforms as transforms
-from tensorboardX import SummaryWriter
 
 class PennActionDataset(Dataset):
-    def __init__(self, dic, use_Bbox, split, input_type, nb_per_stack=3):
+    def __init__(self, dic, use_Bbox, split, input_type, nb_per_stack=3,
+                 data_root='/home/ubuntu/data/PennAction/Penn_Action/'):
         self.keys = list(dic.keys())
         self.values = list(dic.values())
         self.use_Bbox = use_Bbox
         self.split = split
         self.nb_per_stack = nb_per_stack
         self.input_type = input_type
+        self.data_root = data_root
+        # clip loading timer, replaced by the trainer when opt.timing is set
+        self.timer = StageTimer()
+        # worker telemetry, a data.telemetry.LoaderTelemetry when opt.telemetry is set
+        self.telemetry = None
+        # shared decoded cache, a data.cache.DecodedCache when opt.cache_dir is set
+        self.cache = None
 
         self.input_type_zoo = {
             'pose': 'stack_joint_position',
@@ -35,12 +41,20 @@ class PennActionDataset(Dataset):
         if self.split == 'train':
             videoname, nb_clips = self.keys[i].split('[@]')
             clip_idx = randint(1, int(nb_clips))            
-            item = get_fn(videoname, int(clip_idx))
+            start = time.time()
+            with self.timer.stage('load_'+self.input_type):
+                item = get_fn(videoname, int(clip_idx))
+            if self.telemetry is not None:
+                self.telemetry.sample(videoname, clip_idx, time.time()-start)
             return (item,label)
 
         elif self.split == 'test':
             videoname, clip_idx = self.keys[i].split('[@]')
-            item = get_fn(videoname, int(clip_idx))
+            start = time.time()
+            with self.timer.stage('load_'+self.input_type):
+                item = get_fn(videoname, int(clip_idx))
+            if self.telemetry is not None:
+                self.telemetry.sample(videoname, clip_idx, time.time()-start)
             return (videoname, item, label)
 
         else:
@@ -48,12 +62,11 @@ class PennActionDataset(Dataset):
         
     
     def stack_joint_position(self, key, index):
-        data_dir = '/home/ubuntu/data/PennAction/Penn_Action/heatmap/'
+        data_dir = self.data_root + 'heatmap/'
         out=np.zeros((self.nb_per_stack,224,224))
         for ii in range(self.nb_per_stack):
             n = key+'/'+ str(index+ii).zfill(6)+'.mat'
-            mat = scipy.io.loadmat(data_dir + n)['final_score']
-            joint_postion = Image.fromarray(mat.sum(axis=2,dtype='uint8'))
+            joint_postion = Image.fromarray(self.load_heatmap(data_dir + n))
             if self.use_Bbox:
                 data = self.crop_gt_Bbox(joint_postion,key,index+ii)
             else:
@@ -64,12 +77,11 @@ class PennActionDataset(Dataset):
         return torch.from_numpy(out).float().div(255)
 
     def stack_joint_position_3d(self, key, index):
-        data_dir = '/home/ubuntu/data/PennAction/Penn_Action/heatmap/'
+        data_dir = self.data_root + 'heatmap/'
         out=np.zeros((1,self.nb_per_stack,112,112))
         for ii in range(self.nb_per_stack):
             n = key+'/'+ str(index+ii).zfill(6)+'.mat'
-            mat = scipy.io.loadmat(data_dir + n)['final_score']
-            joint_postion = Image.fromarray(mat.sum(axis=2,dtype='uint8'))
+            joint_postion = Image.fromarray(self.load_heatmap(data_dir + n))
             if self.use_Bbox:
                 data = self.crop_gt_Bbox(joint_postion,key,index+ii)
             else:
@@ -80,11 +92,11 @@ class PennActionDataset(Dataset):
         return torch.from_numpy(out).float().div(255)
     
     def stack_opf(self, key, index):
-        data_dir = '/home/ubuntu/data/PennAction/Penn_Action/flownet2.0/dense_opf/'
+        data_dir = self.data_root + 'flownet2.0/dense_opf/'
         out=np.zeros((2*self.nb_per_stack,224,224))
         for ii in range(self.nb_per_stack):
-            flowx=Image.open(data_dir + key+'/x'+str(index+ii).zfill(6)+'.jpg')
-            flowy=Image.open(data_dir + key+'/y'+str(index+ii).zfill(6)+'.jpg')
+            flowx=self.open_image(data_dir + key+'/x'+str(index+ii).zfill(6)+'.jpg', 'opf')
+            flowy=self.open_image(data_dir + key+'/y'+str(index+ii).zfill(6)+'.jpg', 'opf')
 
             if self.use_Bbox:
                 flowx = self.crop_gt_Bbox(flowx, key, index)
@@ -96,9 +108,12 @@ class PennActionDataset(Dataset):
         return torch.from_numpy(out).float().div(255)
 
     def read_image(self, key, index):
-        data_dir = '/home/ubuntu/data/PennAction/Penn_Action/frames/'
+        data_dir = self.data_root + 'frames/'
         n = key+'/'+ str(index).zfill(6)+'.jpg'
-        img = Image.open(data_dir+n)
+        img = self.open_image(data_dir+n, 'rgb')
+        # torchvision is imported here, by the rgb clips only: it also loads
+        # its model zoo, which pose and opf workers never need
+        import torchvision.transforms as transforms
 
         Rcrop=transforms.Compose([
                 transforms.Resize(256),
@@ -119,13 +134,50 @@ class PennActionDataset(Dataset):
         return transform(img)
 
     def crop_gt_Bbox(self, img, key, index):
-        anno_path = '/home/ubuntu/data/PennAction/Penn_Action/labels/'
-        annotation = scipy.io.loadmat(anno_path+key+'.mat')
-        x0,y0,x1,y1 = annotation['bbox'][index-1]
+        anno_path = self.data_root + 'labels/'
+        x0,y0,x1,y1 = self.load_bbox(anno_path+key+'.mat')[index-1]
         crop_img = img.crop([x0,y0,x1,y1])
 
         return crop_img
             
+    def load_mat(self, path, modality):
+        import scipy.io
+        if self.telemetry is None:
+            return scipy.io.loadmat(path)
+        start = time.time()
+        mat = scipy.io.loadmat(path)
+        self.telemetry.file(path, modality, time.time()-start)
+        return mat
+
+    def load_heatmap(self, path):
+        # the joints summed into one uint8 map, the only part of the .mat in use
+        decode = lambda: self.load_mat(path, 'heatmap')['final_score'].sum(axis=2,dtype='uint8')
+        if self.cache is None:
+            return decode()
+        return self.cache.get(path, decode)
+
+    def load_bbox(self, path):
+        decode = lambda: self.load_mat(path, 'label')['bbox']
+        if self.cache is None:
+            return decode()
+        return self.cache.get(path, decode)
+
+    def open_image(self, path, modality):
+        if self.cache is None:
+            return self.decode_image(path, modality)
+        arr = self.cache.get(path, lambda: np.asarray(self.decode_image(path, modality)))
+        return Image.fromarray(arr)
+
+    def decode_image(self, path, modality):
+        if self.telemetry is None:
+            return Image.open(path)
+        # decode now instead of lazily in resize(), so it is billed to this file
+        start = time.time()
+        img = Image.open(path)
+        img.load()
+        self.telemetry.file(path, modality, time.time()-start)
+        return img
+
     def __len__(self):
         return len(self.keys)
 
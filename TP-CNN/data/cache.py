@@ -0,0 +1,82 @@
+import os
+import collections
+import time
+import numpy as np
+
+
+class DecodedCache(object):
+    """On-disk cache of decoded frames, flow images, summed heatmaps and boxes.
+
+    Every entry is one .npy file under `root`, at the path of its source
+    relative to `data_root`. Entries are written once (to a temporary name,
+    then renamed) and read back memory mapped, so any number of training
+    processes - DataLoader workers or concurrent sweep runs - share one copy
+    through the page cache and decode every source file at most once.
+
+    Delete `root` when the source data changes, entries are not revalidated.
+    """
+    def __init__(self, root, data_root):
+        self.root = root
+        self.data_root = data_root
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, source, suffix=''):
+        if source.startswith(self.data_root):
+            source = source[len(self.data_root):]
+        return os.path.join(self.root, source.lstrip('/') + suffix + '.npy')
+
+    def get(self, source, decode, suffix=''):
+        """Returns the cached array of `source`, calling decode() to build it on a miss"""
+        path = self.path(source, suffix)
+        try:
+            arr = np.load(path, mmap_mode='r')
+            self.hits += 1
+            return arr
+        except (IOError, OSError, ValueError):
+            pass
+
+        arr = np.ascontiguousarray(decode())
+        self.misses += 1
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # created by a concurrent process
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), int(time.time() * 1e6))
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, path)
+        return arr
+
+
+class FrameMemo(object):
+    """Bounded in-process memo with the DecodedCache interface.
+
+    Used when several clip readers in one process want the same frames,
+    e.g. models with different stack lengths evaluated in one pass. Misses
+    go to `backing` (a DecodedCache) when one is given.
+    """
+    def __init__(self, capacity=512, backing=None):
+        self.capacity = capacity
+        self.backing = backing
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source, decode, suffix=''):
+        key = source + suffix
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        if self.backing is not None:
+            arr = self.backing.get(source, decode, suffix)
+        else:
+            arr = decode()
+        self.entries[key] = arr
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return arr
@@ -1,8 +1,14 @@
 from .PennAction_dataset import PennActionDataset
 from .Fusion_dataset import Fusiondataset
+from .cache import DecodedCache
 from utils.config import opt
-from torch.utils.data import  DataLoader as _DataLoader
+from utils.distributed import get_rank, get_world_size, shared_seed
+from torch.utils.data import  DataLoader as _DataLoader, Sampler
+import zlib
+import warnings
+import torch
 import pickle
+import numpy as np
 
 class DataLoader():
     def __init__(self, opt):
@@ -28,15 +34,33 @@ class DataLoader():
         test_loader = self.val()
         return train_loader, test_loader, self.test_video
     
-    def test_frame_sampling(self):  # uniformly sample 18 frames and  make a video level consenus
+    def test_frame_sampling(self):  # clips of every test video for a video level consenus
         self.dic_test_idx = {}
         for video in self.test_video: # dic[video] = label
-            nb_frame = int(self.frame_count[video])-self.nb_per_stack-1 # -1 for opf stream
-            for i in range(nb_frame):
-                if i % self.nb_per_stack ==0:
-                    key = video + '[@]' + str(i+1)
-                    #print key
-                    self.dic_test_idx[key] = self.test_video[video]
+            for i in self.test_starts(video):
+                key = video + '[@]' + str(i+1)
+                #print key
+                self.dic_test_idx[key] = self.test_video[video]
+
+    def test_starts(self, video):
+        # 0 based start frames of the test clips of a video: one every
+        # nb_per_stack frames, or a budget of opt.test_clips clips, at the
+        # centers ('uniform') or a random frame ('stratified') of as many
+        # equal segments. The random frames are seeded by the video name, so
+        # every epoch and every rank scores the same clips.
+        nb_frame = int(self.frame_count[video])-self.nb_per_stack-1 # -1 for opf stream
+        K = self.opt.test_clips
+        if not K:
+            return list(range(0, nb_frame, self.nb_per_stack))
+        if self.opt.test_sampling == 'uniform':
+            starts = [int((k + 0.5) * nb_frame / K) for k in range(K)]
+        elif self.opt.test_sampling == 'stratified':
+            rng = np.random.RandomState(zlib.crc32(video.encode()))
+            starts = [int((k + rng.uniform()) * nb_frame / K) for k in range(K)]
+        else:
+            raise ValueError('Unknown test_sampling "%s", expected uniform or stratified' % self.opt.test_sampling)
+        # videos shorter than the budget give fewer clips
+        return sorted(set(min(i, nb_frame - 1) for i in starts if nb_frame > 0))
 
     def train_video_labeling(self):
         self.dic_video_train={}
@@ -52,12 +76,14 @@ class DataLoader():
         if self.opt.Fusion:
             print ('==> Training data : %d videos,'%len(training_set), training_set[1][1][0].size(), training_set[1][1][1].size())
         else:
-            print ('==> Training data : %d videos,'%len(training_set), training_set[1][1].size())
+            print ('==> Training data : %d videos,'%len(training_set), training_set[1][0].size())
 
         train_loader = _DataLoader(
             dataset=training_set,
             batch_size=self.BATCH_SIZE,
-            shuffle=True,
+            sampler=ResumableRandomSampler(
+                training_set, seed=shared_seed(),
+                num_replicas=get_world_size(), rank=get_rank()),
             num_workers=self.num_workers
             )
         return train_loader
@@ -71,11 +97,84 @@ class DataLoader():
         test_loader = _DataLoader(
             dataset=testing_set, 
             batch_size=self.BATCH_SIZE, 
-            shuffle=False,
+            sampler=ShardSampler(testing_set, get_world_size(), get_rank()),
             num_workers=self.num_workers
             )
         return test_loader
 
+class ResumableRandomSampler(Sampler):
+    """Shuffles like RandomSampler, but from a per-epoch seed and an optional start offset.
+
+    The permutation of epoch e only depends on (seed, e), so a run
+    resumed mid-epoch can skip the `start` samples it already trained on.
+    `start` only applies to the next iteration.
+
+    With num_replicas > 1 every rank draws the same permutation (the seed
+    must be shared) and takes every num_replicas-th index from `rank`, the
+    permutation is padded so all ranks run the same number of steps.
+
+    The trainers call set_epoch before every epoch; a second full pass over
+    the same epoch warns, since every epoch (and, distributed, every rank's
+    shard) would then replay the same order.
+    """
+    def __init__(self, data_source, seed=None, num_replicas=1, rank=0):
+        self.data_source = data_source
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = -(-len(data_source) // num_replicas)
+        self.epoch = 0
+        self.start = 0
+        self._drawn_epoch = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        self.start = start
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': self.start}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start = state['start']
+
+    def __iter__(self):
+        if self.start == 0 and self._drawn_epoch == self.epoch:
+            warnings.warn('ResumableRandomSampler: epoch %d drawn again, call set_epoch before every '
+                          'epoch to reshuffle' % self.epoch)
+        self._drawn_epoch = self.epoch
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=g).tolist()
+        total = self.num_samples * self.num_replicas
+        order = (order * (-(-total // len(order))))[:total]
+        order = order[self.rank::self.num_replicas]
+        start, self.start = self.start, 0
+        return iter(order[start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+class ShardSampler(Sampler):
+    """In-order, unpadded 1/num_replicas share of a test set.
+
+    Every clip is seen exactly once over all ranks, so video level scores
+    summed across ranks equal the single process ones.
+    """
+    def __init__(self, data_source, num_replicas=1, rank=0):
+        self.indices = list(range(rank, len(data_source), num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
 class Train_Dataset:
     def __init__(self, opt, dic_train):
         self.opt = opt
@@ -85,7 +184,8 @@ class Train_Dataset:
                 dic=dic_train,
                 use_Bbox=opt.use_Bbox,
                 split='train',
-                nb_per_stack=opt.nb_per_stack
+                nb_per_stack=opt.nb_per_stack,
+                data_root=opt.data_root
             )
         else:
             self.db = PennActionDataset(
@@ -93,8 +193,11 @@ class Train_Dataset:
                 use_Bbox = opt.use_Bbox,
                 split='train',
                 input_type = opt.input_type,
-                nb_per_stack = opt.nb_per_stack
+                nb_per_stack = opt.nb_per_stack,
+                data_root = opt.data_root
                     )
+        if opt.cache_dir:
+            self.db.cache = DecodedCache(opt.cache_dir, opt.data_root)
 
     def __getitem__(self, idx):
         return self.db.get_example(idx)
@@ -110,8 +213,9 @@ class Test_Dataset:
             self.db = Fusiondataset(
                 dic=dic_test,
                 use_Bbox=opt.use_Bbox,
-                split='train',
-                nb_per_stack=opt.nb_per_stack
+                split='val',
+                nb_per_stack=opt.nb_per_stack,
+                data_root=opt.data_root
             )
         else:
             self.db = PennActionDataset(
@@ -119,8 +223,11 @@ class Test_Dataset:
                 use_Bbox = opt.use_Bbox,
                 split='test',
                 input_type = opt.input_type,
-                nb_per_stack = opt.nb_per_stack
+                nb_per_stack = opt.nb_per_stack,
+                data_root = opt.data_root
                     )
+        if opt.cache_dir:
+            self.db.cache = DecodedCache(opt.cache_dir, opt.data_root)
 
     def __getitem__(self, idx):
         return self.db.get_example(idx)
@@ -0,0 +1,99 @@
+# Write a synthetic Penn Action tree with the same on-disk layout as the real one
+# Usage (from TP-CNN/): python -m data.synthetic --root=/tmp/PennAction_synth/
+#
+# root/
+#   heatmap/<video>/000001.mat              final_score: H x W x nb_joints
+#   flownet2.0/dense_opf/<video>/x000001.jpg, y000001.jpg
+#   frames/<video>/000001.jpg
+#   labels/<video>.mat                      bbox: nb_frames x 4 (x0, y0, x1, y1)
+#   train_test_split/train_video.pickle     dic[video] = label (1 based)
+#   train_test_split/test_video.pickle
+#   train_test_split/frame_count.pickle     dic[video] = nb_frames
+import os
+import pickle
+import numpy as np
+import scipy.io
+from PIL import Image
+
+
+def _mkdir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def write_video(root, video, nb_frames, height, width, nb_joints, rng):
+    heatmap_dir = os.path.join(root, 'heatmap', video)
+    opf_dir = os.path.join(root, 'flownet2.0', 'dense_opf', video)
+    frame_dir = os.path.join(root, 'frames', video)
+    for d in [heatmap_dir, opf_dir, frame_dir]:
+        _mkdir(d)
+
+    # one person walking across the frame, used for joints and bbox
+    cx = np.linspace(width * 0.3, width * 0.7, nb_frames)
+    cy = np.full(nb_frames, height * 0.5)
+    box_w, box_h = width * 0.3, height * 0.6
+    bbox = np.stack([cx - box_w / 2, cy - box_h / 2,
+                     cx + box_w / 2, cy + box_h / 2], axis=1).round()
+    scipy.io.savemat(os.path.join(root, 'labels', video + '.mat'),
+                     {'bbox': bbox, 'nframes': nb_frames})
+
+    yy, xx = np.mgrid[0:height, 0:width]
+    for t in range(nb_frames):
+        name = str(t + 1).zfill(6)
+
+        # gaussian blob per joint, summed later in uint8 by the dataset
+        score = np.zeros((height, width, nb_joints), dtype=np.float32)
+        for j in range(nb_joints):
+            jx = cx[t] + rng.uniform(-box_w / 2, box_w / 2)
+            jy = cy[t] + rng.uniform(-box_h / 2, box_h / 2)
+            score[:, :, j] = np.exp(-((xx - jx)**2 + (yy - jy)**2) / 50.) * (255. / nb_joints)
+        scipy.io.savemat(os.path.join(heatmap_dir, name + '.mat'), {'final_score': score})
+
+        # flow is centred on 128, with noise so the jpegs do not compress to nothing
+        for axis in ['x', 'y']:
+            flow = 128 + rng.normal(0, 20, (height, width))
+            flow = np.clip(flow, 0, 255).astype(np.uint8)
+            Image.fromarray(flow).save(os.path.join(opf_dir, axis + name + '.jpg'))
+
+        frame = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        Image.fromarray(frame).save(os.path.join(frame_dir, name + '.jpg'))
+
+
+def generate(root, nb_train=6, nb_test=2, nb_frames=40, height=120, width=160,
+             nb_joints=13, nb_classes=15, seed=0):
+    """Writes nb_train + nb_test videos of nb_frames frames under root."""
+    rng = np.random.RandomState(seed)
+    split_dir = os.path.join(root, 'train_test_split')
+    _mkdir(split_dir)
+    _mkdir(os.path.join(root, 'labels'))
+
+    train_video, test_video, frame_count = {}, {}, {}
+    for i in range(nb_train + nb_test):
+        video = str(i + 1).zfill(4)
+        write_video(root, video, nb_frames, height, width, nb_joints, rng)
+        label = str(i % nb_classes + 1)
+        if i < nb_train:
+            train_video[video] = label
+        else:
+            test_video[video] = label
+        frame_count[video] = nb_frames
+
+    for name, dic in [('train_video', train_video), ('test_video', test_video),
+                      ('frame_count', frame_count)]:
+        with open(os.path.join(split_dir, name + '.pickle'), 'wb') as f:
+            pickle.dump(dic, f)
+
+    return split_dir
+
+
+def main(root='/tmp/PennAction_synth/', **kwargs):
+    root = os.path.join(root, '')
+    split_dir = generate(root, **kwargs)
+    print('==> Synthetic Penn Action written to %s' % root)
+    print('    use --data_root=%s --dic_path=%s' % (root, split_dir))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,196 @@
+import os
+import time
+import heapq
+import queue
+import resource
+import multiprocessing
+from multiprocessing.util import Finalize
+from torch.utils.data import get_worker_info
+
+
+def current_rss():
+    # resident set size in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoaderTelemetry(object):
+    """Per-worker DataLoader telemetry, aggregated in the main process.
+
+    The dataset calls `sample` once per item and `file` once per file it
+    decodes. Each worker buffers its records locally and ships a summary
+    through a multiprocessing queue every `flush_every` samples and when
+    the worker exits, so the cost per file is one `time.time()` pair, one
+    `stat` and a list append.
+
+    In the main process, `collect` drains the queue after the epoch, and
+    `report` ranks workers, the slowest samples and the slowest files.
+    """
+    modalities = ['heatmap', 'opf', 'rgb', 'label']
+
+    def __init__(self, flush_every=32, topk=20):
+        self.queue = multiprocessing.Queue()
+        self.flush_every = flush_every
+        self.topk = topk
+        self._pid = None
+        self.reset()
+
+    # ---- worker side ----
+    def _local(self):
+        # lazily set up the buffers in every (forked or spawned) process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            info = get_worker_info()
+            self._worker = 'main' if info is None else 'worker%d' % info.id
+            self._clear_buffer()
+            # must run before the queue's own close finalizer (priority 10)
+            Finalize(self, self.flush, exitpriority=100)
+
+    def _clear_buffer(self):
+        self._buffer = {
+            'samples': 0,
+            'busy': 0.,
+            'bytes': 0,
+            'first': None,
+            'last': None,
+            'decode': {},
+            'files': [],
+            'clips': []
+        }
+
+    def sample(self, video, clip_idx, seconds):
+        self._local()
+        now = time.time()
+        buf = self._buffer
+        if buf['first'] is None:
+            buf['first'] = now - seconds
+        buf['last'] = now
+        buf['samples'] += 1
+        buf['busy'] += seconds
+        buf['clips'].append((seconds, video, int(clip_idx)))
+        if buf['samples'] >= self.flush_every:
+            self.flush()
+
+    def file(self, path, modality, seconds):
+        self._local()
+        try:
+            nbytes = os.path.getsize(path)
+        except OSError:
+            nbytes = 0
+        buf = self._buffer
+        buf['bytes'] += nbytes
+        total, count = buf['decode'].get(modality, (0., 0))
+        buf['decode'][modality] = (total + seconds, count + 1)
+        buf['files'].append((seconds, path, nbytes))
+
+    def flush(self):
+        if self._pid != os.getpid() or self._buffer['samples'] == 0:
+            return
+        buf = self._buffer
+        record = {
+            'worker': self._worker,
+            'pid': self._pid,
+            'samples': buf['samples'],
+            'busy': buf['busy'],
+            'bytes': buf['bytes'],
+            'first': buf['first'],
+            'last': buf['last'],
+            'decode': buf['decode'],
+            'rss': current_rss(),
+            'slow_files': heapq.nlargest(self.topk, buf['files']),
+            'slow_clips': heapq.nlargest(self.topk, buf['clips'])
+        }
+        self._clear_buffer()
+        self.queue.put(record)
+
+    # ---- main process side ----
+    def reset(self):
+        self.workers = {}
+        self.slow_files = []
+        self.slow_clips = []
+
+    def collect(self):
+        # flush what the main process itself recorded (num_workers=0)
+        self.flush()
+        while True:
+            try:
+                record = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            w = self.workers.setdefault(record['worker'], {
+                'pid': record['pid'],
+                'samples': 0,
+                'busy': 0.,
+                'bytes': 0,
+                'first': record['first'],
+                'last': record['last'],
+                'decode': {},
+                'rss': 0,
+                'max_rss': 0
+            })
+            w['pid'] = record['pid']
+            w['samples'] += record['samples']
+            w['busy'] += record['busy']
+            w['bytes'] += record['bytes']
+            w['first'] = min(w['first'], record['first'])
+            w['last'] = max(w['last'], record['last'])
+            w['rss'] = record['rss']
+            w['max_rss'] = max(w['max_rss'], record['rss'])
+            for modality, (total, count) in record['decode'].items():
+                t, c = w['decode'].get(modality, (0., 0))
+                w['decode'][modality] = (t + total, c + count)
+            self.slow_files = heapq.nlargest(
+                self.topk, self.slow_files + record['slow_files'])
+            self.slow_clips = heapq.nlargest(
+                self.topk, self.slow_clips + record['slow_clips'])
+
+    def worker_stats(self):
+        stats = {}
+        for name, w in self.workers.items():
+            wall = max(w['last'] - w['first'], 1e-6)
+            info = {
+                'samples': w['samples'],
+                'samples_per_sec': w['samples'] / wall,
+                'MB_read': w['bytes'] / 2.**20,
+                'MB_per_sec': w['bytes'] / 2.**20 / wall,
+                'busy_ratio': w['busy'] / wall,
+                'rss_MB': w['rss'] / 2.**20,
+                'max_rss_MB': w['max_rss'] / 2.**20
+            }
+            for modality, (total, count) in w['decode'].items():
+                info['decode_ms_'+modality] = 1000. * total / count
+            stats[name] = info
+        return stats
+
+    def report(self):
+        lines = ['==> DataLoader telemetry']
+        header = '%-9s %8s %10s %9s %8s %7s %8s  %s' % (
+            'worker', 'samples', 'samples/s', 'MB read', 'MB/s', 'busy', 'RSS MB',
+            'decode ms/file (' + '/'.join(self.modalities) + ')')
+        lines.append(header)
+        stats = self.worker_stats()
+        for name in sorted(stats, key=lambda k: stats[k]['samples_per_sec']):
+            s = stats[name]
+            decode = '/'.join(
+                '%.2f' % s['decode_ms_'+m] if 'decode_ms_'+m in s else '-'
+                for m in self.modalities)
+            lines.append('%-9s %8d %10.2f %9.1f %8.2f %6.0f%% %8.1f  %s' % (
+                name, s['samples'], s['samples_per_sec'], s['MB_read'],
+                s['MB_per_sec'], 100 * s['busy_ratio'], s['max_rss_MB'], decode))
+
+        lines.append('==> Slowest samples')
+        for seconds, video, clip_idx in self.slow_clips:
+            lines.append('%9.3fs  %s[@]%d' % (seconds, video, clip_idx))
+
+        lines.append('==> Slowest files')
+        for seconds, path, nbytes in self.slow_files:
+            lines.append('%9.3fs %9.1fKB  %s' % (seconds, nbytes / 1024., path))
+        return '\n'.join(lines)
+
+    def write_tensorboard(self, writer, prefix, step):
+        for name, info in self.worker_stats().items():
+            for k, v in info.items():
+                writer.add_scalar(prefix+name+'/'+k, v, step)
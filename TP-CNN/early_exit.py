@@ -0,0 +1,169 @@
+# Video level evaluation that stops reading clips once a video is confident
+# Usage (from TP-CNN/):
+#   python early_exit.py --checkpoint=record/pose_L15/model_best.pth.tar --thresholds='(0.2,0.5,0.8)' \
+#       --data_root=/path/to/Penn_Action/ --dic_path=/path/to/train_test_split --output=early_exit.json
+#
+# The test clips of a video (one every nb_per_stack frames, as in the
+# trainers' validation) are taken coarse to fine: level 0 is the middle
+# clip, every next level the middles of the gaps left, so each level halves
+# the spacing. After a level the video stops if the margin between the two
+# largest softmax probabilities of its mean clip logits reaches the
+# threshold (and at least --min_levels levels were taken), the prediction
+# is the sum of the logits read so far.
+#
+# One full pass scores every clip. Since a video always stops at the end of
+# a level of this fixed order, the Prec@1 and clips per video of every
+# threshold follow exactly from it: that is the tradeoff curve. With --run
+# set to a threshold, a second pass really stops reading and scoring, and
+# its wall time is compared to the full pass.
+#
+# Both passes must give a clip the same logits. The rgb readers crop and
+# flip at random, so every rgb (and fusion) clip is read under a torch seed
+# of its video and start frame: the same augmentation in every pass.
+import json
+import time
+import zlib
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+from utils.config import opt
+from evaluate import load_checkpoint, input_key, MultiInputClips, _as_list, _to
+
+
+def coarse_to_fine(nb_clips):
+    """Clip indices in levels, each level the middles of the gaps of the previous ones"""
+    levels, gaps = [], [(0, nb_clips)]
+    while gaps:
+        level, next_gaps = [], []
+        for a, b in gaps:
+            mid = (a + b) // 2
+            level.append(mid)
+            next_gaps.extend(g for g in ((a, mid), (mid + 1, b)) if g[0] < g[1])
+        levels.append(sorted(level))
+        gaps = next_gaps
+    return levels
+
+
+def margin(summed, nb_clips):
+    """Top-1 minus top-2 probability of the mean clip logits"""
+    probs = F.softmax(summed / nb_clips, 0)
+    top = probs.topk(min(2, probs.numel()))[0]
+    return float(top[0] - top[1]) if top.numel() > 1 else 1.
+
+
+def exit_level(level_logits, threshold, min_levels):
+    """Number of levels a video takes, and the logits summed over them.
+
+    level_logits may be a generator, levels after the exit are not scored.
+    """
+    summed, nb_clips = 0, 0
+    for i, logits in enumerate(level_logits):
+        summed = summed + logits.sum(0)
+        nb_clips += logits.size(0)
+        if i + 1 >= min_levels and margin(summed, nb_clips) >= threshold:
+            break
+    return i + 1, summed, nb_clips
+
+
+def video_clips(dataset):
+    """{video: clip rows of the dataset in coarse to fine levels}"""
+    rows = {}
+    for i, ((video, start), _) in enumerate(dataset.clips):
+        rows.setdefault(video, []).append(i)
+    return dict((video, [[r[j] for j in level] for level in coarse_to_fine(len(r))])
+                for video, r in rows.items())
+
+
+def read_clip(dataset, key, row):
+    """The input of one clip, rgb crops and flips seeded by the clip"""
+    if key[0] not in ('rgb', 'fusion'):
+        return dataset[row][3][key]
+    (video, start), _ = dataset.clips[row]
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(zlib.crc32(('%s[@]%d' % (video, start)).encode()))
+        return dataset[row][3][key]
+
+
+def score_level(model, dataset, key, rows, device):
+    x = default_collate([read_clip(dataset, key, r) for r in rows])
+    with torch.no_grad():
+        return model(_to(x, device)).float().cpu()
+
+
+def tradeoff(levels, labels, thresholds, min_levels):
+    """Prec@1, mean clips per video and clip fraction of every threshold"""
+    total = sum(sum(l.size(0) for l in ls) for ls in levels.values())
+    curve = []
+    for threshold in thresholds:
+        correct, clips = 0, 0
+        for video, level_logits in levels.items():
+            _, summed, nb_clips = exit_level(level_logits, threshold, min_levels)
+            correct += int(summed.argmax()) == labels[video]
+            clips += nb_clips
+        curve.append({'threshold': threshold, 'prec1': 100. * correct / len(levels),
+                      'clips_per_video': float(clips) / len(levels),
+                      'clip_fraction': float(clips) / max(total, 1)})
+    return curve
+
+
+def main(checkpoint, thresholds=(0.1, 0.2, 0.3, 0.5, 0.7, 0.9), min_levels=1, run=None,
+         output='early_exit.json', **kwargs):
+    opt._parse(kwargs)
+    device = torch.device(opt.device)
+    cfg, model, meta = load_checkpoint(checkpoint)
+    model = model.to(device)
+    key = input_key(cfg)
+    thresholds = [float(t) for t in _as_list(thresholds)]
+    dataset = MultiInputClips(cfg, [key])
+    order = video_clips(dataset)
+    labels = dict((v, int(l) - 1) for v, l in dataset.test_video.items())
+    print('==> %s %s L=%d, %d test videos, %d clips' % (
+        cfg.model, key[0], key[1], len(order), len(dataset)))
+
+    # the full pass, level by level so every clip's logits are kept in exit order
+    start = time.time()
+    levels = {}
+    for video in sorted(order):
+        levels[video] = [score_level(model, dataset, key, rows, device) for rows in order[video]]
+    full_sec = time.time() - start
+    full = tradeoff(levels, labels, [float('inf')], min_levels)[0]
+    del full['threshold']
+    print('==> all clips: Prec@1 %.2f, %.2f clips per video, %.1f sec' % (
+        full['prec1'], full['clips_per_video'], full_sec))
+
+    curve = tradeoff(levels, labels, thresholds, min_levels)
+    print('%10s %8s %14s %10s' % ('threshold', 'Prec@1', 'clips/video', 'compute'))
+    for r in curve:
+        print('%10.2f %8.2f %14.2f %9.1f%%' % (
+            r['threshold'], r['prec1'], r['clips_per_video'], 100. * r['clip_fraction']))
+
+    result = {'checkpoint': checkpoint, 'input': '%s_L%d%s' % (key[0], key[1], '_Bbox' if key[2] else ''),
+              'min_levels': min_levels, 'nb_videos': len(order), 'full': dict(full, sec=full_sec),
+              'curve': curve}
+
+    if run is not None:
+        # really stop reading and scoring, one level at a time
+        start = time.time()
+        correct, clips = 0, 0
+        for video in sorted(order):
+            scored = (score_level(model, dataset, key, rows, device) for rows in order[video])
+            _, summed, nb_clips = exit_level(scored, float(run), min_levels)
+            correct += int(summed.argmax()) == labels[video]
+            clips += nb_clips
+        sec = time.time() - start
+        result['run'] = {'threshold': float(run), 'prec1': 100. * correct / len(order),
+                         'clips_per_video': float(clips) / len(order), 'sec': sec,
+                         'speedup': full_sec / max(sec, 1e-9)}
+        print('==> threshold %.2f: Prec@1 %.2f, %.2f clips per video, %.1f sec (%.2fx)' % (
+            float(run), result['run']['prec1'], result['run']['clips_per_video'], sec,
+            result['run']['speedup']))
+
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('==> Saved to %s' % output)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,333 @@
+# Evaluate several checkpoints in one pass over the test set
+# Usage (from TP-CNN/):
+#   python evaluate.py --checkpoints='(record/pose_L15/model_best.pth.tar,record/opf_L15_Bbox/model_best.pth.tar)' \
+#       --data_root=/path/to/Penn_Action/ --dic_path=/path/to/train_test_split --output=eval
+#
+# Every model is rebuilt from the 'config' saved in its checkpoint, data
+# locations and loader options come from the command line. The test clips of
+# all models (one every nb_per_stack frames as in training, or --test_clips
+# per video) are read once: each clip position loads the input of every
+# model that scores it, models with the same input (input_type,
+# nb_per_stack, use_Bbox) share the tensor, and frames, flow images and
+# heatmaps used by several inputs (pose L5 and pose L15, pose and 3d_pose,
+# ...) are decoded once through a FrameMemo.
+#
+# Per model, <output>/<name>/ gets metrics.json, video_preds.pickle (summed
+# clip logits per video, as written by the trainers) and clip_logits.npz
+# (video, start frame, label and logits of every clip).
+import os
+import json
+import time
+import pickle
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+from torch.utils.data import DataLoader as _DataLoader
+from torch.utils.data.dataloader import default_collate
+from utils.config import Config, opt
+from utils.extension import accuracy
+from data.dataloader import DataLoader as DLoader
+from data.PennAction_dataset import PennActionDataset
+from data.Fusion_dataset import Fusiondataset
+from data.cache import DecodedCache, FrameMemo
+
+
+# taken from the command line, not from the checkpoints
+LOCAL_OPTIONS = ('data_root', 'dic_path', 'batch_size', 'num_workers', 'device', 'cache_dir',
+                 'test_clips', 'test_sampling', 'stream_parallel')
+
+
+def _as_list(v):
+    if isinstance(v, str):
+        return [s.strip() for s in v.strip('()[]').split(',') if s.strip()]
+    return list(v) if isinstance(v, (tuple, list)) else [v]
+
+
+def _to(x, device):
+    if isinstance(x, (tuple, list)):
+        return tuple(_to(i, device) for i in x)
+    return x.to(device, non_blocking=True)
+
+
+def input_key(cfg):
+    """What a model reads, models with equal keys get the same tensor"""
+    kind = 'fusion' if cfg.Fusion else cfg.input_type
+    nb_per_stack = 1 if kind == 'rgb' else int(cfg.nb_per_stack)
+    return (kind, nb_per_stack, bool(cfg.use_Bbox))
+
+
+def load_config(checkpoint):
+    if 'config' not in checkpoint:
+        raise ValueError('checkpoint has no saved config, evaluate it with main.py --evaluate')
+    cfg = Config()
+    for k, v in checkpoint['config'].items():
+        if hasattr(Config, k):
+            setattr(cfg, k, v)
+    for k in LOCAL_OPTIONS:
+        setattr(cfg, k, getattr(opt, k))
+    cfg.checkpoint_stages = ''  # only used in training
+    return cfg
+
+
+def load_checkpoint(path):
+    """Returns (config, model in eval mode on the CPU, checkpoint without the weights)"""
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    cfg = load_config(checkpoint)
+    if cfg.Fusion:
+        from Fusion import create_model
+    else:
+        from main import create_model
+    model = create_model(cfg, pretrained=False)
+    model.load_state_dict(checkpoint.pop('state_dict'))
+    model.eval()
+    if cfg.Fusion and cfg.stream_parallel:
+        model.run_streams_concurrently(cfg.stream_parallel)
+    checkpoint.pop('optimizer', None)
+    return cfg, model, checkpoint
+
+
+class Evaluated(object):
+    """One checkpoint, its model and the clip level outputs it produced"""
+    def __init__(self, name, path, device):
+        self.cfg, self.model, checkpoint = load_checkpoint(path)
+        self.name = name
+        self.path = path
+        self.key = input_key(self.cfg)
+        self.epoch = checkpoint.get('epoch')
+        self.best_prec1 = checkpoint.get('best_prec1')
+        self.model = self.model.to(device)
+
+        self.videos = []
+        self.starts = []
+        self.labels = []
+        self.outputs = []
+        self.compute_sec = 0.
+
+    def add(self, videos, starts, labels, output):
+        self.videos.extend(videos)
+        self.starts.append(starts)
+        self.labels.append(labels)
+        # kept on device until the pass ends, like the trainers' validation
+        self.outputs.append(output.detach())
+
+    def clip_logits(self):
+        return (np.array(self.videos), torch.cat(self.starts).numpy(),
+                torch.cat(self.labels).numpy(), torch.cat(self.outputs).float().cpu().numpy())
+
+    def video_preds(self, logits):
+        dic_video_level_preds = {}
+        for j, video in enumerate(self.videos):
+            if video not in dic_video_level_preds:
+                dic_video_level_preds[video] = logits[j, :].copy()
+            else:
+                dic_video_level_preds[video] += logits[j, :]
+        return dic_video_level_preds
+
+
+def video_level_accuracy(dic_video_level_preds, test_video, nb_classes):
+    """Prec@1, Prec@5 and loss of the summed clip logits, as in the trainers"""
+    names = sorted(dic_video_level_preds.keys())
+    video_level_preds = np.zeros((len(names), nb_classes))
+    video_level_labels = np.zeros(len(names))
+    for ii, name in enumerate(names):
+        video_level_preds[ii, :] = dic_video_level_preds[name]
+        video_level_labels[ii] = int(test_video[name]) - 1
+    video_level_labels = torch.from_numpy(video_level_labels).long()
+    video_level_preds = torch.from_numpy(video_level_preds).float()
+
+    loss = nn.CrossEntropyLoss()(video_level_preds, video_level_labels)
+    top1, top5 = accuracy(video_level_preds, video_level_labels, topk=(1, min(5, nb_classes)))
+    return float(top1), float(top5), float(loss)
+
+
+class MultiInputClips(object):
+    """Union of the test clips of several inputs, each read once per position.
+
+    Item i is (video, start, label, {input key: tensor}) with the inputs of
+    every model whose test sampling includes that start frame. Clips are in
+    video order, so the readers' shared FrameMemo sees the overlap between
+    inputs of different stack lengths.
+
+    `videos` replaces the test split by any videos of frame_count.pickle,
+    with label -1 for those in neither split.
+    """
+    def __init__(self, cfg, keys, memo_size=256, videos=None):
+        self.memo = FrameMemo(memo_size)
+        if cfg.cache_dir:
+            self.memo.backing = DecodedCache(cfg.cache_dir, cfg.data_root)
+
+        data_loader = DLoader(cfg)
+        if videos is not None:
+            labels = dict(data_loader.train_video, **data_loader.test_video)
+            data_loader.test_video = dict((v, labels.get(v, 0)) for v in videos)
+        self.test_video = data_loader.test_video
+        self.readers = {}
+        clips = {}
+        for key in keys:
+            kind, nb_per_stack, use_Bbox = key
+            if kind == 'fusion':
+                db = Fusiondataset({}, use_Bbox, 'val', nb_per_stack, data_root=cfg.data_root)
+            else:
+                db = PennActionDataset({}, use_Bbox, 'test', kind, nb_per_stack,
+                                       data_root=cfg.data_root)
+            db.cache = self.memo
+            self.readers[key] = db
+
+            # the clips main.py / Fusion.py validate this input on
+            data_loader.nb_per_stack = nb_per_stack
+            data_loader.test_frame_sampling()
+            for clip in data_loader.dic_test_idx:
+                video, start = clip.split('[@]')
+                clips.setdefault((video, int(start)), []).append(key)
+        self.clips = sorted(clips.items())
+
+    def nb_reads(self):
+        return sum(len(keys) for _, keys in self.clips)
+
+    def nb_clips(self, key):
+        return sum(1 for _, keys in self.clips if key in keys)
+
+    def __getitem__(self, i):
+        (video, start), keys = self.clips[i]
+        label = int(self.test_video[video]) - 1
+        data = {}
+        for key in keys:
+            db = self.readers[key]
+            if key[0] == 'fusion':
+                data[key] = (db.read_image(video, start), db.stack_opf(video, start))
+            else:
+                data[key] = getattr(db, db.input_type_zoo[key[0]])(video, start)
+        return video, start, label, data
+
+    def __len__(self):
+        return len(self.clips)
+
+
+def collate(batch):
+    # every input is stacked over the clips that have it, with their rows in the batch
+    videos = [b[0] for b in batch]
+    starts = torch.LongTensor([b[1] for b in batch])
+    labels = torch.LongTensor([b[2] for b in batch])
+    inputs = {}
+    for j, (_, _, _, data) in enumerate(batch):
+        for key, x in data.items():
+            rows, xs = inputs.setdefault(key, ([], []))
+            rows.append(j)
+            xs.append(x)
+    inputs = dict((key, (torch.LongTensor(rows), default_collate(xs)))
+                  for key, (rows, xs) in inputs.items())
+    return videos, starts, labels, inputs
+
+
+def model_names(paths):
+    # 'record/pose_L15/model_best.pth.tar' -> 'pose_L15_model_best'
+    names = []
+    for path in paths:
+        stem = os.path.basename(path).split('.')[0]
+        name = '%s_%s' % (os.path.basename(os.path.dirname(os.path.abspath(path))), stem)
+        base, n = name, 2
+        while name in names:
+            name, n = '%s_%d' % (base, n), n + 1
+        names.append(name)
+    return names
+
+
+def format_table(results):
+    lines = ['%-36s %-16s %8s %8s %8s %8s %7s %10s' % (
+        'model', 'input', 'Prec@1', 'Prec@5', 'loss', 'clip@1', 'clips', 'model sec')]
+    for r in results:
+        lines.append('%-36s %-16s %8.2f %8.2f %8.4f %8.2f %7d %10.1f' % (
+            r['name'], r['input'], r['video_prec1'], r['video_prec5'], r['video_loss'],
+            r['clip_prec1'], r['nb_clips'], r['compute_sec']))
+    return '\n'.join(lines)
+
+
+def main(checkpoints, output='eval', memo_size=256, **kwargs):
+    opt._parse(kwargs)
+    device = torch.device(opt.device)
+    paths = _as_list(checkpoints)
+
+    models = [Evaluated(name, path, device) for name, path in zip(model_names(paths), paths)]
+    groups = {}
+    for m in models:
+        groups.setdefault(m.key, []).append(m)
+        print('==> %s: %s %s L=%d%s (epoch %s)' % (
+            m.name, m.cfg.model, m.key[0], m.key[1], ' Bbox' if m.key[2] else '', m.epoch))
+
+    dataset = MultiInputClips(opt, sorted(groups), memo_size=memo_size)
+    # evaluating every checkpoint on its own reads its clips once per model
+    separate = sum(dataset.nb_clips(m.key) for m in models)
+    print('==> %d models, %d inputs, %d clip positions: %d clip reads instead of %d' % (
+        len(models), len(groups), len(dataset), dataset.nb_reads(), separate))
+    test_loader = _DataLoader(dataset, batch_size=opt.batch_size, shuffle=False,
+                              num_workers=opt.num_workers, collate_fn=collate)
+
+    data_sec = 0.
+    start = end = time.time()
+    for videos, starts, labels, inputs in tqdm(test_loader, ascii=True, desc='evaluating'):
+        data_sec += time.time() - end
+        for key, (rows, x) in inputs.items():
+            x = _to(x, device)
+            sub_videos = [videos[r] for r in rows.tolist()]
+            for m in groups[key]:
+                t = time.time()
+                with torch.no_grad():
+                    scores = m.model(x)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                m.compute_sec += time.time() - t
+                m.add(sub_videos, starts[rows], labels[rows], scores)
+        end = time.time()
+    wall = time.time() - start
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    results = []
+    for m in models:
+        videos, starts, labels, logits = m.clip_logits()
+        dic_video_level_preds = m.video_preds(logits)
+        top1, top5, loss = video_level_accuracy(
+            dic_video_level_preds, dataset.test_video, m.cfg.nb_classes)
+        clip_top1 = float(accuracy(torch.from_numpy(logits), torch.from_numpy(labels))[0])
+        result = {
+            'name': m.name,
+            'checkpoint': m.path,
+            'input': '%s_L%d%s' % (m.key[0], m.key[1], '_Bbox' if m.key[2] else ''),
+            'model': m.cfg.model,
+            'epoch': m.epoch,
+            'video_prec1': top1,
+            'video_prec5': top5,
+            'video_loss': loss,
+            'clip_prec1': clip_top1,
+            'nb_videos': len(dic_video_level_preds),
+            'nb_clips': len(videos),
+            'compute_sec': m.compute_sec
+        }
+        results.append(result)
+
+        folder = os.path.join(output, m.name)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, 'metrics.json'), 'w') as f:
+            json.dump(result, f, indent=2)
+        with open(os.path.join(folder, 'video_preds.pickle'), 'wb') as f:
+            pickle.dump(dic_video_level_preds, f)
+        np.savez(os.path.join(folder, 'clip_logits.npz'),
+                 videos=videos, starts=starts, labels=labels, logits=logits)
+
+    table = format_table(results)
+    print(table)
+    print('==> one pass in %.1f sec, %.1f sec waiting for data' % (wall, data_sec))
+    with open(os.path.join(output, 'summary.txt'), 'w') as f:
+        f.write(table + '\n')
+    with open(os.path.join(output, 'summary.json'), 'w') as f:
+        json.dump({'wall_sec': wall, 'data_sec': data_sec, 'nb_clip_positions': len(dataset),
+                   'nb_clip_reads': dataset.nb_reads(), 'nb_clip_reads_separate': separate,
+                   'models': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
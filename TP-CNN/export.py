@@ -0,0 +1,131 @@
+# Export a checkpoint to TorchScript or ONNX for runtime.py
+# Usage (from TP-CNN/):
+#   python export.py --checkpoint=record/pose_L15/model_best.pth.tar --output=export/pose_L15.pt
+#   python export.py --checkpoint=record/opf_L15_Bbox/model_best.pth.tar --output=export/opf_L15_Bbox.onnx
+#
+# The model is rebuilt from the config saved in the checkpoint (see
+# evaluate.load_checkpoint, no ImageNet download) and traced in eval mode
+# with a dynamic clip dimension. The format follows the extension: .pt is
+# TorchScript with the metadata embedded as meta.json, .onnx is ONNX
+# (opset --opset) with the metadata in <output>.json. The metadata has what
+# a caller needs to build inputs: input names and shapes, input type, stack
+# length, resolution, channels per frame and the pixel scaling.
+#
+# The exported model is then loaded with runtime.load and checked against
+# the eager model on random clips (batch sizes 1 and --batch_size), it
+# fails above --atol. ONNX parity needs onnxruntime; without it only the
+# ONNX checker runs.
+import os
+import json
+import torch
+from utils.config import opt
+from evaluate import load_checkpoint, input_key
+from serve import input_shapes
+from model.streaming import LAYOUTS
+import runtime
+
+
+def metadata(cfg, key, checkpoint, meta, fmt):
+    kind, nb_per_stack, use_Bbox = key
+    shapes = input_shapes(key)
+    names = ['rgb', 'opf'] if kind == 'fusion' else ['x']
+    info = {
+        'format': fmt,
+        'checkpoint': checkpoint,
+        'epoch': meta.get('epoch'),
+        'best_prec1': meta.get('best_prec1'),
+        'model': cfg.model,
+        'input_type': kind,
+        'nb_per_stack': nb_per_stack,
+        'use_Bbox': use_Bbox,
+        'nb_classes': cfg.nb_classes,
+        'inputs': [{'name': n, 'shape': [None] + list(shapes[n])} for n in names],
+        # how the datasets build a clip, see data/PennAction_dataset.py
+        'frames': {},
+    }
+    for n in names:
+        input_type = n if kind == 'fusion' else kind
+        size, width, axis = LAYOUTS[input_type]
+        frames = {'resolution': size, 'channels_per_frame': width,
+                  'layout': 'frames stacked on the channels' if axis == 0 else '(channel, time, height, width)'}
+        if input_type == 'rgb':
+            frames.update({'scale': '1/255', 'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]})
+        else:
+            frames['scale'] = '1/255'
+        info['frames'][n] = frames
+    return info
+
+
+def example_inputs(info, batch_size):
+    return [torch.rand(batch_size, *i['shape'][1:]) for i in info['inputs']]
+
+
+def _arg(inputs):
+    return inputs[0] if len(inputs) == 1 else tuple(inputs)
+
+
+def export_torchscript(model, info, output, batch_size):
+    traced = torch.jit.trace(model, (_arg(example_inputs(info, batch_size)),), check_trace=False)
+    torch.jit.save(traced, output, _extra_files={'meta.json': json.dumps(info)})
+
+
+def export_onnx(model, info, output, batch_size, opset):
+    names = [i['name'] for i in info['inputs']]
+    axes = dict((n, {0: 'clips'}) for n in names + ['logits'])
+    # the TorchScript based exporter, the torch.export one needs onnxscript
+    torch.onnx.export(model, (_arg(example_inputs(info, batch_size)),), output, input_names=names,
+                      output_names=['logits'], dynamic_axes=axes, opset_version=opset, dynamo=False)
+    with open(output + '.json', 'w') as f:
+        json.dump(info, f, indent=2)
+
+
+def check_parity(model, output, info, batch_sizes):
+    """Max |logit| difference between the exported and the eager model, None if it cannot run"""
+    try:
+        exported = runtime.load(output)
+    except ImportError as e:
+        print('==> %s, parity not checked' % e)
+        try:
+            import onnx
+            onnx.checker.check_model(onnx.load(output))
+            print('==> ONNX checker passed')
+        except ImportError:
+            pass
+        return None
+    diff = 0.
+    for B in batch_sizes:
+        inputs = example_inputs(info, B)
+        with torch.no_grad():
+            reference = model(_arg(inputs)).numpy()
+        diff = max(diff, float(abs(exported(*[x.numpy() for x in inputs]) - reference).max()))
+    return diff
+
+
+def main(checkpoint, output='export/model.pt', batch_size=2, opset=17, atol=1e-4, **kwargs):
+    opt._parse(kwargs)
+    opt.device = 'cpu'
+    cfg, model, meta = load_checkpoint(checkpoint)
+    key = input_key(cfg)
+    fmt = 'onnx' if output.endswith('.onnx') else 'torchscript'
+    info = metadata(cfg, key, checkpoint, meta, fmt)
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+
+    if fmt == 'onnx':
+        export_onnx(model, info, output, batch_size, opset)
+    else:
+        export_torchscript(model, info, output, batch_size)
+    print('==> %s %s L=%d exported to %s (%s, %.1f MB)' % (
+        cfg.model, key[0], key[1], output, fmt, os.path.getsize(output) / 2.**20))
+
+    diff = check_parity(model, output, info, sorted(set([1, batch_size])))
+    if diff is not None:
+        print('==> max |logit| difference to the eager model: %.3g' % diff)
+        if diff > atol:
+            raise RuntimeError('exported model differs from the eager model by %.3g > %.3g' % (diff, atol))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
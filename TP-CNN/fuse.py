@@ -0,0 +1,195 @@
+# Late fusion of saved video level predictions, no forward passes
+# Usage (from TP-CNN/):
+#   python fuse.py --preds='(record/pose_L15/video_preds.pickle,record/opf_L15_Bbox/video_preds.pickle,record/rgb_L1/video_preds.pickle)' \
+#       --dic_path=/path/to/train_test_split --step=0.05 --folds=5
+#
+# Inputs are the video_preds.pickle files of main.py / Fusion.py and
+# evaluate.py (summed clip logits per video) or the predictions.npz of
+# infer.py. They are aligned on the videos all of them cover, each stream is
+# normalized (--normalize: 'zscore' over the whole stream, 'softmax' per
+# video or 'none'), and the fused score is a weighted sum of the streams.
+#
+# Every subset of the streams is searched, with --search='grid' (all weights
+# on a simplex grid of --step, scored at once as one array op) or 'optimize'
+# (softmax weights and a temperature fitted to the video level loss with
+# LBFGS). The weights are fitted on the videos that are scored, so with
+# --folds=k the table also has the k-fold cross validated Prec@1 of the search.
+import os
+import json
+import pickle
+import itertools
+import numpy as np
+import torch
+import torch.nn.functional as F
+from utils.config import opt
+
+
+def _as_list(v):
+    if isinstance(v, str):
+        return [s.strip() for s in v.strip('()[]').split(',') if s.strip()]
+    return list(v) if isinstance(v, (tuple, list)) else [v]
+
+
+def stream_name(path):
+    # 'record/pose_L15/video_preds.pickle' -> 'pose_L15'
+    return os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+
+def load_preds(path):
+    """{video: summed logits} of a video_preds.pickle or an infer.py predictions.npz"""
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return dict(zip(f['video'].tolist(), f['video_logits']))
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def align(dics, labels):
+    """(streams x videos x classes) scores and the labels of the videos in every stream"""
+    videos = set(dics[0])
+    for dic in dics[1:]:
+        videos &= set(dic)
+    videos = sorted(v for v in videos if v in labels)
+    scores = np.stack([np.stack([np.asarray(dic[v], np.float64) for v in videos]) for dic in dics])
+    targets = np.array([int(labels[v]) - 1 for v in videos])
+    return videos, scores, targets
+
+
+def normalize_scores(scores, mode):
+    if mode == 'none':
+        return scores
+    if mode == 'softmax':
+        e = np.exp(scores - scores.max(axis=2, keepdims=True))
+        return e / e.sum(axis=2, keepdims=True)
+    if mode == 'zscore':
+        mean = scores.mean(axis=(1, 2), keepdims=True)
+        std = scores.std(axis=(1, 2), keepdims=True)
+        return (scores - mean) / np.maximum(std, 1e-12)
+    raise ValueError('Unknown normalize "%s", expected none, softmax or zscore' % mode)
+
+
+def simplex_grid(nb_streams, step):
+    """All weight vectors with entries in multiples of step that sum to 1"""
+    n = int(round(1. / step))
+    rows = [c for c in itertools.product(range(n + 1), repeat=nb_streams - 1) if sum(c) <= n]
+    grid = np.array([list(c) + [n - sum(c)] for c in rows], np.float64)
+    return grid / n
+
+
+def score(weights, scores, targets, chunk=256):
+    """Prec@1 of every weight row (C x S) on scores (S x V x K), vectorized over C"""
+    top1 = np.empty(len(weights))
+    for i in range(0, len(weights), chunk):
+        fused = np.tensordot(weights[i:i + chunk], scores, axes=(1, 0))  # C x V x K
+        top1[i:i + chunk] = (fused.argmax(axis=2) == targets).mean(axis=1)
+    return 100. * top1
+
+
+def metrics(weights, scores, targets):
+    fused = torch.from_numpy(np.tensordot(weights, scores, axes=(0, 0)))
+    target = torch.from_numpy(targets)
+    k = min(5, fused.size(1))
+    topk = fused.topk(k, 1)[1]
+    return {
+        'prec1': 100. * float((topk[:, 0] == target).double().mean()),
+        'prec5': 100. * float((topk == target.view(-1, 1)).any(1).double().mean()),
+        'loss': float(F.cross_entropy(fused, target))
+    }
+
+
+def search_grid(scores, targets, step):
+    grid = simplex_grid(scores.shape[0], step)
+    top1 = score(grid, scores, targets)
+    best = np.flatnonzero(top1 == top1.max())
+    # ties go to the weights closest to the uniform average
+    uniform = np.full(scores.shape[0], 1. / scores.shape[0])
+    best = best[np.argmin(((grid[best] - uniform) ** 2).sum(axis=1))]
+    return grid[best]
+
+
+def search_optimize(scores, targets, nb_iters=100):
+    s = torch.from_numpy(scores)
+    target = torch.from_numpy(targets)
+    theta = torch.zeros(scores.shape[0], dtype=torch.float64, requires_grad=True)
+    log_t = torch.zeros((), dtype=torch.float64, requires_grad=True)
+    optimizer = torch.optim.LBFGS([theta, log_t], max_iter=nb_iters, line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        fused = torch.einsum('s,svk->vk', torch.softmax(theta, 0), s) * log_t.exp()
+        loss = F.cross_entropy(fused, target)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return torch.softmax(theta, 0).detach().numpy()
+
+
+def cross_validate(scores, targets, search, folds, seed=0):
+    """Prec@1 of weights searched on the other folds, over all videos"""
+    order = np.random.RandomState(seed).permutation(scores.shape[1])
+    correct = 0
+    for f in range(folds):
+        test = order[f::folds]
+        train = np.setdiff1d(order, test)
+        w = search(scores[:, train], targets[train])
+        fused = np.tensordot(w, scores[:, test], axes=(0, 0))
+        correct += (fused.argmax(axis=1) == targets[test]).sum()
+    return 100. * correct / scores.shape[1]
+
+
+def main(preds, normalize='zscore', search='grid', step=0.1, folds=0, min_streams=1,
+         output='fuse.json', **kwargs):
+    opt._parse(kwargs)
+    paths = _as_list(preds)
+    names = [stream_name(p) for p in paths]
+    with open(opt.dic_path + '/train_video.pickle', 'rb') as f:
+        labels = pickle.load(f)
+    with open(opt.dic_path + '/test_video.pickle', 'rb') as f:
+        labels.update(pickle.load(f))
+
+    videos, scores, targets = align([load_preds(p) for p in paths], labels)
+    if not videos:
+        raise ValueError('the prediction files have no labelled video in common')
+    scores = normalize_scores(scores, normalize)
+    print('==> %d streams, %d common videos, %s normalization, %s search' % (
+        len(paths), len(videos), normalize, search))
+
+    if search == 'grid':
+        find = lambda s, t: search_grid(s, t, step)
+    elif search == 'optimize':
+        find = search_optimize
+    else:
+        raise ValueError('Unknown search "%s", expected grid or optimize' % search)
+
+    results = []
+    for size in range(max(1, min_streams), len(paths) + 1):
+        for subset in itertools.combinations(range(len(paths)), size):
+            sub = scores[list(subset)]
+            w = find(sub, targets) if size > 1 else np.ones(1)
+            result = {'streams': [names[i] for i in subset], 'weights': w.tolist()}
+            result.update(metrics(w, sub, targets))
+            result['mean_prec1'] = metrics(np.full(size, 1. / size), sub, targets)['prec1']
+            if folds > 1 and size > 1:
+                result['cv_prec1'] = cross_validate(sub, targets, find, folds)
+            results.append(result)
+
+    results.sort(key=lambda r: (-r['prec1'], r['loss']))
+    print('%-48s %8s %8s %8s %8s %8s  %s' % (
+        'streams', 'Prec@1', 'Prec@5', 'loss', 'mean@1', 'cv@1', 'weights'))
+    for r in results:
+        print('%-48s %8.2f %8.2f %8.4f %8.2f %8s  %s' % (
+            '+'.join(r['streams']), r['prec1'], r['prec5'], r['loss'], r['mean_prec1'],
+            '%.2f' % r['cv_prec1'] if 'cv_prec1' in r else '-',
+            ' '.join('%.2f' % w for w in r['weights'])))
+
+    with open(output, 'w') as f:
+        json.dump({'preds': paths, 'nb_videos': len(videos), 'normalize': normalize,
+                   'search': search, 'step': step, 'folds': folds, 'results': results}, f, indent=2)
+    print('==> Saved %d combinations to %s' % (len(results), output))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,189 @@
+# Offline batch inference of one checkpoint over many videos
+# Usage (from TP-CNN/):
+#   python infer.py --checkpoint=record/pose_L15/model_best.pth.tar --videos=all --workers=4 \
+#       --data_root=/path/to/Penn_Action/ --dic_path=/path/to/train_test_split --output=infer_pose_L15
+#
+# --videos is 'test', 'train', 'all' (every video of frame_count.pickle) or
+# a text file with one video name per line. Videos are split into `workers`
+# shards of near equal clip counts, one forked process each. The model is
+# loaded once and put in shared memory before the fork, so the workers read
+# the same weights; each gets cpu_count / workers threads. Clips are sampled
+# as in validation, one every nb_per_stack frames or --test_clips per video.
+#
+# <output>/predictions.npz is columnar: the clip_* arrays have one row per
+# clip (video, start frame, label, logits), the video_* arrays one row per
+# video (name, label, number of clips, summed logits as in video_preds.pickle).
+# Labels are -1 for videos in neither split. <output>/summary.json has the
+# per worker throughput.
+import os
+import json
+import time
+import traceback
+import multiprocessing
+from queue import Empty
+import numpy as np
+import torch
+from torch.utils.data import DataLoader as _DataLoader
+from utils.config import opt
+from data.dataloader import DataLoader as DLoader
+from evaluate import load_checkpoint, input_key, MultiInputClips, collate, _to
+
+
+def select_videos(videos, data_loader):
+    if videos == 'test':
+        return sorted(data_loader.test_video)
+    if videos == 'train':
+        return sorted(data_loader.train_video)
+    if videos == 'all':
+        return sorted(data_loader.frame_count)
+    with open(videos) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def shard(videos, nb_clips, nb_shards):
+    """Splits the videos into nb_shards lists of near equal clip counts"""
+    shards = [[] for _ in range(nb_shards)]
+    load = [0] * nb_shards
+    # longest first, each to the least loaded shard
+    for video in sorted(videos, key=lambda v: -nb_clips[v]):
+        i = load.index(min(load))
+        shards[i].append(video)
+        load[i] += nb_clips[video]
+    return [sorted(s) for s in shards]
+
+
+def _worker(rank, model, cfg, key, videos, folder, messages, threads):
+    try:
+        torch.set_num_threads(threads)
+        device = torch.device(cfg.device)
+        if device.type == 'cuda':
+            device = torch.device('cuda', rank % torch.cuda.device_count())
+        model = model.to(device)
+        dataset = MultiInputClips(cfg, [key], videos=videos)
+        loader = _DataLoader(dataset, batch_size=cfg.batch_size, shuffle=False,
+                             num_workers=cfg.num_workers, collate_fn=collate)
+
+        clip_videos, starts, labels, outputs = [], [], [], []
+        start = time.time()
+        for batch_videos, batch_starts, batch_labels, inputs in loader:
+            rows, x = inputs[key]
+            with torch.no_grad():
+                outputs.append(model(_to(x, device)).float().cpu())
+            clip_videos.extend(batch_videos)
+            starts.append(batch_starts)
+            labels.append(batch_labels)
+            messages.put(('progress', rank, len(batch_videos)))
+        sec = time.time() - start
+
+        path = os.path.join(folder, 'shard_%03d.npz' % rank)
+        np.savez(path, clip_video=np.array(clip_videos, dtype=str),
+                 clip_start=torch.cat(starts).numpy() if starts else np.zeros(0, np.int64),
+                 clip_label=torch.cat(labels).numpy() if labels else np.zeros(0, np.int64),
+                 clip_logits=torch.cat(outputs).numpy() if outputs else np.zeros((0, cfg.nb_classes), np.float32))
+        messages.put(('done', rank, len(clip_videos), sec))
+    except Exception:
+        messages.put(('error', rank, traceback.format_exc()))
+
+
+def merge(paths):
+    """Concatenates the shard files, then adds the video level columns"""
+    columns = {}
+    for path in paths:
+        with np.load(path) as shard_file:
+            for k in shard_file.files:
+                columns.setdefault(k, []).append(shard_file[k])
+    columns = dict((k, np.concatenate(v)) for k, v in columns.items())
+
+    videos, index, nb_clips = np.unique(columns['clip_video'], return_inverse=True, return_counts=True)
+    video_logits = np.zeros((len(videos), columns['clip_logits'].shape[1]), np.float32)
+    np.add.at(video_logits, index, columns['clip_logits'])
+    video_label = np.zeros(len(videos), np.int64)
+    video_label[index] = columns['clip_label']
+    columns.update({'video': videos, 'video_label': video_label,
+                    'video_nb_clips': nb_clips, 'video_logits': video_logits})
+    return columns
+
+
+def main(checkpoint, videos='test', workers=2, output='infer', report_freq=10, **kwargs):
+    opt._parse(kwargs)
+    cfg, model, meta = load_checkpoint(checkpoint)
+    key = input_key(cfg)
+    print('==> %s: %s %s L=%d%s (epoch %s)' % (
+        checkpoint, cfg.model, key[0], key[1], ' Bbox' if key[2] else '', meta.get('epoch')))
+
+    data_loader = DLoader(cfg)
+    names = select_videos(videos, data_loader)
+    # the clips of test_frame_sampling
+    data_loader.nb_per_stack = key[1]
+    nb_clips = dict((v, len(data_loader.test_starts(v))) for v in names)
+    shards = [s for s in shard(names, nb_clips, min(workers, len(names))) if s]
+    total = sum(nb_clips.values())
+    cores = len(os.sched_getaffinity(0))
+    threads = max(1, cores // len(shards))
+    print('==> %d videos, %d clips in %d shards, %d threads each' % (
+        len(names), total, len(shards), threads))
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    # copy-on-write after fork would still duplicate pages the workers touch
+    model.share_memory()
+    ctx = multiprocessing.get_context('fork')
+    messages = ctx.Queue()
+    processes = [ctx.Process(target=_worker, args=(rank, model, cfg, key, s, output, messages, threads))
+                 for rank, s in enumerate(shards)]
+    start = time.time()
+    for p in processes:
+        p.start()
+
+    done, workers_info, last = 0, {}, start
+    while len(workers_info) < len(processes):
+        try:
+            msg = messages.get(timeout=report_freq)
+        except Empty:
+            msg = None
+            if any(p.exitcode not in (None, 0) for p in processes):
+                raise RuntimeError('an inference worker died, exit codes %s' % [p.exitcode for p in processes])
+        if msg is not None:
+            if msg[0] == 'error':
+                for p in processes:
+                    p.terminate()
+                raise RuntimeError('inference worker %d failed:\n%s' % (msg[1], msg[2]))
+            if msg[0] == 'progress':
+                done += msg[2]
+            if msg[0] == 'done':
+                workers_info[msg[1]] = {'clips': msg[2], 'sec': msg[3],
+                                        'clips_per_sec': msg[2] / max(msg[3], 1e-9),
+                                        'videos': len(shards[msg[1]])}
+        now = time.time()
+        if now - last >= report_freq or len(workers_info) == len(processes):
+            print('==> %d/%d clips (%.0f%%), %.1f clips/s' % (
+                done, total, 100. * done / max(total, 1), done / (now - start)))
+            last = now
+    for p in processes:
+        p.join()
+    wall = time.time() - start
+
+    paths = [os.path.join(output, 'shard_%03d.npz' % rank) for rank in range(len(shards))]
+    columns = merge(paths)
+    np.savez(os.path.join(output, 'predictions.npz'), **columns)
+    for path in paths:
+        os.remove(path)
+
+    for rank in sorted(workers_info):
+        w = workers_info[rank]
+        print('    worker %2d: %4d videos %6d clips %8.1f clips/s' % (
+            rank, w['videos'], w['clips'], w['clips_per_sec']))
+    print('==> %d clips of %d videos in %.1f sec, %.1f clips/s, saved to %s' % (
+        len(columns['clip_video']), len(columns['video']), wall,
+        len(columns['clip_video']) / wall, os.path.join(output, 'predictions.npz')))
+    with open(os.path.join(output, 'summary.json'), 'w') as f:
+        json.dump({'checkpoint': checkpoint, 'videos': videos, 'nb_videos': len(columns['video']),
+                   'nb_clips': len(columns['clip_video']), 'wall_sec': wall,
+                   'clips_per_sec': len(columns['clip_video']) / wall, 'threads_per_worker': threads,
+                   'workers': [workers_info[r] for r in sorted(workers_info)]}, f, indent=2)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -13,33 +13,87 @@ from utils.config import opt
 from data.dataloader import DataLoader as DLoader
 import model.resnet_2d as models_2d
 import model.resnet_3d as models_3d
-import model.resnet3d_conv1_10 as model_dev
+import model.resnet_3d_conv1_10 as model_dev
 from utils.extension import *
+from utils.timer import StageTimer, TraceWindow
+from data.telemetry import LoaderTelemetry
+from utils.tuner import tune
+from utils.compiled import TrainStep
+from utils.distributed import init_distributed, cleanup, is_main_process, wrap_model, \
+    unwrap_model, broadcast_buffers, all_reduce_meter, merge_video_preds, NullWriter
 
 
 def main(**kwargs):
 
     # opt config
     opt._parse(kwargs)
+    device = init_distributed(opt)
+
+    # pick batch_size and num_workers for this model and machine
+    if opt.autotune:
+        tune(opt, device, create_model)
 
     # Data Loader
     data_loader = DLoader(opt)
     train_loader, test_loader, test_video = data_loader.run()
 
     # Train my model
-    model = Resnet2D(opt, train_loader, test_loader, test_video)
+    model = Resnet2D(opt, train_loader, test_loader, test_video, device=device)
     model.run()
+    cleanup()
+
+
+def create_model(opt, pretrained=True):
+    if opt.input_type == 'opf':
+        return models_2d.__dict__[opt.model](
+            pretrained=pretrained,
+            channel=opt.nb_per_stack*2,
+            nb_classes=opt.nb_classes,
+            checkpoint_stages=opt.checkpoint_stages
+        )
+
+    elif opt.input_type == 'rgb':
+        return models_2d.__dict__[opt.model](
+            pretrained=pretrained,
+            channel=3,
+            nb_classes=opt.nb_classes,
+            checkpoint_stages=opt.checkpoint_stages
+        )
+
+    elif opt.input_type == '3d_pose':
+        return models_3d.__dict__[opt.model](
+            pretrained=pretrained,
+            num_classes=opt.nb_classes,
+            checkpoint_stages=opt.checkpoint_stages
+        )
+
+    else:
+        return models_2d.__dict__[opt.model](
+            pretrained=pretrained,
+            channel=opt.nb_per_stack,
+            nb_classes=opt.nb_classes,
+            checkpoint_stages=opt.checkpoint_stages
+        )
 
 
 class Resnet2D():
 
-    def __init__(self, opt, train_loader, test_loader, test_video):
+    def __init__(self, opt, train_loader, test_loader, test_video, device=None):
         self.opt = opt
+        self.device = device if device is not None else torch.device(opt.device)
         self.train_loader = train_loader
         self.test_loader = test_loader
         self.test_video = test_video
         self.best_prec1 = 0
 
+        # position inside the current epoch when resuming a training state
+        self.start_step = 0
+        self.global_step = 0
+        self.resume_metrics = None
+
+        # compiled forward and loss with --compile, built in run()
+        self.train_step = None
+
         # Check for rgb input
         if opt.input_type == 'rgb' and opt.nb_per_stack != 1:
             raise ValueError('rgb data only support nb_per_stack = 1')
@@ -52,46 +106,50 @@ class Resnet2D():
         # Bounding Box
         if opt.use_Bbox:
             log_dir = log_dir+'_Bbox'
-        self.tensorboard = SummaryWriter(log_dir=log_dir)
+        self.log_dir = log_dir
+
+        # record folder for checkpoints and video level prediction
+        self.save_folder = opt.record_path+'/' + \
+            opt.input_type+'_L'+str(opt.nb_per_stack)
+        if opt.use_Bbox:
+            self.save_folder = self.save_folder + '_Bbox'
+        # only rank 0 writes tensorboard, timing and checkpoints
+        if is_main_process():
+            self.tensorboard = SummaryWriter(log_dir=log_dir)
+        else:
+            self.tensorboard = NullWriter()
+
+        # Hot path timing, the datasets report clip loading from their workers
+        self.timer = StageTimer(enabled=opt.timing and is_main_process(), sync=True)
+        if opt.timing and is_main_process():
+            for loader in [train_loader, test_loader]:
+                loader.dataset.db.timer = StageTimer(
+                    enabled=True,
+                    csv_path=os.path.join(log_dir, 'clip_timing.csv'),
+                    flush_every=200
+                )
+
+        # DataLoader worker telemetry, collected after every epoch
+        self.telemetry = None
+        if opt.telemetry:
+            self.telemetry = LoaderTelemetry()
+            for loader in [train_loader, test_loader]:
+                loader.dataset.db.telemetry = self.telemetry
 
     def build_model(self):
-        if opt.input_type == 'opf':
-            self.model = models_2d.__dict__[self.opt.model](
-                pretrained=True,
-                channel=self.opt.nb_per_stack*2,
-                num_classes=self.opt.nb_classes
-            )
-
-        elif opt.input_type == 'rgb':
-            self.model = models_2d.__dict__[self.opt.model](
-                pretrained=True,
-                channel=3,
-                num_classes=self.opt.nb_classes
-            )
+        self.model = create_model(self.opt)
+        if self.opt.input_type == 'rgb':
             self.opt.nb_per_stack = 1
 
-        elif opt.input_type == '3d_pose':
-            self.model = models_3d.__dict__[self.opt.model](
-                pretrained=True,
-                num_classes=self.opt.nb_classes
-            )
-
-        else:
-            self.model = models_2d.__dict__[self.opt.model](
-                pretrained=True,
-                channel=self.opt.nb_per_stack,
-                num_classes=self.opt.nb_classes
-            )
-
-        # TO cuda()
-        self.model = self.model.cuda()
+        # To device
+        self.model = self.model.to(self.device)
 
         # Loss function and optimizer
-        self.criterion = nn.CrossEntropyLoss().cuda()
+        self.criterion = nn.CrossEntropyLoss().to(self.device)
         self.optimizer = torch.optim.SGD(
             self.model.parameters(), self.opt.lr, momentum=0.9)
         self.scheduler = ReduceLROnPlateau(
-            self.optimizer, 'min', patience=1, verbose=True)
+            self.optimizer, 'min', patience=1)
         print ('==> Build %s model and setup loss function and optimizer' %
                self.opt.model)
 
@@ -99,26 +157,86 @@ class Resnet2D():
         # Note that this function DID NOT load the opt config setting
         # You need to set the opt config manually for your desired result
         if self.opt.resume:
-            if os.path.isfile(self.resume):
+            if os.path.isfile(self.opt.resume):
                 print("==> loading checkpoint %s" % self.opt.resume)
-                checkpoint = torch.load(self.opt.resume)
-                self.opt.start_epoch = checkpoint['epoch']
+                checkpoint = torch.load(
+                    self.opt.resume, map_location=self.device, weights_only=False)
                 self.best_prec1 = checkpoint['best_prec1']
                 self.model.load_state_dict(checkpoint['state_dict'])
                 self.optimizer.load_state_dict(checkpoint['optimizer'])
-                print("==> loaded checkpoint '%s' (epoch %d) (best_prec1 %f)"
-                      % (self.resume, checkpoint['epoch'], self.best_prec1))
+                if 'scheduler' in checkpoint:
+                    self.scheduler.load_state_dict(checkpoint['scheduler'])
+
+                if 'step' in checkpoint:
+                    # training state, 'epoch' is the epoch in progress
+                    self.opt.start_epoch = checkpoint['epoch']
+                    self.load_train_state(checkpoint)
+                else:
+                    # epoch checkpoint, saved after 'epoch' finished
+                    self.opt.start_epoch = checkpoint['epoch'] + 1
+                print("==> loaded checkpoint '%s' (epoch %d) (step %d) (best_prec1 %f)"
+                      % (self.opt.resume, checkpoint['epoch'], self.start_step, self.best_prec1))
 
             else:
                 print("==> no checkpoint found at %s" % self.opt.resume)
 
         if self.opt.evaluate:
+            self.epoch = self.opt.start_epoch
             prec1, val_loss = self.validate_1epoch()
             return
 
+    def save_train_state(self, step, metrics):
+        # everything needed to continue this epoch at `step`
+        if not is_main_process():
+            return
+        sampler = self.train_loader.sampler.state_dict()
+        sampler['start'] = step * self.opt.batch_size
+        self.checkpoint_writer.save_state({
+            'epoch': self.epoch,
+            'step': step,
+            'global_step': self.global_step,
+            'state_dict': unwrap_model(self.model).state_dict(),
+            'best_prec1': self.best_prec1,
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'sampler': sampler,
+            'metrics': metrics.state_dict() if metrics is not None else None,
+            'rng': get_rng_state(),
+            'log_dir': self.log_dir,
+            'config': self.opt._state_dict()
+        }, self.save_folder+'/train_state.pth.tar')
+
+    def load_train_state(self, state):
+        self.start_step = state['step']
+        self.global_step = state['global_step']
+        self.resume_metrics = state['metrics']
+        self.train_loader.sampler.load_state_dict(state['sampler'])
+        set_rng_state(state['rng'])
+
+        # keep writing to the same tensorboard run
+        if state['log_dir'] != self.log_dir and is_main_process():
+            self.tensorboard.close()
+            self.log_dir = state['log_dir']
+            self.tensorboard = SummaryWriter(log_dir=self.log_dir)
+
     def run(self):
         self.build_model()
+        self.checkpoint_writer = CheckpointWriter(
+            keep_last=self.opt.keep_last, background=self.opt.async_save)
         self.resume_and_evaluate()
+        if self.opt.evaluate:
+            return
+        self.model = wrap_model(self.model, self.device)
+        if self.opt.compile:
+            self.train_step = TrainStep(self.model, self.criterion, self.opt.compile_mode,
+                                        verbose=is_main_process())
+
+        # mkdir for record_path and save folder
+        if is_main_process():
+            if not os.path.isdir(self.opt.record_path):
+                os.mkdir(self.opt.record_path)
+            if not os.path.isdir(self.save_folder):
+                os.mkdir(self.save_folder)
 
         cudnn.benchmark = True
         for self.epoch in range(self.opt.start_epoch, self.opt.nb_epochs):
@@ -129,42 +247,46 @@ class Resnet2D():
             prec1, val_loss = self.validate_1epoch()
             self.scheduler.step(val_loss)
 
-            # save training model and video level prediction
-            save_folder = self.opt.record_path+'/' + \
-                self.opt.input_type+'_L'+str(self.opt.nb_per_stack)
-            if self.opt.use_Bbox:
-                save_folder = save_folder + '_Bbox'
-
-            # mkdir for record_path
-            if not os.path.isdir(self.opt.record_path):
-                os.mkdir(self.opt.record_path)
-            # mkdir for save folder
-            if not os.path.isdir(save_folder):
-                os.mkdir(save_folder)
-
-            # Save the current model and the best model
+            # Save the current model and the best model, on rank 0 only
             is_best = prec1 > self.best_prec1
             if is_best:
                 self.best_prec1 = prec1
-                with open(save_folder+'/video_preds.pickle', 'wb') as f:
+            if not is_main_process():
+                continue
+            if is_best:
+                with open(self.save_folder+'/video_preds.pickle', 'wb') as f:
                     pickle.dump(self.dic_video_level_preds, f)
                 f.close()
 
             # Save model and hyperparameter
-            save_checkpoint({
+            self.checkpoint_writer.save({
                 'epoch': self.epoch,
-                'state_dict': self.model.state_dict(),
+                'state_dict': unwrap_model(self.model).state_dict(),
                 'best_prec1': self.best_prec1,
                 'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict(),
                 'config': self.opt._state_dict()
-            }, is_best, folder=save_folder)
+            }, is_best, folder=self.save_folder)
+
+            # the training state now points at the start of the next epoch
+            if self.opt.save_freq:
+                self.epoch += 1
+                self.save_train_state(0, None)
+
+        # wait for the last checkpoint to reach the disk
+        self.checkpoint_writer.close()
 
     def train_1epoch(self):
         batch_time = AverageMeter()
         data_time = AverageMeter()
-        losses = AverageMeter()
-        top1 = AverageMeter()
-        top5 = AverageMeter()
+        metrics = MetricMeter(topk=(1, 5))
+        if self.resume_metrics is not None:
+            metrics.load_state_dict(
+                self.resume_metrics, device=next(self.model.parameters()).device)
+            self.resume_metrics = None
+
+        # shuffle order of this epoch, skipping what a resumed state already did
+        self.train_loader.sampler.set_epoch(self.epoch)
 
         # switch to train mode
         self.model.train()
@@ -173,107 +295,152 @@ class Resnet2D():
         # tqdm display
         des = 'Epoch:[%d/%d][training stage]' % (
             self.epoch, self.opt.nb_epochs)
-        progress = tqdm(self.train_loader, ascii=True, desc=des)
+        progress = tqdm(self.train_loader, ascii=True, desc=des, disable=not is_main_process(),
+                        initial=self.start_step, total=self.start_step+len(self.train_loader))
+
+        # profiler trace for a few steps of the first epoch
+        trace = TraceWindow(
+            self.opt.trace_steps if self.epoch == self.opt.start_epoch and is_main_process() else 0,
+            self.opt.trace_start,
+            os.path.join(self.log_dir, 'trace_epoch%d.json' % self.epoch)
+        )
 
         # mini-batch training
-        for i, (data, label) in enumerate(progress):
+        for i, (data, label) in enumerate(progress, self.start_step):
             # measure data loading time
             data_time.update(time.time() - end)
+            self.timer.record('loader', data_time.val)
+            trace.step(i)
 
             # To cuda()
-            label = label.cuda(async=True)
-            input_var = Variable(data).cuda()
-            target_var = Variable(label).cuda()
-
-            output = self.model(input_var)
-            loss = self.criterion(output, target_var)
+            with self.timer.stage('h2d'):
+                label = label.to(self.device, non_blocking=True)
+                input_var = Variable(data).to(self.device)
+                target_var = Variable(label).to(self.device)
+
+            if self.train_step is not None:
+                # one compiled graph, the loss is part of the forward stage
+                with self.timer.stage('forward'):
+                    output, loss = self.train_step(input_var, target_var)
+            else:
+                with self.timer.stage('forward'):
+                    output = self.model(input_var)
+                with self.timer.stage('loss'):
+                    loss = self.criterion(output, target_var)
 
-            # measure accuracy and record loss
-            prec1, prec5 = accuracy(output.data, label, topk=(1, 5))
-            losses.update(loss.data[0], data.size(0))
-            top1.update(prec1[0], data.size(0))
-            top5.update(prec5[0], data.size(0))
+            # record loss and accuracy on device, no host sync here
+            metrics.update(loss, output, label)
 
             # compute gradient and do SGD step
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            with self.timer.stage('backward'):
+                self.optimizer.zero_grad()
+                loss.backward()
+            with self.timer.stage('optimizer'):
+                self.optimizer.step()
+            self.global_step += 1
+
+            # mid-epoch training state
+            if self.opt.save_freq and (i + 1) % self.opt.save_freq == 0:
+                self.save_train_state(i + 1, metrics)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
-            # tqdm visuallization
-            info = {
-                'Prec@1': display_format(top1.avg),
-                'Loss': display_format(losses.avg),
-                'Data Time': display_format(data_time.avg)
-            }
-            progress.set_postfix(info)
-
-        # tensorboard utils
+            # tqdm visuallization, synced every print_freq steps
+            if (i + 1) % self.opt.print_freq == 0:
+                loss_avg, (top1, top5) = metrics.summary()
+                info = {
+                    'Prec@1': display_format(top1),
+                    'Loss': display_format(loss_avg),
+                    'Data Time': display_format(data_time.avg)
+                }
+                progress.set_postfix(info, refresh=False)
+                self.tensorboard.add_scalar('train_step/Loss', loss_avg, self.global_step)
+
+        self.start_step = 0
+
+        # tensorboard utils, averaged over every rank
+        all_reduce_meter(metrics, self.device)
+        loss_avg, (top1, top5) = metrics.summary()
         tb_info = {
             'Batch Time': batch_time.avg,
             'Data Time': data_time.avg,
-            'Loss': losses.avg,
-            'Prec@1': top1.avg,
-            'Prec@5': top5.avg,
+            'Loss': loss_avg,
+            'Prec@1': top1,
+            'Prec@5': top5,
             'lr': self.optimizer.param_groups[0]['lr']
         }
         for k, v in tb_info.items():
             self.tensorboard.add_scalar('train/'+k, v, self.epoch)
 
+        # per-stage timing
+        trace.close()
+        if self.opt.timing:
+            self.timer.write_tensorboard(self.tensorboard, 'timing/', self.epoch)
+            self.timer.write_csv(os.path.join(self.log_dir, 'stage_timing.csv'), epoch=self.epoch)
+            self.timer.reset()
+        self.report_telemetry('train')
+
     def validate_1epoch(self):
         batch_time = AverageMeter()
-        losses = AverageMeter()
-        top1 = AverageMeter()
-        top5 = AverageMeter()
+        metrics = MetricMeter(topk=(1, 5))
+        # every rank scores its own shard of clips, without DDP collectives
+        model = unwrap_model(self.model)
+        broadcast_buffers(model)
         # switch to evaluate mode
-        self.model.eval()
+        model.eval()
         self.dic_video_level_preds = {}
+        clip_keys = []
+        clip_preds = []
         end = time.time()
 
         # tqdm display
         des = 'Epoch:[%d/%d][testing stage ]' % (
             self.epoch, self.opt.nb_epochs)
-        progress = tqdm(self.test_loader, ascii=True, desc=des)
+        progress = tqdm(self.test_loader, ascii=True, desc=des, disable=not is_main_process())
         # mini-batch training
         for i, (keys, data, label) in enumerate(progress):
             # TO cuda()
-            label = label.cuda(async=True)
-            data_var = Variable(data).cuda()
-            label_var = Variable(label).cuda()
+            label = label.to(self.device, non_blocking=True)
+            data_var = Variable(data).to(self.device)
+            label_var = Variable(label).to(self.device)
 
             # compute output
-            output = self.model(data_var)
-            loss = self.criterion(output, label_var)
-            prec1, prec5 = accuracy(output.data, label, topk=(1, 5))
+            with torch.no_grad():
+                output = model(data_var)
+                loss = self.criterion(output, label_var)
 
             # measure loss
-            losses.update(loss.data[0], data.size(0))
-            top1.update(prec1[0], data.size(0))
-            top5.update(prec5[0], data.size(0))
+            metrics.update(loss, output, label)
 
             # tqdm
-            info = {
-                'Prec@1': display_format(top1.avg),
-                'Loss': display_format(losses.avg),
-                'Batch Time': display_format(batch_time.avg),
-            }
-            progress.set_postfix(info)
+            if (i + 1) % self.opt.print_freq == 0:
+                loss_avg, (top1, top5) = metrics.summary()
+                info = {
+                    'Prec@1': display_format(top1),
+                    'Loss': display_format(loss_avg),
+                    'Batch Time': display_format(batch_time.avg),
+                }
+                progress.set_postfix(info, refresh=False)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
-            # Calculate video level prediction
-            preds = output.data.cpu().numpy()
-            nb_data = preds.shape[0]
-            for j in range(nb_data):
-                videoName = keys[j].split('/', 1)[0]
-                if videoName not in self.dic_video_level_preds.keys():
-                    self.dic_video_level_preds[videoName] = preds[j, :]
-                else:
-                    self.dic_video_level_preds[videoName] += preds[j, :]
+            # keep clip level prediction on device until the epoch ends
+            clip_keys.extend(keys)
+            clip_preds.append(output.detach())
+
+        # Calculate video level prediction
+        if clip_preds:
+            preds = torch.cat(clip_preds).cpu().numpy()
+        for j, key in enumerate(clip_keys):
+            videoName = key.split('/', 1)[0]
+            if videoName not in self.dic_video_level_preds.keys():
+                self.dic_video_level_preds[videoName] = preds[j, :].copy()
+            else:
+                self.dic_video_level_preds[videoName] += preds[j, :]
+        self.dic_video_level_preds = merge_video_preds(self.dic_video_level_preds)
 
         video_top1, video_top5, video_loss = self.frame2_video_level_accuracy()
         #print type(video_loss)
@@ -288,9 +455,22 @@ class Resnet2D():
 
         for k, v in info.items():
             self.tensorboard.add_scalar('test/'+k, v, self.epoch)
+        self.report_telemetry('test')
 
         return video_top1, video_loss
 
+    def report_telemetry(self, split):
+        if self.telemetry is None:
+            return
+        self.telemetry.collect()
+        if is_main_process():
+            report = self.telemetry.report()
+            print(report)
+            with open(os.path.join(self.log_dir, 'loader_telemetry.txt'), 'a') as f:
+                f.write('Epoch %d [%s]\n%s\n\n' % (self.epoch, split, report))
+            self.telemetry.write_tensorboard(self.tensorboard, split+'_loader/', self.epoch)
+        self.telemetry.reset()
+
     def frame2_video_level_accuracy(self):
         correct = 0
         video_level_preds = np.zeros(
@@ -313,8 +493,8 @@ class Resnet2D():
         video_level_labels = torch.from_numpy(video_level_labels).long()
         video_level_preds = torch.from_numpy(video_level_preds).float()
 
-        loss = self.criterion(Variable(video_level_preds).cuda(),
-                              Variable(video_level_labels).cuda())
+        loss = self.criterion(Variable(video_level_preds).to(self.device),
+                              Variable(video_level_labels).to(self.device))
 
         top1, top5 = accuracy(
             video_level_preds, video_level_labels, topk=(1, 5))
@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+STAGES = ('layer1', 'layer2', 'layer3', 'layer4')
+
+
+def parse_stages(stages):
+    """Accepts 'layer3,layer4', ('layer3', 'layer4'), 'all' or a falsy value"""
+    if not stages:
+        return ()
+    if isinstance(stages, str):
+        stages = STAGES if stages == 'all' else [s.strip() for s in stages.split(',')]
+    stages = tuple(stages)
+    for s in stages:
+        if s not in STAGES:
+            raise ValueError('Unknown checkpoint stage "%s", expected one of %s' % (s, STAGES))
+    return stages
+
+
+class _Recompute(object):
+    # the recomputation in backward must not update the BatchNorm running
+    # statistics a second time, so they are restored after it
+    def __init__(self, block):
+        self.block = block
+        self.calls = 0
+
+    def __call__(self, x):
+        self.calls += 1
+        if self.calls == 1:
+            return self.block(x)
+        bns = [m for m in self.block.modules()
+               if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        saved = [[b.clone() for b in (m.running_mean, m.running_var, m.num_batches_tracked)]
+                 for m in bns]
+        try:
+            return self.block(x)
+        finally:
+            with torch.no_grad():
+                for m, (mean, var, tracked) in zip(bns, saved):
+                    m.running_mean.copy_(mean)
+                    m.running_var.copy_(var)
+                    m.num_batches_tracked.copy_(tracked)
+
+
+def run_stage(stage, x, use_checkpoint):
+    """Runs one residual stage, keeping only block inputs for backward if use_checkpoint.
+
+    The activations inside each block are recomputed during backward, which
+    trades one extra forward pass of the stage for its activation memory.
+    """
+    if not use_checkpoint or not stage.training or not torch.is_grad_enabled():
+        return stage(x)
+    for block in stage:
+        x = checkpoint(_Recompute(block), x, use_reentrant=False)
+    return x
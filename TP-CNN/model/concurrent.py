@@ -0,0 +1,122 @@
+import os
+import queue
+import threading
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+
+def split_cores(nb_streams, cores=None):
+    """Splits the cores this process may use into nb_streams near equal sets"""
+    cores = sorted(os.sched_getaffinity(0) if cores is None else cores)
+    if len(cores) < nb_streams:
+        # fewer cores than streams, every stream shares all of them
+        return [cores] * nb_streams
+    size, extra = divmod(len(cores), nb_streams)
+    parts, start = [], 0
+    for i in range(nb_streams):
+        end = start + size + (i < extra)
+        parts.append(cores[start:end])
+        start = end
+    return parts
+
+
+def _pin(cores):
+    # affinity and intra-op threads of the calling thread only
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def _thread_worker(module, cores, jobs, results):
+    _pin(cores)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        x, grad = job
+        try:
+            # grad mode is thread local, use the caller's
+            with torch.set_grad_enabled(grad):
+                results.put((True, module(x)))
+        except Exception:
+            results.put((False, traceback.format_exc()))
+
+
+def _process_worker(module, cores, jobs, results):
+    _pin(cores)
+    module.eval()
+    while True:
+        x = jobs.get()
+        if x is None:
+            return
+        try:
+            with torch.no_grad():
+                results.put((True, module(x)))
+        except Exception:
+            results.put((False, traceback.format_exc()))
+
+
+class StreamPool(object):
+    """Runs independent modules concurrently, each on its own set of cores.
+
+    'threads' keeps one worker thread per module, pinned to its cores with
+    as many intra-op threads, so the streams do not compete for one OpenMP
+    pool; autograd works across the threads. 'processes' keeps one spawned
+    process per module on the module's shared memory weights (later
+    load_state_dict calls are seen), inputs and outputs go through shared
+    memory, and it is inference only; spawning pays for a torch import per
+    stream and needs the `if __name__ == '__main__'` guard of the calling
+    script. The workers start on the first run() of a process, so a pool
+    survives a fork (e.g. infer.py workers).
+    """
+    def __init__(self, modules, mode='threads', cores=None):
+        if mode not in ('threads', 'processes'):
+            raise ValueError('Unknown stream mode "%s", expected threads or processes' % mode)
+        self.modules = modules
+        self.mode = mode
+        self.cores = split_cores(len(modules), cores)
+        self.pid = None
+        self.workers = []
+
+    def start(self):
+        self.pid = os.getpid()
+        self.workers = []
+        for module, cores in zip(self.modules, self.cores):
+            if self.mode == 'threads':
+                jobs, results = queue.Queue(), queue.Queue()
+                w = threading.Thread(target=_thread_worker, args=(module, cores, jobs, results))
+            else:
+                module.share_memory()
+                ctx = mp.get_context('spawn')
+                jobs, results = ctx.Queue(), ctx.Queue()
+                w = ctx.Process(target=_process_worker, args=(module, cores, jobs, results))
+            w.daemon = True
+            w.start()
+            self.workers.append((w, jobs, results))
+
+    def run(self, inputs):
+        """Outputs of every module on its input, computed concurrently"""
+        if self.mode == 'processes' and torch.is_grad_enabled():
+            raise RuntimeError('process streams are inference only, run them under torch.no_grad()')
+        if self.pid != os.getpid():
+            self.start()
+        grad = torch.is_grad_enabled()
+        for (w, jobs, results), x in zip(self.workers, inputs):
+            jobs.put((x, grad) if self.mode == 'threads' else x)
+        outputs = []
+        for w, jobs, results in self.workers:
+            ok, out = results.get()
+            if not ok:
+                raise RuntimeError('stream worker failed:\n%s' % out)
+            outputs.append(out)
+        return outputs
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        for w, jobs, results in self.workers:
+            jobs.put(None)
+        for w, jobs, results in self.workers:
+            w.join()
+        self.pid = None
+        self.workers = []
@@ -4,6 +4,7 @@ import numpy as np
 import torch.utils.model_zoo as model_zoo
 import torch
 from torch.autograd import Variable
+from model.checkpointing import parse_stages, run_stage
 
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101']
@@ -96,10 +97,13 @@ class Bottleneck(nn.Module):
 
 class ResNet(nn.Module):
 
-    def __init__(self, block, layers, nb_classes=101, channel=20, extract_feature=False):
+    def __init__(self, block, layers, nb_classes=101, channel=20, extract_feature=False,
+                 checkpoint_stages=()):
         self.inplanes = 64
         super(ResNet, self).__init__()
         self.extract_feature=extract_feature
+        # residual stages whose activations are recomputed in backward
+        self.checkpoint_stages = parse_stages(checkpoint_stages)
         self.conv1_custom = nn.Conv2d(channel, 64, kernel_size=7, stride=2, padding=3,   
                                bias=False)
         self.bn1 = nn.BatchNorm2d(64)
@@ -137,15 +141,40 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        x = self.conv1_custom(x)
+        return self.trunk(self.conv1_custom(x))
+
+    def frame_patches(self, frame):
+        """conv1_custom im2col patches of the channels of one frame.
+
+        The patches of a stack are those of its frames one after the other,
+        so each frame of overlapping windows is unfolded once and the stem of
+        a window is one matrix product, see model.streaming.IncrementalStem.
+        frame is (B, width, H, W), the result (B, width*49, H/2*W/2).
+        """
+        c = self.conv1_custom
+        return nn.functional.unfold(frame, c.kernel_size, padding=c.padding, stride=c.stride)
+
+    def stem_from_patches(self, patches, height, width):
+        """conv1_custom output of a stack of height x width frames from its patches"""
+        c = self.conv1_custom
+        # one 2D product over the batch, a broadcast matmul takes a slow batched path
+        B, K, N = patches.size()
+        out = c.weight.view(c.out_channels, K).mm(patches.transpose(0, 1).reshape(K, B * N))
+        out = out.view(c.out_channels, B,
+                       (height + 2 * c.padding[0] - c.kernel_size[0]) // c.stride[0] + 1,
+                       (width + 2 * c.padding[1] - c.kernel_size[1]) // c.stride[1] + 1)
+        return out.transpose(0, 1).contiguous()
+
+    def trunk(self, x):
+        """Everything after conv1_custom"""
         x = self.bn1(x)
         x = self.relu(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = run_stage(self.layer1, x, 'layer1' in self.checkpoint_stages)
+        x = run_stage(self.layer2, x, 'layer2' in self.checkpoint_stages)
+        x = run_stage(self.layer3, x, 'layer3' in self.checkpoint_stages)
+        x = run_stage(self.layer4, x, 'layer4' in self.checkpoint_stages)
         x = self.avgpool(x)
         
         if self.extract_feature:
@@ -6,6 +6,7 @@ from torch.autograd import Variable
 import math
 from functools import partial
 import torch.utils.model_zoo as model_zoo
+from model.checkpointing import parse_stages, run_stage
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101']
 
@@ -109,9 +110,11 @@ class Bottleneck(nn.Module):
 
 class ResNet(nn.Module):
 
-    def __init__(self, block, layers, num_classes, shortcut_type='B'):
+    def __init__(self, block, layers, num_classes, shortcut_type='B', checkpoint_stages=()):
         self.inplanes = 64
         super(ResNet, self).__init__()
+        # residual stages whose activations are recomputed in backward
+        self.checkpoint_stages = parse_stages(checkpoint_stages)
         self.conv1 = nn.Conv3d(1, 64, kernel_size=(7,7,10), stride=(1, 2, 2), # change from 3channel to 1channel
                                padding=(3, 3, 3), bias=False)
         self.bn1 = nn.BatchNorm3d(64)
@@ -160,10 +163,10 @@ class ResNet(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = run_stage(self.layer1, x, 'layer1' in self.checkpoint_stages)
+        x = run_stage(self.layer2, x, 'layer2' in self.checkpoint_stages)
+        x = run_stage(self.layer3, x, 'layer3' in self.checkpoint_stages)
+        x = run_stage(self.layer4, x, 'layer4' in self.checkpoint_stages)
 
         x = self.avgpool(x)
 
@@ -182,7 +185,7 @@ def filter2d_to_3d(key,weight2d, weight3d):
         # Modify the shape conv1 kernal to (7, 7, 10)
         c=10
         for ii in range(c):
-            weight3d[:,:,:,:,ii] = s/float(c*3)
+            weight3d[:,:,:,:,ii] = (s/float(c*3)).unsqueeze(1)
         print ('conv1 shape : (%d, %d, %d)'%(h,w,c))
     else:
         for i in range(c):
@@ -208,10 +211,10 @@ def resnet18(pretrained=False, num_classes=15, **kwargs):
     """
     model = ResNet(BasicBlock, [2, 2, 2, 2], num_classes, **kwargs)
 
-    pretrain_dict = model_zoo.load_url(model_urls['resnet18'])
-    model_dict = model.state_dict()
     #print model_dict.keys()
     if pretrained:
+        pretrain_dict = model_zoo.load_url(model_urls['resnet18'])
+        model_dict = model.state_dict()
         weight_dict = weight_trainsform(pretrain_dict,model_dict)
         model.load_state_dict(weight_dict)
 
@@ -221,9 +224,9 @@ def resnet34(pretrained=False, num_classes=15, **kwargs):
     """Constructs a ResNet-34 model.
     """
     model = ResNet(BasicBlock, [3, 4, 6, 3], num_classes, **kwargs)
-    pretrain_dict = model_zoo.load_url(model_urls['resnet34'])
-    model_dict = model.state_dict()
     if pretrained:
+        pretrain_dict = model_zoo.load_url(model_urls['resnet34'])
+        model_dict = model.state_dict()
         weight_dict = weight_trainsform(pretrain_dict,model_dict)
         model.load_state_dict(weight_dict)
     return model
@@ -233,9 +236,9 @@ def resnet50(pretrained=False, num_classes=15, **kwargs):
     """Constructs a ResNet-50 model.
     """
     model = ResNet(Bottleneck, [3, 4, 6, 3], num_classes, **kwargs)
-    pretrain_dict = model_zoo.load_url(model_urls['resnet50'])
-    model_dict = model.state_dict()
     if pretrained:
+        pretrain_dict = model_zoo.load_url(model_urls['resnet50'])
+        model_dict = model.state_dict()
         weight_dict = weight_trainsform(pretrain_dict,model_dict)
         model.load_state_dict(weight_dict)
     return model
@@ -244,9 +247,9 @@ def resnet101(pretrained=False, num_classes=15, **kwargs):
     """Constructs a ResNet-101 model.
     """
     model = ResNet(Bottleneck, [3, 4, 23, 3], num_classes, **kwargs)
-    pretrain_dict = model_zoo.load_url(model_urls['resnet101'])
-    model_dict = model.state_dict()
     if pretrained:
+        pretrain_dict = model_zoo.load_url(model_urls['resnet101'])
+        model_dict = model.state_dict()
         weight_dict = weight_trainsform(pretrain_dict,model_dict)
         model.load_state_dict(weight_dict)
     return model
@@ -0,0 +1,387 @@
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+
+
+# input_type : (frame size, channels per frame, time axis of the model input)
+LAYOUTS = {
+    'pose': (224, 1, 0),
+    'opf': (224, 2, 0),
+    'rgb': (224, 3, 0),
+    '3d_pose': (112, 1, 1),
+}
+
+
+class MirroredRing(object):
+    """The last `length` slots of a stream as one contiguous view.
+
+    Each slot is written twice, to i and i + length of a buffer twice as
+    long along `axis`, so the newest `length` slots are always adjacent in
+    stream order and reading them never copies or re-stacks.
+    """
+    def __init__(self, length, slot_shape, axis=0, device='cpu'):
+        self.length = length
+        self.width = slot_shape[axis]
+        self.axis = axis
+        shape = list(slot_shape)
+        shape[axis] *= 2 * length
+        self.buffer = torch.zeros(shape, device=device)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+
+    def push(self, x):
+        slot = (self.count % self.length) * self.width
+        for offset in (slot, slot + self.length * self.width):
+            target = self.buffer.narrow(self.axis, offset, self.width)
+            target.copy_(x.view_as(target))
+        self.count += 1
+
+    def window(self):
+        start = (self.count % self.length) * self.width
+        return self.buffer.narrow(self.axis, start, self.length * self.width)
+
+
+class IncrementalStem(object):
+    """conv1_custom outputs of sliding windows from per-frame im2col patches.
+
+    A 2D ResNet stacks the frames of a window as input channels of
+    conv1_custom, and the im2col patches of a stack are those of its frames
+    one after the other (see ResNet.frame_patches). Every frame is unfolded
+    once, when it arrives, into a MirroredRing, and the stem of the current
+    window is a single matrix product with the conv1_custom weights. Dense
+    windows no longer unfold each frame nb_per_stack times; the multiply
+    adds are those of the convolution, the weights differ per position.
+    """
+    def __init__(self, model, nb_per_stack, width, size, device='cpu'):
+        self.model = model
+        self.size = size
+        conv = model.conv1_custom
+        nb_rows = width * conv.kernel_size[0] * conv.kernel_size[1]
+        side = (size + 2 * conv.padding[0] - conv.kernel_size[0]) // conv.stride[0] + 1
+        self.patches = MirroredRing(nb_per_stack, (nb_rows, side * side), 0, device)
+
+    def reset(self):
+        self.patches.reset()
+
+    def push(self, frame):
+        """Adds a (width, size, size) frame"""
+        with torch.no_grad():
+            self.patches.push(self.model.frame_patches(frame.unsqueeze(0))[0])
+
+    def stem(self):
+        """conv1_custom output of the last nb_per_stack frames, (1, 64, size/2, size/2)"""
+        with torch.no_grad():
+            return self.model.stem_from_patches(self.patches.window().unsqueeze(0), self.size, self.size)
+
+
+def _taps(k, s, p):
+    return lambda j: range(j * s - p, j * s - p + k)
+
+
+def _mask(clean, k, s, p):
+    """Output positions of a temporal (k, s, p) op whose taps are all inside and clean"""
+    T = len(clean)
+    taps = _taps(k, s, p)
+    return [all(0 <= t < T and clean[t] for t in taps(j)) for j in range((T + 2 * p - k) // s + 1)]
+
+
+def _slice(x, offset, T, lo, hi, value=0.):
+    """Positions [lo, hi) of a level of length T, x holds [offset, offset + x.size(2))"""
+    left, right = max(0, -lo), max(0, hi - T)
+    xs = x[:, :, max(lo, 0) - offset:min(hi, T) - offset]
+    if left or right:
+        xs = F.pad(xs, (0, 0, 0, 0, left, right), value=value)
+    return xs
+
+
+def _conv(conv, x, offset, T, a, b):
+    """Outputs [a, b) of a Conv3d along time, with its zero padding at the level ends"""
+    k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+    xs = _slice(x, offset, T, a * s - p, (b - 1) * s - p + k)
+    return F.conv3d(xs, conv.weight, conv.bias, conv.stride, (0,) + tuple(conv.padding[1:]),
+                    conv.dilation, conv.groups)
+
+
+class _Stem(object):
+    def __init__(self, model):
+        self.model = model
+        c = model.conv1
+        self.mask = lambda clean: _mask(clean, c.kernel_size[0], c.stride[0], c.padding[0])
+        self.stride = c.stride[0]
+
+    def compute(self, x, a, b):
+        m = self.model
+        return m.relu(m.bn1(_conv(m.conv1, x, 0, x.size(2), a, b)))
+
+
+class _Pool(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.k, self.s, self.p = [v if isinstance(v, int) else v[0]
+                                  for v in (pool.kernel_size, pool.stride, pool.padding)]
+        self.mask = lambda clean: _mask(clean, self.k, self.s, self.p)
+        self.stride = self.s
+
+    def compute(self, x, a, b):
+        # max pooling pads with -inf
+        xs = _slice(x, 0, x.size(2), a * self.s - self.p, (b - 1) * self.s - self.p + self.k, -float('inf'))
+        spatial = lambda v: (v, v) if isinstance(v, int) else tuple(v[1:])
+        return F.max_pool3d(xs, (self.k,) + spatial(self.pool.kernel_size),
+                            (self.s,) + spatial(self.pool.stride), (0,) + spatial(self.pool.padding))
+
+
+class _Block(object):
+    # BasicBlock (conv1 3x3x3 strided, conv2 3x3x3) or Bottleneck (conv1 1x1x1,
+    # conv2 3x3x3 strided, conv3 1x1x1), plus the shortcut
+    def __init__(self, block):
+        self.block = block
+        self.convs = [block.conv1, block.conv2] + ([block.conv3] if hasattr(block, 'conv3') else [])
+        self.bns = [block.bn1, block.bn2] + ([block.bn3] if hasattr(block, 'bn3') else [])
+        self.stride = max(c.stride[0] for c in self.convs)
+
+    def mask(self, clean):
+        path = clean
+        for c in self.convs:
+            path = _mask(path, c.kernel_size[0], c.stride[0], c.padding[0])
+        shortcut = _mask(clean, 1, self.stride, 0)
+        return [p and q for p, q in zip(path, shortcut)]
+
+    def compute(self, x, a, b):
+        # walk back from the outputs [a, b) to the range every conv needs
+        T = [x.size(2)]
+        for c in self.convs:
+            T.append((T[-1] + 2 * c.padding[0] - c.kernel_size[0]) // c.stride[0] + 1)
+        ranges = [(a, b)]
+        for i in range(len(self.convs) - 1, 0, -1):
+            c = self.convs[i]
+            lo, hi = ranges[0]
+            ranges.insert(0, (max(lo * c.stride[0] - c.padding[0], 0),
+                              min((hi - 1) * c.stride[0] - c.padding[0] + c.kernel_size[0], T[i])))
+
+        out, offset = x, 0
+        for i, (c, bn) in enumerate(zip(self.convs, self.bns)):
+            lo, hi = ranges[i]
+            out = bn(_conv(c, out, offset, T[i], lo, hi))
+            if i < len(self.convs) - 1:
+                out = self.block.relu(out)
+            offset = lo
+
+        downsample = self.block.downsample
+        if downsample is None:
+            residual = x[:, :, a:b]
+        elif isinstance(downsample, nn.Sequential):
+            residual = downsample[1](_conv(downsample[0], x, 0, T[0], a, b))
+        else:
+            residual = downsample(x)[:, :, a:b]  # shortcut type A, parameter free
+        return self.block.relu(out + residual)
+
+
+def _runs(positions):
+    """[a, b) ranges of consecutive positions"""
+    runs = []
+    for j in positions:
+        if runs and runs[-1][1] == j:
+            runs[-1][1] = j + 1
+        else:
+            runs.append([j, j + 1])
+    return runs
+
+
+class TemporalReuse3D(object):
+    """Sliding-window inference of a 3D ResNet that reuses temporal activations.
+
+    Consecutive windows, `stride` frames apart, share most of their frames.
+    At every level (conv1, maxpool, each residual block) an activation is
+    copied from the previous window when it is clean in both, i.e. none of
+    the convolutions and poolings below it reached the zero (or -inf)
+    padding at the window ends, so it depends on the same frames only. The
+    time axis of a level can only be shifted when its cumulative temporal
+    stride divides `stride`, e.g. with stride 1 only conv1 is reused, with
+    stride 2 also maxpool and the blocks of layer1. The other positions are
+    computed as in the full forward, with the padding at the level ends, so
+    the logits match full recomputation up to float rounding.
+
+    The model must be in eval mode (BatchNorm uses its running statistics).
+    """
+    def __init__(self, model, nb_per_stack, stride):
+        self.model = model
+        self.stages = [_Stem(model), _Pool(model.maxpool)]
+        for layer in (model.layer1, model.layer2, model.layer3, model.layer4):
+            self.stages.extend(_Block(block) for block in layer)
+
+        clean, S = [True] * nb_per_stack, 1
+        self.nb_positions = 0
+        self.nb_reused = 0
+        for stage in self.stages:
+            clean = stage.mask(clean)
+            S *= stage.stride
+            stage.shift = stride // S if stride % S == 0 else None
+            stage.reuse = []
+            if stage.shift is not None:
+                stage.reuse = [j for j in range(len(clean) - stage.shift)
+                               if clean[j] and clean[j + stage.shift]]
+            reuse = set(stage.reuse)
+            stage.runs = _runs([j for j in range(len(clean)) if j not in reuse])
+            self.nb_positions += len(clean)
+            self.nb_reused += len(stage.reuse)
+        self.reset()
+
+    def reset(self):
+        self.cache = [None] * len(self.stages)
+
+    def __call__(self, x):
+        """Logits of the (B, 1, nb_per_stack, H, W) window `stride` frames after the last one"""
+        with torch.no_grad():
+            for i, stage in enumerate(self.stages):
+                old = self.cache[i]
+                if old is None or not stage.reuse:
+                    y = stage.compute(x, 0, len(stage.reuse) + sum(b - a for a, b in stage.runs))
+                else:
+                    y = torch.empty_like(old)
+                    index = torch.tensor(stage.reuse, device=old.device)
+                    y[:, :, index] = old[:, :, index + stage.shift]
+                    for a, b in stage.runs:
+                        y[:, :, a:b] = stage.compute(x, a, b)
+                self.cache[i] = y
+                x = y
+            m = self.model
+            x = m.avgpool(x)
+            return m.fc(x.view(x.size(0), -1))
+
+
+class StreamRecognizer(object):
+    """Online recognition over the last nb_per_stack frames of a stream.
+
+    push() takes one frame at a time (the summed heatmap of a frame for pose
+    and 3d_pose, the (x, y) flow images for opf, the image for rgb) and
+    resizes it like the datasets do. The frames are kept in a MirroredRing,
+    so the last nb_per_stack frames are always one contiguous view and
+    nothing is re-stacked. Every `stride` frames the model scores that
+    window, and push() returns the clip logits and the smoothed video level
+    prediction ('mean' of all clip logits as in the trainers' validation,
+    or 'ema' with weight `decay` on the history).
+
+    With incremental=True (2D pose and opf models) an IncrementalStem keeps
+    the unfolded frames instead, and the window's stem is one matrix product.
+    For 3d_pose models a TemporalReuse3D copies the activations the window
+    shares with the previous one.
+
+    rgb frames are center cropped, the datasets crop at random.
+    """
+    def __init__(self, model, input_type, nb_per_stack, stride=None, smoothing='mean',
+                 decay=0.8, device='cpu', incremental=False):
+        if input_type not in LAYOUTS:
+            raise ValueError('Unknown input type "%s", expected one of %s' % (input_type, sorted(LAYOUTS)))
+        if smoothing not in ('mean', 'ema'):
+            raise ValueError('Unknown smoothing "%s", expected mean or ema' % smoothing)
+        self.model = model.eval()
+        self.input_type = input_type
+        self.nb_per_stack = 1 if input_type == 'rgb' else nb_per_stack
+        self.stride = stride or self.nb_per_stack
+        self.smoothing = smoothing
+        self.decay = decay
+        self.device = torch.device(device)
+        self.size, self.width, self.axis = LAYOUTS[input_type]
+
+        self.stem = None
+        self.reuse = None
+        if incremental and input_type != '3d_pose':
+            if input_type not in ('pose', 'opf') or not hasattr(model, 'frame_patches'):
+                raise ValueError('incremental stems need a 2D ResNet on pose or opf stacks')
+            self.stem = IncrementalStem(model, self.nb_per_stack, self.width, self.size, self.device)
+            self.frames = self.stem
+        else:
+            if incremental:
+                self.reuse = TemporalReuse3D(model, self.nb_per_stack, self.stride)
+            slot = [self.width, self.size, self.size]
+            if self.axis == 1:
+                slot.insert(0, 1)
+            self.frames = MirroredRing(self.nb_per_stack, slot, self.axis, self.device)
+        # the test time crop of whole frames, the datasets resize Bbox crops to 224 instead
+        self.rgb_crop = transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+        ])
+        self.rgb_normalize = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ])
+        self.reset()
+
+    def reset(self):
+        """Starts a new stream"""
+        self.nb_frames = 0
+        self.nb_clips = 0
+        self.smoothed = None
+        self.latency = []  # (seconds, scored) of every push
+        self.frames.reset()
+        if self.reuse is not None:
+            self.reuse.reset()
+
+    def preprocess(self, frame, bbox=None):
+        """(width, size, size) tensor of one frame, as the datasets build it"""
+        if self.input_type == 'rgb':
+            img = frame if isinstance(frame, Image.Image) else Image.fromarray(frame)
+            if bbox is not None:
+                return self.rgb_normalize(img.crop(bbox).resize([224, 224]))
+            return self.rgb_normalize(self.rgb_crop(img))
+        planes = frame if self.input_type == 'opf' else (frame,)
+        out = np.zeros((self.width, self.size, self.size))
+        for c, plane in enumerate(planes):
+            img = plane if isinstance(plane, Image.Image) else Image.fromarray(np.asarray(plane))
+            if bbox is not None:
+                img = img.crop(bbox)
+            out[c] = img.resize([self.size, self.size])
+        return torch.from_numpy(out).float().div(255)
+
+    def window(self):
+        """The model input of the last nb_per_stack frames, a view of the ring"""
+        return self.frames.window().unsqueeze(0)
+
+    def score(self):
+        with torch.no_grad():
+            if self.stem is not None:
+                return self.model.trunk(self.stem.stem())[0]
+            if self.reuse is not None:
+                return self.reuse(self.window())[0]
+            return self.model(self.window())[0]
+
+    def push(self, frame, bbox=None):
+        """Adds one frame, returns (clip logits, smoothed probabilities) or None"""
+        start = time.time()
+        x = self.preprocess(frame, bbox).to(self.device, non_blocking=True)
+        self.frames.push(x)
+        self.nb_frames += 1
+
+        result = None
+        if self.nb_frames >= self.nb_per_stack and (self.nb_frames - self.nb_per_stack) % self.stride == 0:
+            logits = self.score()
+            self.nb_clips += 1
+            if self.smoothed is None:
+                self.smoothed = logits.clone()
+            elif self.smoothing == 'mean':
+                self.smoothed += (logits - self.smoothed) / self.nb_clips
+            else:
+                self.smoothed = self.decay * self.smoothed + (1 - self.decay) * logits
+            result = (logits, F.softmax(self.smoothed, 0))
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+        self.latency.append((time.time() - start, result is not None))
+        return result
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """Milliseconds per push, for all pushes and for those that scored a clip"""
+        report = {}
+        for name, keep in (('frame', lambda scored: True), ('scored', lambda scored: scored),
+                           ('buffered', lambda scored: not scored)):
+            ms = np.array([1000. * s for s, scored in self.latency if keep(scored)])
+            if len(ms):
+                report[name] = dict(('p%d' % p, float(np.percentile(ms, p))) for p in percentiles)
+                report[name].update({'mean': float(ms.mean()), 'max': float(ms.max()), 'count': len(ms)})
+        return report
@@ -0,0 +1,108 @@
+# Inference-only runtime for models written by export.py
+# Usage (from anywhere, only torch and numpy are needed, onnxruntime for .onnx):
+#   python runtime.py --artifact=export/pose_L15.pt --batch_size=4
+#
+#   from runtime import load
+#   model = load('export/pose_L15.pt')
+#   logits = model(x)                     # x: (clips,) + model.meta['inputs'][0]['shape'][1:]
+#   logits = model(rgb=rgb, opf=opf)      # Fusion_net
+#
+# Nothing of the training code is imported (no utils.config, tensorboardX,
+# torchvision or the model factories). The metadata of an artifact
+# (input names and shapes, input type, stack length, resolution, channels
+# per frame, pixel scaling and normalization) is embedded in TorchScript
+# files and written next to ONNX files as <artifact>.json. Run as a script
+# it reports the import, load and forward times and the modules it loaded.
+import sys
+import json
+import time
+_start = time.time()
+import numpy as np
+import torch
+IMPORT_SEC = time.time() - _start  # numpy and torch
+
+
+class Runtime(object):
+    """An exported model with its metadata, called like the eager model"""
+    def __init__(self, path, threads=0):
+        if threads:
+            torch.set_num_threads(threads)
+        self.path = path
+        if path.endswith('.onnx'):
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError('running ONNX models needs onnxruntime, pip install onnxruntime')
+            with open(path + '.json') as f:
+                self.meta = json.load(f)
+            options = onnxruntime.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            extra = {'meta.json': ''}
+            self.module = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+            self.module.eval()
+            self.meta = json.loads(extra['meta.json'])
+            self.session = None
+        self.names = [i['name'] for i in self.meta['inputs']]
+
+    def __call__(self, *args, **kwargs):
+        """Logits (numpy) of a batch of clips, inputs by position or by name"""
+        inputs = list(args) + [kwargs[name] for name in self.names[len(args):]]
+        if len(inputs) != len(self.names):
+            raise ValueError('expected the inputs %s' % ', '.join(self.names))
+        if self.session is not None:
+            feed = dict((name, np.asarray(x, np.float32)) for name, x in zip(self.names, inputs))
+            return self.session.run(None, feed)[0]
+        inputs = [torch.as_tensor(np.asarray(x, np.float32)) for x in inputs]
+        with torch.no_grad():
+            out = self.module(inputs[0] if len(inputs) == 1 else tuple(inputs))
+        return out.numpy()
+
+    def random_inputs(self, batch_size, seed=0):
+        rng = np.random.RandomState(seed)
+        return [rng.rand(batch_size, *i['shape'][1:]).astype(np.float32) for i in self.meta['inputs']]
+
+
+def load(path, threads=0):
+    return Runtime(path, threads)
+
+
+def main(artifact, batch_size=1, nb_iters=10, warmup=2, threads=0):
+    start = time.time()
+    model = load(artifact, threads)
+    load_sec = time.time() - start
+    inputs = model.random_inputs(batch_size)
+    for _ in range(warmup):
+        model(*inputs)
+    start = time.time()
+    for _ in range(nb_iters):
+        model(*inputs)
+    forward_ms = 1000. * (time.time() - start) / nb_iters
+
+    # tqdm is not in the list, torch imports it
+    training = sorted(m for m in ('tensorboardX', 'torchvision', 'utils.config', 'main', 'Fusion', 'evaluate')
+                      if m in sys.modules)
+    print('==> %s: %s %s L=%d, %d classes' % (
+        artifact, model.meta['model'], model.meta['input_type'], model.meta['nb_per_stack'],
+        model.meta['nb_classes']))
+    print('    import %.2f sec, load %.2f sec, forward %.1f ms for %d clips' % (
+        IMPORT_SEC, load_sec, forward_ms, batch_size))
+    print('    %d modules loaded, training modules: %s' % (len(sys.modules), ', '.join(training) or 'none'))
+    return {'import_sec': IMPORT_SEC, 'load_sec': load_sec, 'forward_ms': forward_ms,
+            'nb_modules': len(sys.modules), 'training_modules': training}
+
+
+if __name__ == '__main__':
+    # argparse rather than fire, the runtime needs torch and numpy only
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a model exported by export.py')
+    parser.add_argument('--artifact', required=True)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--nb_iters', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=0)
+    args = parser.parse_args()
+    main(args.artifact, args.batch_size, args.nb_iters, args.warmup, args.threads)
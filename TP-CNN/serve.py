@@ -0,0 +1,287 @@
+# Dynamic batching inference server for a trained checkpoint, over local HTTP
+# Usage (from TP-CNN/):
+#   python serve.py --checkpoint=record/pose_L15/model_best.pth.tar --port=8500 --max_batch=16 --max_wait_ms=10 \
+#       --device=cpu
+#   python -m benchmark.serving --port=8500 --concurrency='(1,4,16)'
+#
+# POST /predict takes an .npz with the model input of one or more clips
+# ('x', or 'rgb' and 'opf' for a Fusion_net, each with the clip dimension
+# first, see GET /info for the shapes) and answers JSON with their logits.
+# Requests wait in one queue; a batch is closed when it has --max_batch
+# clips or --max_wait_ms after its first request arrived, whichever comes
+# first, and runs as one forward pass. GET /stats has the served requests
+# and clips, throughput, queue depth, batch sizes and latency percentiles
+# (queue wait and total time in the server). Client below talks to it.
+import io
+import json
+import time
+import queue
+import threading
+import collections
+import http.client
+import numpy as np
+import torch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.config import opt
+from evaluate import load_checkpoint, input_key, _to
+
+
+def input_shapes(key):
+    """{input name: shape of one clip} of a model input key"""
+    kind, nb_per_stack, _ = key
+    if kind == 'fusion':
+        return {'rgb': (3, 224, 224), 'opf': (2 * nb_per_stack, 224, 224)}
+    if kind == '3d_pose':
+        return {'x': (1, nb_per_stack, 112, 112)}
+    channels = {'pose': nb_per_stack, 'opf': 2 * nb_per_stack, 'rgb': 3}[kind]
+    return {'x': (channels, 224, 224)}
+
+
+def _percentiles(values, percentiles=(50, 90, 99)):
+    if not values:
+        return {}
+    ms = 1000. * np.array(values)
+    report = dict(('p%d' % p, float(np.percentile(ms, p))) for p in percentiles)
+    report.update({'mean': float(ms.mean()), 'max': float(ms.max())})
+    return report
+
+
+class _Request(object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.size = inputs[0].size(0)
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class DynamicBatcher(object):
+    """Groups queued requests into batches of up to max_batch clips.
+
+    A batch closes when it is full or max_wait seconds after its oldest
+    request arrived; a request is never split, so a batch may be smaller
+    than max_batch when the next request does not fit.
+    """
+    def __init__(self, model, names, max_batch=16, max_wait=0.01, device='cpu', window=10000):
+        self.model = model
+        self.names = names
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.device = torch.device(device)
+        self.requests = queue.Queue()
+        self.pending = None  # a request that did not fit in the last batch
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.nb_requests = 0
+        self.nb_clips = 0
+        self.nb_batches = 0
+        self.batch_sizes = collections.Counter()
+        self.queue_depth = collections.deque(maxlen=window)
+        self.wait_sec = collections.deque(maxlen=window)
+        self.total_sec = collections.deque(maxlen=window)
+        self.compute_sec = collections.deque(maxlen=window)
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, inputs):
+        """Logits of the clips of one request, blocks until its batch ran"""
+        request = _Request(inputs)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.output
+
+    def _gather(self):
+        first = self.pending if self.pending is not None else self.requests.get()
+        self.pending = None
+        batch, size = [first], first.size
+        deadline = first.arrival + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                request = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if size + request.size > self.max_batch:
+                self.pending = request
+                break
+            batch.append(request)
+            size += request.size
+        return batch, size
+
+    def _loop(self):
+        while True:
+            batch, size = self._gather()
+            closed = time.time()
+            depth = self.requests.qsize() + (self.pending is not None)
+            try:
+                inputs = [torch.cat([r.inputs[i] for r in batch]) for i in range(len(self.names))]
+                x = inputs[0] if len(inputs) == 1 else tuple(inputs)
+                with torch.no_grad():
+                    output = self.model(_to(x, self.device)).float().cpu()
+                offset = 0
+                for r in batch:
+                    r.output = output[offset:offset + r.size]
+                    offset += r.size
+            except Exception as e:
+                for r in batch:
+                    r.error = '%s: %s' % (type(e).__name__, e)
+            end = time.time()
+            with self.lock:
+                self.nb_requests += len(batch)
+                self.nb_clips += size
+                self.nb_batches += 1
+                self.batch_sizes[size] += 1
+                self.queue_depth.append(depth)
+                self.compute_sec.append(end - closed)
+                for r in batch:
+                    self.wait_sec.append(closed - r.arrival)
+                    self.total_sec.append(end - r.arrival)
+            for r in batch:
+                r.done.set()
+
+    def stats(self):
+        with self.lock:
+            uptime = time.time() - self.start
+            return {
+                'uptime_sec': uptime,
+                'requests': self.nb_requests,
+                'clips': self.nb_clips,
+                'batches': self.nb_batches,
+                'clips_per_sec': self.nb_clips / max(uptime, 1e-9),
+                'mean_batch': self.nb_clips / max(self.nb_batches, 1),
+                'batch_sizes': dict((str(k), v) for k, v in sorted(self.batch_sizes.items())),
+                'queue_depth': {'now': self.requests.qsize() + (self.pending is not None),
+                                'mean': float(np.mean(self.queue_depth)) if self.queue_depth else 0.,
+                                'max': int(max(self.queue_depth)) if self.queue_depth else 0},
+                'queue_ms': _percentiles(list(self.wait_sec)),
+                'server_ms': _percentiles(list(self.total_sec)),
+                'batch_compute_ms': _percentiles(list(self.compute_sec)),
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.start = time.time()
+            self.nb_requests = self.nb_clips = self.nb_batches = 0
+            self.batch_sizes.clear()
+            for d in (self.queue_depth, self.wait_sec, self.total_sec, self.compute_sec):
+                d.clear()
+
+
+def make_handler(batcher, info):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, clients reuse their connection
+
+        def _reply(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, code, obj):
+            self._reply(code, json.dumps(obj).encode())
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._json(200, batcher.stats())
+            elif self.path == '/info':
+                self._json(200, info)
+            else:
+                self._json(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/reset':
+                batcher.reset_stats()
+                return self._json(200, {})
+            if self.path != '/predict':
+                return self._json(404, {'error': 'unknown path %s' % self.path})
+            try:
+                with np.load(io.BytesIO(body)) as f:
+                    inputs = [torch.from_numpy(np.asarray(f[name], np.float32)) for name in batcher.names]
+                for name, x in zip(batcher.names, inputs):
+                    if tuple(x.shape[1:]) != tuple(info['shapes'][name]) or x.size(0) != inputs[0].size(0):
+                        raise ValueError('%s has shape %s, expected (clips, %s)' % (
+                            name, tuple(x.shape), ', '.join(str(s) for s in info['shapes'][name])))
+            except Exception as e:
+                return self._json(400, {'error': '%s: %s' % (type(e).__name__, e)})
+            try:
+                logits = batcher.submit(inputs)
+            except RuntimeError as e:
+                return self._json(500, {'error': str(e)})
+            self._json(200, {'logits': logits.tolist()})
+
+        def log_message(self, format, *args):
+            pass  # one line per request would dominate the output
+
+    return Handler
+
+
+class Client(object):
+    """Keep-alive connection to a serve.py server"""
+    def __init__(self, host='127.0.0.1', port=8500, timeout=60):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, body=None):
+        self.connection.request(method, path, body)
+        response = self.connection.getresponse()
+        out = json.loads(response.read().decode())
+        if response.status != 200:
+            raise RuntimeError('%s %s failed (%d): %s' % (method, path, response.status, out.get('error')))
+        return out
+
+    def predict(self, **inputs):
+        """Logits of the clips in inputs, e.g. predict(x=clips) or predict(rgb=..., opf=...)"""
+        buf = io.BytesIO()
+        np.savez(buf, **dict((k, np.asarray(v, np.float32)) for k, v in inputs.items()))
+        return np.array(self._request('POST', '/predict', buf.getvalue())['logits'], np.float32)
+
+    def info(self):
+        return self._request('GET', '/info')
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+    def reset_stats(self):
+        return self._request('POST', '/reset')
+
+    def close(self):
+        self.connection.close()
+
+
+def main(checkpoint, host='127.0.0.1', port=8500, max_batch=16, max_wait_ms=10., threads=0, **kwargs):
+    opt._parse(kwargs)
+    if threads:
+        torch.set_num_threads(threads)
+    cfg, model, meta = load_checkpoint(checkpoint)
+    device = torch.device(opt.device)
+    model = model.to(device)
+    key = input_key(cfg)
+    shapes = input_shapes(key)
+    names = ['rgb', 'opf'] if key[0] == 'fusion' else ['x']
+    info = {'checkpoint': checkpoint, 'model': cfg.model, 'input': key[0], 'nb_per_stack': key[1],
+            'use_Bbox': key[2], 'nb_classes': cfg.nb_classes, 'shapes': shapes,
+            'max_batch': max_batch, 'max_wait_ms': max_wait_ms}
+
+    batcher = DynamicBatcher(model, names, max_batch, max_wait_ms / 1000., device)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, info))
+    server.daemon_threads = True
+    print('==> serving %s %s L=%d on http://%s:%d, batches of up to %d clips within %.1f ms' % (
+        cfg.model, key[0], key[1], host, port, max_batch, max_wait_ms))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('==> %s' % json.dumps(batcher.stats()))
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,108 @@
+# Online recognition of recorded videos, replayed one frame at a time
+# Usage (from TP-CNN/):
+#   python stream.py --checkpoint=record/pose_L15/model_best.pth.tar --videos='(0007,0008)' --stride=5 \
+#       --data_root=/path/to/Penn_Action/ --dic_path=/path/to/train_test_split --device=cpu
+#
+# Each frame (heatmap, flow pair or image) is read from data_root when it
+# is pushed, like from a live source, into a model.streaming.StreamRecognizer.
+# Every --stride frames it prints the running video level prediction. At the
+# end it reports per-frame latency percentiles, split into pushes that only
+# buffered the frame and pushes that also scored a clip, and checks that the
+# clips starting where the test sampling starts (every nb_per_stack frames)
+# give the logits of the dataset clips (pose, opf and 3d_pose without Bbox,
+# rgb with Bbox; whole rgb frames are randomly cropped by the dataset, and
+# as it also flips rgb test clips at random, the closer of a clip and its
+# mirror is compared).
+# --incremental=True assembles the stems of 2D pose and opf windows frame by
+# frame (model.streaming.IncrementalStem) and reuses the temporal activations
+# of 3d_pose windows (model.streaming.TemporalReuse3D). See benchmark/streaming.py for
+# model latencies without data.
+import json
+import numpy as np
+import torch
+from utils.config import opt
+from data.dataloader import DataLoader as DLoader
+from data.PennAction_dataset import PennActionDataset
+from evaluate import load_checkpoint, input_key, _as_list
+from model.streaming import StreamRecognizer
+
+
+def read_frame(db, video, index):
+    """The raw frame `index` (1 based) of a video, what a live source would deliver"""
+    if db.input_type in ('pose', '3d_pose'):
+        return db.load_heatmap(db.data_root + 'heatmap/' + video + '/' + str(index).zfill(6) + '.mat')
+    if db.input_type == 'opf':
+        path = db.data_root + 'flownet2.0/dense_opf/' + video + '/%s' + str(index).zfill(6) + '.jpg'
+        return (db.open_image(path % 'x', 'opf'), db.open_image(path % 'y', 'opf'))
+    return db.open_image(db.data_root + 'frames/' + video + '/' + str(index).zfill(6) + '.jpg', 'rgb')
+
+
+def main(checkpoint, videos='test', stride=None, smoothing='mean', decay=0.8, incremental=False,
+         check=True, output='stream.json', **kwargs):
+    opt._parse(kwargs)
+    cfg, model, meta = load_checkpoint(checkpoint)
+    kind, L, use_Bbox = input_key(cfg)
+    device = torch.device(opt.device)
+    model = model.to(device)
+    recognizer = StreamRecognizer(model, kind, L, stride=stride, smoothing=smoothing,
+                                  decay=decay, device=device, incremental=incremental)
+    print('==> %s %s L=%d, a clip every %d frames, %s smoothing%s' % (
+        cfg.model, kind, L, recognizer.stride, smoothing, ', incremental' if incremental else ''))
+
+    data_loader = DLoader(cfg)
+    labels = dict(data_loader.train_video, **data_loader.test_video)
+    names = sorted(data_loader.test_video) if videos == 'test' else [str(v) for v in _as_list(videos)]
+    db = PennActionDataset({}, use_Bbox, 'test', kind, L, data_root=cfg.data_root)
+    check = check and (kind == 'rgb') == bool(use_Bbox)
+
+    results, latency, max_diff = [], [], 0.
+    for video in names:
+        recognizer.reset()
+        # the frames a clip of the test sampling may reach, see test_frame_sampling
+        nb_frames = int(data_loader.frame_count[video]) - 1
+        for index in range(1, nb_frames + 1):
+            bbox = None
+            if use_Bbox:
+                bbox = db.load_bbox(cfg.data_root + 'labels/' + video + '.mat')[index - 1]
+            out = recognizer.push(read_frame(db, video, index), bbox)
+            if out is None:
+                continue
+            logits, probs = out
+            first = index - recognizer.nb_per_stack + 1
+            print('    %s frames %4d-%4d: clip %2d, video %2d (%.2f)' % (
+                video, first, index, int(logits.argmax()) + 1, int(probs.argmax()) + 1, float(probs.max())))
+            if check and (first - 1) % L == 0 and first - 1 < nb_frames - L:
+                with torch.no_grad():
+                    clip = getattr(db, db.input_type_zoo[kind])(video, first).unsqueeze(0).to(device)
+                    clips = [clip, clip.flip(-1)] if kind == 'rgb' else [clip]
+                    max_diff = max(max_diff, min(float((model(c)[0] - logits).abs().max()) for c in clips))
+        latency.extend(recognizer.latency)
+        label = int(labels.get(video, 0))
+        pred = None if recognizer.smoothed is None else int(recognizer.smoothed.argmax()) + 1
+        results.append({'video': video, 'label': label, 'prediction': pred,
+                        'nb_frames': recognizer.nb_frames, 'nb_clips': recognizer.nb_clips})
+        print('==> %s: label %d, prediction %s after %d clips' % (video, label, pred, recognizer.nb_clips))
+
+    recognizer.latency = latency
+    report = recognizer.latency_percentiles()
+    for name, r in sorted(report.items()):
+        print('    %-9s %6d pushes  p50 %8.2f  p90 %8.2f  p99 %8.2f  max %8.2f ms' % (
+            name, r['count'], r['p50'], r['p90'], r['p99'], r['max']))
+    labelled = [r for r in results if r['label'] > 0 and r['prediction'] is not None]
+    if labelled:
+        print('==> video Prec@1 %.2f over %d videos' % (
+            100. * np.mean([r['label'] == r['prediction'] for r in labelled]), len(labelled)))
+    if check:
+        print('==> max |logit| difference to the dataset clips: %.3g' % max_diff)
+
+    with open(output, 'w') as f:
+        json.dump({'checkpoint': checkpoint, 'input': kind, 'nb_per_stack': L,
+                   'stride': recognizer.stride, 'smoothing': smoothing,
+                   'incremental': incremental, 'latency_ms': report,
+                   'max_diff': max_diff if check else None, 'videos': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,167 @@
+# Run a grid of main.py configurations concurrently on one machine
+# Usage (from TP-CNN/):
+#   python sweep.py --input_type='(pose,opf)' --nb_per_stack='(5,15)' --use_Bbox='(False,True)' \
+#       --model='(resnet18,resnet50)' --concurrency=4 --nb_epochs=20 --num_workers=2
+#
+# Every run gets its own slice of the CPU cores (its DataLoader workers
+# inherit it) and its own folder under sweep_dir for the log, tensorboard
+# runs/ and record/. All runs read through one DecodedCache (--cache_dir),
+# so each frame, flow image and heatmap is decoded once for the whole sweep.
+# Other options are passed through to main.py unchanged.
+import os
+import sys
+import json
+import time
+import glob
+import datetime
+import itertools
+import subprocess
+import torch
+
+
+def _as_tuple(v):
+    # fire leaves lists it cannot parse, e.g. '(pose,3d_pose)', as one string
+    if isinstance(v, str):
+        return tuple(s.strip() for s in v.strip('()[]').split(','))
+    return tuple(v) if isinstance(v, (tuple, list)) else (v,)
+
+
+def grid(input_type, nb_per_stack, use_Bbox, model):
+    for kind, L, bbox, arch in itertools.product(
+            _as_tuple(input_type), _as_tuple(nb_per_stack), _as_tuple(use_Bbox), _as_tuple(model)):
+        if kind == 'rgb' and L != 1:
+            continue  # rgb data only support nb_per_stack = 1
+        name = '%s_%s_L%d%s' % (arch, kind, L, '_Bbox' if bbox else '')
+        yield name, {'input_type': kind, 'nb_per_stack': L, 'use_Bbox': bbox, 'model': arch}
+
+
+def partition(cores, nb_slots):
+    """Splits the cores into nb_slots disjoint, near equal sets (shared if too few)"""
+    if nb_slots >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(nb_slots)]
+    size, extra = divmod(len(cores), nb_slots)
+    slots, start = [], 0
+    for i in range(nb_slots):
+        end = start + size + (1 if i < extra else 0)
+        slots.append(cores[start:end])
+        start = end
+    return slots
+
+
+def read_result(run_dir):
+    # the trainers keep the best video level Prec@1 in every checkpoint
+    best, epoch = None, None
+    for path in glob.glob(os.path.join(run_dir, 'record', '*', 'checkpoint.pth.tar')):
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        best, epoch = checkpoint['best_prec1'], checkpoint['epoch'] + 1
+    return best, epoch
+
+
+class Run(object):
+    def __init__(self, name, config, run_dir):
+        self.name = name
+        self.config = config
+        self.run_dir = run_dir
+        self.process = None
+        self.cores = None
+        self.start = None
+        self.wall = None
+
+    def launch(self, script, cores, extra):
+        self.cores = cores
+        if not os.path.isdir(self.run_dir):
+            os.makedirs(self.run_dir)
+        args = dict(extra, **self.config)
+        cmd = [sys.executable, script] + ['--%s=%s' % (k, v) for k, v in sorted(args.items())]
+
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(len(cores))
+        self.log = open(os.path.join(self.run_dir, 'log.txt'), 'w')
+        self.log.write(' '.join(cmd) + '\n')
+        self.log.flush()
+        self.start = time.time()
+        self.process = subprocess.Popen(
+            cmd, cwd=self.run_dir, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+            preexec_fn=lambda: os.sched_setaffinity(0, cores))
+
+    def poll(self):
+        if self.process.poll() is None:
+            return False
+        self.wall = time.time() - self.start
+        self.log.close()
+        return True
+
+    def summary(self):
+        best, epochs = read_result(self.run_dir)
+        info = {'name': self.name, 'returncode': self.process.returncode,
+                'best_prec1': best, 'epochs': epochs, 'wall_sec': self.wall,
+                'cores': len(self.cores), 'run_dir': self.run_dir}
+        info.update(self.config)
+        return info
+
+
+def format_table(results):
+    lines = ['%-34s %6s %10s %7s %10s %6s' % (
+        'run', 'status', 'Prec@1', 'epochs', 'wall min', 'cores')]
+    key = lambda r: -1 if r['best_prec1'] is None else r['best_prec1']
+    for r in sorted(results, key=key, reverse=True):
+        lines.append('%-34s %6s %10s %7s %10.1f %6d' % (
+            r['name'], 'ok' if r['returncode'] == 0 else 'rc=%d' % r['returncode'],
+            '-' if r['best_prec1'] is None else '%.4f' % r['best_prec1'],
+            '-' if r['epochs'] is None else r['epochs'],
+            r['wall_sec'] / 60., r['cores']))
+    return '\n'.join(lines)
+
+
+def main(input_type=('pose',), nb_per_stack=(15,), use_Bbox=(False,), model=('resnet50',),
+         concurrency=2, sweep_dir=None, cache_dir=None, script='main.py', **kwargs):
+    script = os.path.abspath(script)
+    if sweep_dir is None:
+        sweep_dir = os.path.join('sweeps', datetime.datetime.now().strftime('%b%d_%H%M%S'))
+    sweep_dir = os.path.abspath(sweep_dir)
+    if cache_dir is None:
+        cache_dir = os.path.join(sweep_dir, 'decoded_cache')
+    kwargs['cache_dir'] = os.path.abspath(cache_dir)
+
+    pending = [Run(name, cfg, os.path.join(sweep_dir, name))
+               for name, cfg in grid(input_type, nb_per_stack, use_Bbox, model)]
+    cores = sorted(os.sched_getaffinity(0))
+    slots = partition(cores, min(concurrency, len(pending)))
+    print('==> %d runs, %d at a time on %d cores, in %s' % (
+        len(pending), len(slots), len(cores), sweep_dir))
+
+    running, done = {}, []
+    sweep_start = time.time()
+    try:
+        while pending or running:
+            for slot in range(len(slots)):
+                if slot not in running and pending:
+                    run = pending.pop(0)
+                    run.launch(script, slots[slot], kwargs)
+                    running[slot] = run
+                    print('==> start %s on cores %s' % (run.name, slots[slot]))
+            time.sleep(1)
+            for slot, run in list(running.items()):
+                if run.poll():
+                    del running[slot]
+                    done.append(run.summary())
+                    print('==> done  %s in %.1f min (rc=%d)' % (
+                        run.name, run.wall / 60., run.process.returncode))
+    except KeyboardInterrupt:
+        for run in running.values():
+            run.process.terminate()
+        raise
+
+    table = format_table(done)
+    print(table)
+    print('==> sweep wall time %.1f min' % ((time.time() - sweep_start) / 60.))
+    with open(os.path.join(sweep_dir, 'summary.txt'), 'w') as f:
+        f.write(table + '\n')
+    with open(os.path.join(sweep_dir, 'summary.json'), 'w') as f:
+        json.dump(done, f, indent=2)
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,49 @@
+import time
+import warnings
+import torch
+
+
+class TrainStep(object):
+    """Forward and loss of a training step, captured with torch.compile.
+
+    The trainers call it instead of model(x) and criterion(output, target);
+    AOTAutograd also compiles the matching backward, which runs on
+    loss.backward() as usual, and the optimizer step stays eager. The first
+    call traces and compiles (compile_sec); when that fails, or torch has no
+    torch.compile, the step warns once and stays eager (fallback has why).
+    Changed input shapes, e.g. the last smaller batch, recompile once.
+    """
+    def __init__(self, model, criterion, mode='default', verbose=True):
+        self.model = model
+        self.criterion = criterion
+        self.verbose = verbose
+        self.compile_sec = None
+        self.fallback = None
+        self.compiled = None
+        if not hasattr(torch, 'compile'):
+            self.fallback = 'torch %s has no torch.compile' % torch.__version__
+        else:
+            self.compiled = torch.compile(self._step, mode=None if mode == 'default' else mode)
+
+    def _step(self, x, target):
+        output = self.model(x)
+        return output, self.criterion(output, target)
+
+    def __call__(self, x, target):
+        if self.compiled is None:
+            return self._step(x, target)
+        if self.compile_sec is not None:
+            return self.compiled(x, target)
+
+        start = time.time()
+        try:
+            out = self.compiled(x, target)
+        except Exception as e:
+            self.fallback = '%s: %s' % (type(e).__name__, (str(e).splitlines() or [''])[0])
+            self.compiled = None
+            warnings.warn('torch.compile failed, training steps stay eager (%s)' % self.fallback)
+            return self._step(x, target)
+        self.compile_sec = time.time() - start
+        if self.verbose:
+            print('==> compiled the training step in %.1f sec' % self.compile_sec)
+        return out
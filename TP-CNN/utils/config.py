@@ -19,17 +19,44 @@ class Config:
     input_type = 'pose'
     use_Bbox = False
     nb_per_stack = 15
+    Fusion = False
+    data_root = '/home/ubuntu/data/PennAction/Penn_Action/'
+    cache_dir = ''  # shared cache of decoded frames and heatmaps, see data/cache.py
+    test_clips = 0  # clips per test video, 0 takes one every nb_per_stack frames
+    test_sampling = 'uniform'  # where the test_clips are: 'uniform' or 'stratified'
+    stream_parallel = ''  # run the two Fusion_net streams of evaluate.py / infer.py concurrently: 'threads' or 'processes'
 
     #model
     model = 'resnet50'
     nb_classes = 15
+    checkpoint_stages = ''  # e.g. 'layer3,layer4' or 'all', recompute their activations in backward
+    compile = False  # torch.compile the forward and loss of training steps, eager fallback, see utils/compiled.py
+    compile_mode = 'default'  # torch.compile mode: 'default', 'reduce-overhead' or 'max-autotune'
 
     #record
     record_path = 'record'
+    async_save = True  # write checkpoints from a background thread
+    keep_last = 0  # keep the last N epoch checkpoints, 0 keeps only checkpoint.pth.tar
+    save_freq = 0  # steps between mid-epoch training state checkpoints, 0 disables
     dic_path = '/home/ubuntu/data/PennAction/Penn_Action/train_test_split/'
 
     #utils
     num_workers = 8
+    print_freq = 20  # steps between host syncs of the running metrics
+    timing = False  # per-stage step and clip loading timing, see utils/timer.py
+    trace_steps = 0  # capture a profiler trace of this many steps in the first epoch
+    trace_start = 10  # first step of the profiler trace
+    telemetry = False  # per-worker DataLoader telemetry and slowest sample report
+    autotune = False  # pick batch_size and num_workers with a short calibration, see utils/tuner.py
+    tune_max_batch = 128  # largest batch size the tuner tries
+    tune_steps = 3  # timed steps (and loader batches) per tuner probe
+    tune_memory_fraction = 0.8  # share of device / host memory a training step may use
+    tuned = None  # filled by the tuner with its measurements and decision
+
+    #distributed, see utils/distributed.py
+    device = 'cuda'  # 'cpu' for CPU-only nodes
+    distributed = False  # one process per device, launched by torchrun
+    dist_backend = 'gloo'  # 'nccl' for multi GPU
 
     def _parse(self, kwargs):
         state_dict = self._state_dict()
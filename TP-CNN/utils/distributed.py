@@ -0,0 +1,134 @@
+# Multi-process data parallel helpers
+# Launch one process per core (or GPU) with torchrun, e.g. on a CPU node:
+#   torchrun --nproc_per_node=4 main.py --distributed=True --device=cpu --num_workers=2
+# and across nodes:
+#   torchrun --nnodes=2 --node_rank=0 --master_addr=node0 --nproc_per_node=4 main.py ...
+#
+# opt.batch_size is the batch of every process, the global batch is
+# batch_size * world_size.
+import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(opt):
+    """Joins the process group started by torchrun and picks this process' device"""
+    if not opt.distributed:
+        return torch.device(opt.device)
+    if 'RANK' not in os.environ:
+        raise ValueError('--distributed=True expects to be launched by torchrun')
+
+    dist.init_process_group(backend=opt.dist_backend, init_method='env://')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+
+    # split the cores of a node between its processes
+    local_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
+
+    if opt.device == 'cuda':
+        torch.cuda.set_device(local_rank)
+        return torch.device('cuda', local_rank)
+    return torch.device(opt.device)
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj):
+    """rank 0's obj on every rank"""
+    if is_distributed():
+        objs = [obj]
+        dist.broadcast_object_list(objs, src=0)
+        obj = objs[0]
+    return obj
+
+
+def shared_seed():
+    """A random seed drawn on rank 0 and shared by every rank"""
+    return broadcast_object(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+
+def wrap_model(model, device):
+    if not is_distributed():
+        return model
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids)
+
+
+def unwrap_model(model):
+    # checkpoints keep the plain module keys so they load without DDP
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def broadcast_buffers(model):
+    """Copies rank 0's BatchNorm running statistics to every rank.
+
+    DDP only broadcasts buffers before a training forward, so after the last
+    step of an epoch every rank holds its own running statistics.
+    """
+    if not is_distributed():
+        return
+    for buf in model.buffers():
+        dist.broadcast(buf, src=0)
+
+
+def all_reduce_meter(meter, device):
+    """Sums the loss / top-k counts of a MetricMeter over every rank"""
+    if not is_distributed():
+        return
+    sums = torch.zeros(2 + len(meter.topk), device=device)
+    if meter.count:
+        sums[0] = meter.loss_sum.detach()
+        sums[1:-1] = meter.correct
+        sums[-1] = meter.count
+    dist.all_reduce(sums)
+    meter.count = int(sums[-1].item())
+    if meter.count:
+        meter.loss_sum = sums[0]
+        meter.correct = sums[1:-1]
+
+
+def merge_video_preds(dic_video_level_preds):
+    """Sums every rank's per video clip scores into one dict on every rank"""
+    if not is_distributed():
+        return dic_video_level_preds
+    parts = [None] * get_world_size()
+    dist.all_gather_object(parts, dic_video_level_preds)
+    merged = {}
+    for part in parts:
+        for video, preds in part.items():
+            if video in merged:
+                merged[video] = merged[video] + preds
+            else:
+                merged[video] = preds.copy()
+    return merged
+
+
+class NullWriter(object):
+    """Stands in for the SummaryWriter on ranks other than 0"""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
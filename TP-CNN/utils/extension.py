@@ -1,5 +1,9 @@
 import pickle,os
+import random
 import shutil
+import glob
+import threading
+import queue
 import numpy as np
 import torch
 
@@ -15,10 +19,20 @@ def accuracy(output, target, topk=(1,)):
 
     res = []
     for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0)
+        correct_k = correct[:k].reshape(-1).float().sum(0)
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
+def correct_count(output, target, topk=(1,)):
+    """Counts the correct top-k predictions, kept on the device of output"""
+    maxk = max(topk)
+
+    _, pred = output.topk(maxk, 1, True, True)
+    pred = pred.t()
+    correct = pred.eq(target.view(1, -1).expand_as(pred))
+
+    return torch.stack([correct[:k].float().sum() for k in topk])
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
     def __init__(self):
@@ -36,10 +50,185 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
-def save_checkpoint(state, is_best, folder):
-    torch.save(state, folder+'/checkpoint.pth.tar')
+class MetricMeter(object):
+    """Keeps running sums of loss and top-k correct counts as device tensors.
+
+    Updating never leaves the device; values are only copied to the host
+    by `summary`, which callers invoke every `print_freq` steps or at the
+    end of an epoch.
+    """
+    def __init__(self, topk=(1, 5)):
+        self.topk = topk
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = None
+        self.correct = None
+        self.count = 0
+
+    def update(self, loss, output, target):
+        n = target.size(0)
+        loss_sum = loss.detach() * n
+        correct = correct_count(output.detach(), target, self.topk)
+        if self.loss_sum is None:
+            self.loss_sum = loss_sum
+            self.correct = correct
+        else:
+            self.loss_sum += loss_sum
+            self.correct += correct
+        self.count += n
+
+    def summary(self):
+        """Returns (loss avg, [Prec@k ...]) with a single device-to-host copy"""
+        if self.count == 0:
+            return 0., [0.] * len(self.topk)
+        values = torch.cat([self.loss_sum.view(1), self.correct]).cpu().tolist()
+        loss = values[0] / self.count
+        precs = [100.0 * c / self.count for c in values[1:]]
+        return loss, precs
+
+    def state_dict(self):
+        return {'loss_sum': self.loss_sum, 'correct': self.correct, 'count': self.count}
+
+    def load_state_dict(self, state, device=None):
+        self.loss_sum = state['loss_sum']
+        self.correct = state['correct']
+        self.count = state['count']
+        if device is not None and self.loss_sum is not None:
+            self.loss_sum = self.loss_sum.to(device)
+            self.correct = self.correct.to(device)
+
+def get_rng_state():
+    """Python, NumPy, torch and CUDA RNG states, for resuming a run exactly"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_checkpoint(state, is_best, folder, keep_last=0):
+    """Writes folder/checkpoint.pth.tar atomically, see CheckpointWriter"""
+    _write_checkpoint(state, is_best, folder, keep_last)
+
+def snapshot(obj):
+    """Copies every tensor in a (nested) state dict to host memory"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+def _link(src, dst):
+    # atomically point dst at the same file as src, copy if links are unsupported
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+def _write_atomic(state, path):
+    # write + rename, so a crash never leaves a truncated checkpoint behind
+    tmp = path + '.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+def _write_checkpoint(state, is_best, folder, keep_last=0):
+    latest = folder+'/checkpoint.pth.tar'
+    if keep_last > 0:
+        target = folder+'/checkpoint_epoch%03d.pth.tar' % state['epoch']
+    else:
+        target = latest
+    _write_atomic(state, target)
+
+    if target != latest:
+        _link(target, latest)
     if is_best:
-        shutil.copyfile(folder+'/checkpoint.pth.tar', folder+'/model_best.pth.tar')
+        # a hard link shares the data, later checkpoints replace the
+        # checkpoint.pth.tar entry with a new file and leave this one alone
+        _link(target, folder+'/model_best.pth.tar')
+
+    if keep_last > 0:
+        epochs = sorted(glob.glob(folder+'/checkpoint_epoch*.pth.tar'))
+        for old in epochs[:-keep_last]:
+            os.remove(old)
+
+class CheckpointWriter(object):
+    """Saves checkpoints from a background thread.
+
+    `save` snapshots the state to host memory and returns, the write,
+    atomic rename, best-model link and keep-last-N pruning happen on the
+    writer thread. At most one snapshot waits while another is written,
+    `save` blocks beyond that. Errors from the thread are raised by the
+    next `save` or by `close`, which also waits for pending writes.
+    """
+    def __init__(self, keep_last=0, background=True):
+        self.keep_last = keep_last
+        self.background = background
+        self.error = None
+        if background:
+            self.queue = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self._run, name='checkpoint-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, is_best, folder):
+        self._check()
+        if not self.background:
+            _write_checkpoint(state, is_best, folder, self.keep_last)
+            return
+        self.queue.put((_write_checkpoint, (snapshot(state), is_best, folder, self.keep_last)))
+
+    def save_state(self, state, path):
+        """Atomically writes a mid-epoch training state to path"""
+        self._check()
+        if not self.background:
+            _write_atomic(state, path)
+            return
+        self.queue.put((_write_atomic, (snapshot(state), path)))
+
+    def wait(self):
+        if self.background:
+            self.queue.join()
+        self._check()
+
+    def close(self):
+        if self.background and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
 
 def display_format(n):
     return '%.03f' % n
@@ -0,0 +1,161 @@
+import os
+import time
+import fcntl
+from multiprocessing.util import Finalize
+import numpy as np
+import torch
+
+
+class _NullStage(object):
+    # shared no-op context, so a disabled timer costs one attribute lookup
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.timer.record(self.name, time.time() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """Collects wall time per named stage of a step.
+
+    Usage:
+        timer = StageTimer(enabled=opt.timing)
+        with timer.stage('forward'):
+            output = model(input_var)
+
+    When disabled, `stage` returns a shared no-op context manager and
+    `record` returns immediately. `sync` waits for queued CUDA kernels at
+    the stage boundaries so device time is billed to the right stage.
+    If `csv_path` and `flush_every` are set, the summary is appended to the
+    csv after every `flush_every` records, which is how DataLoader workers
+    report without a handle back to the main process; the records left
+    since the last flush are appended when the process exits.
+    """
+    columns = ['pid', 'stage', 'count', 'mean', 'p50', 'p90', 'p99', 'max']
+
+    def __init__(self, enabled=False, sync=False, csv_path=None, flush_every=0):
+        self.enabled = enabled
+        self.sync = sync and enabled and torch.cuda.is_available()
+        self.csv_path = csv_path
+        self.flush_every = flush_every
+        self._pid = None
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.nb_records = 0
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        if self.flush_every and self._pid != os.getpid():
+            # first record in this (forked or spawned) process, like data/telemetry.py
+            self._pid = os.getpid()
+            Finalize(self, self.flush, exitpriority=100)
+        self.times.setdefault(name, []).append(seconds)
+        self.nb_records += 1
+        if self.flush_every and self.nb_records >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Appends the records since the last flush to the csv"""
+        self.write_csv()
+        self.reset()
+
+    def summary(self):
+        info = {}
+        for name, values in self.times.items():
+            values = np.asarray(values)
+            info[name] = {
+                'count': len(values),
+                'mean': values.mean(),
+                'p50': np.percentile(values, 50),
+                'p90': np.percentile(values, 90),
+                'p99': np.percentile(values, 99),
+                'max': values.max()
+            }
+        return info
+
+    def write_tensorboard(self, writer, prefix, step):
+        for name, values in self.times.items():
+            writer.add_histogram(prefix+name, np.asarray(values), step)
+            writer.add_scalar(prefix+name+'_mean', float(np.mean(values)), step)
+
+    def write_csv(self, path=None, **extra):
+        path = path or self.csv_path
+        if path is None or not self.times:
+            return
+        extra_keys = sorted(extra.keys())
+        lines = []
+        for name, info in sorted(self.summary().items()):
+            row = [str(extra[k]) for k in extra_keys]
+            row += [str(os.getpid()), name, str(info['count'])]
+            row += ['%.6f' % info[k] for k in ['mean', 'p50', 'p90', 'p99', 'max']]
+            lines.append(','.join(row))
+        # one locked write per flush so workers flushing together neither
+        # interleave their lines nor both write the header
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if f.tell() == 0:
+                lines.insert(0, ','.join(extra_keys + self.columns))
+            f.write('\n'.join(lines) + '\n')
+
+
+class TraceWindow(object):
+    """Captures a torch.profiler trace of steps [start, start + nb_steps).
+
+    Call `step(i)` at the top of every iteration and `close()` after the
+    loop. The chrome trace is written to `path` and can be opened in
+    chrome://tracing or Perfetto.
+    """
+    def __init__(self, nb_steps, start, path):
+        self.nb_steps = nb_steps
+        self.start = start
+        self.path = path
+        self.profiler = None
+
+    def step(self, i):
+        if self.nb_steps <= 0:
+            return
+        if i == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.start()
+        elif i == self.start + self.nb_steps:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(self.path)
+        print('==> Saved profiler trace of %d steps to %s' % (self.nb_steps, self.path))
+        self.profiler = None
@@ -0,0 +1,204 @@
+# Short calibration run that picks batch_size and num_workers before training
+# Enabled with --autotune=True, the decision is stored in opt.tuned and so
+# ends up in the printed config and in the 'config' of every checkpoint.
+import os
+import time
+import resource
+import multiprocessing
+from pprint import pprint
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader as _DataLoader, RandomSampler
+from data.dataloader import DataLoader as DLoader, Train_Dataset
+from utils.distributed import is_main_process, broadcast_object
+
+
+def _available_memory():
+    # bytes the process may still grow by on the host
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _batch(sample, batch_size):
+    # repeat one dataset item into a batch of the training layout
+    if isinstance(sample, (tuple, list)):
+        return [_batch(s, batch_size) for s in sample]
+    return sample.unsqueeze(0).expand(batch_size, *sample.size()).contiguous()
+
+
+def _to(x, device):
+    if isinstance(x, (tuple, list)):
+        return tuple(_to(i, device) for i in x)
+    return x.to(device)
+
+
+def _train_steps(model, inputs, target, nb_steps):
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), 1e-3, momentum=0.9)
+    model.train()
+    times = []
+    for _ in range(nb_steps + 1):
+        start = time.time()
+        loss = criterion(model(inputs), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if target.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+    # the first step pays for allocation and algorithm selection
+    return min(times[1:])
+
+
+def _probe_cpu(create_model, opt, sample, batch_size, nb_steps, q):
+    try:
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        model = create_model(opt, pretrained=False)
+        inputs = _to(_batch(sample, batch_size), 'cpu')
+        target = torch.zeros(batch_size, dtype=torch.long)
+        sec = _train_steps(model, inputs, target, nb_steps)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - rss0
+        q.put((sec, peak))
+    except (RuntimeError, MemoryError) as e:
+        q.put((None, str(e)))
+
+
+def probe_compute(create_model, opt, device, sample, batch_size, nb_steps):
+    """Returns (seconds per training step, peak bytes) or (None, error)"""
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        try:
+            model = create_model(opt, pretrained=False).to(device)
+            inputs = _to(_batch(sample, batch_size), device)
+            target = torch.zeros(batch_size, dtype=torch.long, device=device)
+            sec = _train_steps(model, inputs, target, nb_steps)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            return None, 'out of memory'
+        finally:
+            model = inputs = None
+            torch.cuda.empty_cache()
+        return sec, torch.cuda.max_memory_allocated(device) - base
+
+    # on the host a failed allocation can take the process down, so every
+    # probe runs in a forked child and its peak RSS growth is the cost
+    ctx = multiprocessing.get_context('fork')
+    q = ctx.Queue()
+    p = ctx.Process(target=_probe_cpu, args=(create_model, opt, sample, batch_size, nb_steps, q))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        return None, 'probe exited with %d' % p.exitcode
+    return q.get()
+
+
+def probe_loader(dataset, batch_size, num_workers, nb_batches):
+    """Seconds per clip of the training loader alone, after worker startup"""
+    sampler = RandomSampler(dataset, replacement=True,
+                            num_samples=batch_size * (nb_batches + 1))
+    loader = _DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                         num_workers=num_workers)
+    batches = iter(loader)
+    next(batches)
+    start = time.time()
+    nb_clips = 0
+    for batch in batches:
+        nb_clips += batch[-1].size(0)
+    return (time.time() - start) / max(nb_clips, 1)
+
+
+def step_time(compute, data, num_workers):
+    # workers prefetch while the model trains, the main process cannot
+    if num_workers == 0:
+        return compute + data
+    return max(compute, data)
+
+
+def tune(opt, device, create_model):
+    """Sets opt.batch_size, opt.num_workers and opt.tuned, rank 0 decides for every rank"""
+    tuned = _tune(opt, device, create_model) if is_main_process() else None
+    tuned = broadcast_object(tuned)
+    opt.batch_size = tuned['batch_size']
+    opt.num_workers = tuned['num_workers']
+    opt.tuned = tuned
+    print('==> Autotune decision')
+    pprint(opt.tuned)
+    return tuned
+
+
+def _tune(opt, device, create_model):
+    data_loader = DLoader(opt)
+    data_loader.train_video_labeling()
+    dataset = Train_Dataset(opt=opt, dic_train=data_loader.dic_video_train)
+    item = dataset[0]
+    sample = item[1] if opt.Fusion else item[0]
+
+    if device.type == 'cuda':
+        limit = torch.cuda.get_device_properties(device).total_memory * opt.tune_memory_fraction
+    else:
+        # the processes of a node share its memory
+        available = _available_memory()
+        limit = available * opt.tune_memory_fraction if available else float('inf')
+        limit /= int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+    # memory headroom and compute time, doubling the batch until it does not fit
+    print('==> Autotune: probing batch sizes up to %d (memory limit %.0f MB)' % (
+        opt.tune_max_batch, limit / 2.**20))
+    compute = {}
+    memory = {}
+    batch_size = 2  # BatchNorm needs more than one clip in training mode
+    while batch_size <= opt.tune_max_batch:
+        sec, peak = probe_compute(create_model, opt, device, sample, batch_size, opt.tune_steps)
+        if sec is None:
+            print('    batch %4d: %s' % (batch_size, peak))
+            break
+        print('    batch %4d: %8.1f ms/step %8.1f clips/s %9.1f MB' % (
+            batch_size, 1000. * sec, batch_size / sec, peak / 2.**20))
+        if peak > limit:
+            break
+        compute[batch_size] = sec
+        memory[batch_size] = peak
+        # the next doubling would roughly double the activations
+        if 2 * peak > limit:
+            break
+        batch_size *= 2
+    if not compute:
+        raise RuntimeError('Autotune: even batch_size=2 does not fit in memory')
+
+    # data time per clip for every worker count, measured at the largest batch
+    probe_batch = max(compute)
+    workers = [0] + [w for w in [1, 2, 4, 8, 16, 32] if w <= (os.cpu_count() or 1)]
+    print('==> Autotune: probing num_workers %s at batch %d' % (workers, probe_batch))
+    data = {}
+    for w in workers:
+        data[w] = probe_loader(dataset, probe_batch, w, opt.tune_steps)
+        print('    workers %3d: %8.2f ms/clip' % (w, 1000. * data[w]))
+
+    # best estimated clips/s, ties go to the smaller batch and fewer workers
+    best = None
+    for b in sorted(compute):
+        for w in workers:
+            rate = b / step_time(compute[b], b * data[w], w)
+            if best is None or rate > best[0] * 1.05:
+                best = (rate, b, w)
+    rate, batch_size, num_workers = best
+
+    return {
+        'batch_size': batch_size,
+        'num_workers': num_workers,
+        'est_clips_per_sec': rate,
+        'device': str(device),
+        'memory_limit_MB': limit / 2.**20 if limit != float('inf') else None,
+        'step_ms': dict((str(b), 1000. * s) for b, s in compute.items()),
+        'peak_MB': dict((str(b), m / 2.**20) for b, m in memory.items()),
+        'data_ms_per_clip': dict((str(w), 1000. * s) for w, s in data.items())
+    }